@@ -19,6 +19,8 @@ from torch.autograd import Variable
 from Baselines.GlobalStateEvaluation.test import show_test_result
 
 from data_loader.BatchEnv import BatchSpatialEnv
+from data_loader.PrefetchEnv import PrefetchBatchEnv
+from data_loader.ReplayCache import make_cache
 
 class BuildOrderGRU(torch.nn.Module):
     def __init__(self, n_channels, n_features, n_actions):
@@ -93,13 +95,16 @@ def train(model, env, args):
 
     epoch = 0
     save = args.save_intervel
-    env_return = env.step(reward=False, action=True)
+    # The env writes every batch straight into these, pinned for the copies to the GPU
+    buffers = [torch.zeros(args.n_steps, args.n_replays, env.n_channels, 64, 64),
+               torch.zeros(args.n_steps, args.n_replays, env.n_features),
+               torch.zeros(args.n_steps, args.n_replays).long().squeeze()]
+    if gpu_id >= 0:
+        buffers = [buf.pin_memory() for buf in buffers]
+    env_return = env.step(out=buffers, reward=False, action=True)
     if env_return is not None:
         (states_S, states_G, actions_gt), require_init = env_return
     with torch.cuda.device(gpu_id):
-        states_S = torch.from_numpy(states_S).float()
-        states_G = torch.from_numpy(states_G).float()
-        actions_gt = torch.from_numpy(actions_gt).long().squeeze()
         weight = torch.ones((env.n_actions,))
         weight[-1] = 0.05
         if gpu_id >= 0:
@@ -172,12 +177,13 @@ def train(model, env, args):
             gt_per_replay[idx].append(action_gt[-1])
 
         ####################### NEXT BATCH ###################################
-        env_return = env.step(reward=False, action=True)
+        env_return = env.step(out=buffers, reward=False, action=True)
         if env_return is not None:
-            (raw_states_S, raw_states_G, raw_rewards), require_init = env_return
-            states_S = states_S.copy_(torch.from_numpy(raw_states_S).float())
-            states_G = states_G.copy_(torch.from_numpy(raw_states_G).float())
-            actions_gt = actions_gt.copy_(torch.from_numpy(raw_rewards).long().squeeze())
+            (raw_states_S, raw_states_G, raw_actions_gt), require_init = env_return
+            if gpu_id >= 0:
+                states_S = states_S.copy_(raw_states_S)
+                states_G = states_G.copy_(raw_states_G)
+                actions_gt = actions_gt.copy_(raw_actions_gt)
 
         if env.step_count() > save or env_return is None:
             save = env.step_count()+args.save_intervel
@@ -275,6 +281,12 @@ def main():
     parser.add_argument('--n_steps', type=int, default=20, help='# of forward steps (default: 20)')
     parser.add_argument('--n_replays', type=int, default=32, help='# of replays (default: 32)')
     parser.add_argument('--n_epoch', type=int, default=10, help='# of epoches (default: 10)')
+    parser.add_argument('--n_workers', type=int, default=0,
+                        help='# of processes assembling batches [0 indicate in-process] (default: 0)')
+    parser.add_argument('--cache_size', type=int, default=0,
+                        help='MB of decoded replays kept in memory across epochs and checkpoints [0 indicate no cache] (default: 0)')
+    parser.add_argument('--shared_store', type=str, default=None,
+                        help='Name of the split published by data_loader/SharedStore.py, replaces --cache_size (default: None)')
 
     parser.add_argument('--save_intervel', type=int, default=1000000,
                         help='Frequency of model saving (default: 1000000)')
@@ -296,10 +308,11 @@ def main():
         with open(os.path.join(args.save_path, 'config'), 'w') as f:
             f.write(json.dumps(vars(args)))
 
-        env = BatchSpatialEnv()
+        env = BatchSpatialEnv() if args.n_workers == 0 else PrefetchBatchEnv(BatchSpatialEnv, n_workers=args.n_workers)
         env.init(os.path.join(args.replays_path, '{}.json'.format(args.phrase)),
                     './', args.race, args.enemy_race, n_steps=args.n_steps, seed=args.seed,
-                        n_replays=args.n_replays, epochs=args.n_epoch)
+                        n_replays=args.n_replays, epochs=args.n_epoch,
+                            cache=make_cache(args.cache_size, args.shared_store))
         model = BuildOrderGRU(env.n_channels, env.n_features, env.n_actions)
         train(model, env, args)
     elif 'val' in args.phrase or 'test' in args.phrase:
@@ -309,6 +322,7 @@ def main():
 
         dataset_path = 'test.json' if 'test' in args.phrase else 'val.json'
         paths = set()
+        cache = make_cache(args.cache_size, args.shared_store)
         while True:
             path = next_path(args.model_path, paths)
             if path is not None:
@@ -317,7 +331,7 @@ def main():
                 env = BatchSpatialEnv()
                 env.init(os.path.join(args.replays_path, dataset_path),
                             './', args.race, args.enemy_race, n_steps=args.n_steps,
-                                            seed=args.seed, n_replays=1, epochs=1)
+                                            seed=args.seed, n_replays=1, epochs=1, cache=cache)
                 model = BuildOrderGRU(env.n_channels, env.n_features, env.n_actions)
                 model.load_state_dict(torch.load(path))
                 result = test(model, env, args)
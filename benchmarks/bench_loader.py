@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import resource
+import tempfile
+import itertools
+import multiprocessing
+
+from data_loader.BatchEnv import BatchGlobalFeatureEnv, BatchSpatialEnv
+from data_loader.ReplayCache import ReplayCache
+from benchmarks.synthetic import generate
+
+def instrument(env_cls):
+    """
+    Subclass of env_cls timing __load_replay__ and __post_process__, and counting the bytes they read
+    """
+    class TimedEnv(env_cls):
+        def __post_init__(self, **kwargs):
+            self.timers = {'load': 0., 'post_process': 0.}
+            self.read_bytes = 0
+            self.decoded_bytes = 0
+            super(TimedEnv, self).__post_init__(**kwargs)
+
+        def __load_replay__(self, path):
+            start = time.time()
+            replay_dict = super(TimedEnv, self).__load_replay__(path)
+            self.timers['load'] += time.time() - start
+
+            self.read_bytes += sum(os.path.getsize(p) for p in self.__files__(path))
+            self.decoded_bytes += sum(v.nbytes for v in replay_dict.values())
+            return replay_dict
+
+        def __files__(self, path):
+            if isinstance(path, list):
+                groups = [path[0].replace('@S.npz', '@S_{}.npz'.format(c)) for c in self.channels]
+                return (groups if all(os.path.isfile(p) for p in groups) else [path[0]]) + [path[1]]
+            # Packed splits are memory-mapped, see decoded bytes instead
+            return [] if self.packed is not None else [path]
+
+        def __post_process__(self, result, **kwargs):
+            start = time.time()
+            result = super(TimedEnv, self).__post_process__(result, **kwargs)
+            self.timers['post_process'] += time.time() - start
+            return result
+
+    TimedEnv.__name__ = env_cls.__name__
+    return TimedEnv
+
+def run(env_cls, split_path, root, race, enemy_race, n_replays, n_steps, n_batches, step_kwargs, **kwargs):
+    env = instrument(env_cls)()
+    env.init(split_path, root, race, enemy_race, n_replays=n_replays, n_steps=n_steps, **kwargs)
+
+    batches = 0
+    start = time.time()
+    while batches < n_batches and env.step(**step_kwargs) is not None:
+        batches += 1
+    elapsed = time.time() - start
+    env.close()
+
+    return {'env': env_cls.__name__, 'n_replays': n_replays, 'n_steps': n_steps, 'batches': batches,
+            'frames': env.step_count(), 'seconds': elapsed,
+            'batches_per_second': batches / elapsed, 'frames_per_second': env.step_count() / elapsed,
+            'read_MB': env.read_bytes / 2**20, 'read_MB_per_second': env.read_bytes / 2**20 / elapsed,
+            'decoded_MB': env.decoded_bytes / 2**20,
+            'load_seconds': env.timers['load'], 'post_process_seconds': env.timers['post_process'],
+            'assemble_seconds': elapsed - env.timers['load'] - env.timers['post_process'],
+            'padding': env.padding_stats()['waste'],
+            # KB on Linux, of the whole process so far
+            'peak_rss_MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark BatchGlobalFeatureEnv and BatchSpatialEnv')
+    parser.add_argument('--env', default='global', choices=['global', 'spatial'], help='Which env? (default: global)')
+    parser.add_argument('--split_path', default=None,
+                        help='Split to load [None indicate synthetic replays] (default: None)')
+    parser.add_argument('--root', default='./', help='Root of the split (default: ./)')
+    parser.add_argument('--race', default='Terran', help='Which race? (default: Terran)')
+    parser.add_argument('--enemy_race', default='Terran', help='Which the enemy race? (default: Terran)')
+    parser.add_argument('--n_replays', default='4,32', help='Comma separated # of replays (default: 4,32)')
+    parser.add_argument('--n_steps', default='5,20', help='Comma separated # of forward steps (default: 5,20)')
+    parser.add_argument('--n_batches', type=int, default=200, help='Max # of batches per run (default: 200)')
+    parser.add_argument('--labels', default='reward', help='Labels passed to env.step() (default: reward)')
+    parser.add_argument('--channels', default='minimap,unit_type',
+                        help='Channel groups of spatial feature tensors (default: minimap,unit_type)')
+    parser.add_argument('--packed_path', default=None, help='Index of a packed split (default: None)')
+    parser.add_argument('--packing', action='store_true', help='Refill finished slots inside the window')
+    parser.add_argument('--cache_size', type=int, default=0, help='MB of decoded replays to cache (default: 0)')
+    parser.add_argument('--synthetic_replays', type=int, default=64, help='# of synthetic replays (default: 64)')
+    parser.add_argument('--quantize', action='store_true', help='Synthetic S as raw uint8/uint16 layers')
+    parser.add_argument('--output', default=None, help='JSON file for the results (default: None)')
+    args = parser.parse_args()
+
+    synthetic = args.split_path is None
+    if synthetic:
+        args.root = tempfile.mkdtemp(prefix='msc_bench_')
+        # In a child process, to keep it out of the peak RSS
+        with multiprocessing.Pool(1) as pool:
+            args.split_path = pool.apply(generate, (args.root, args.race, args.enemy_race, args.synthetic_replays),
+                                         {'spatial': args.env == 'spatial', 'quantize': args.quantize})
+
+    labels = args.labels.split(',')
+    step_kwargs = {'reward': 'reward' in labels, 'action': 'action' in labels, 'score': 'score' in labels}
+    # Stop after n_batches rather than at the end of the split
+    kwargs = {'packing': args.packing, 'epochs': 1000}
+    if args.env == 'global':
+        env_cls = BatchGlobalFeatureEnv
+        kwargs['packed_path'] = args.packed_path
+    else:
+        env_cls = BatchSpatialEnv
+        kwargs['channels'] = tuple(args.channels.split(','))
+
+    results = []
+    for n_replays, n_steps in itertools.product([int(n) for n in args.n_replays.split(',')],
+                                                [int(n) for n in args.n_steps.split(',')]):
+        cache = ReplayCache(args.cache_size*2**20) if args.cache_size > 0 else None
+        results.append(run(env_cls, args.split_path, args.root, args.race, args.enemy_race, n_replays, n_steps,
+                           args.n_batches, step_kwargs, cache=cache, **kwargs))
+        print('{env} n_replays={n_replays} n_steps={n_steps}: {frames_per_second:.0f} frames/s, '
+              '{batches_per_second:.1f} batches/s, {read_MB_per_second:.1f} MB/s, load {load_seconds:.2f}s, '
+              'assemble {assemble_seconds:.2f}s, post_process {post_process_seconds:.2f}s, '
+              'peak RSS {peak_rss_MB:.0f} MB'.format(**results[-1]), file=sys.stderr)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+    if synthetic:
+        shutil.rmtree(args.root)
+
+if __name__ == '__main__':
+    main()
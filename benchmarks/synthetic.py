@@ -0,0 +1,111 @@
+import os
+import json
+import argparse
+
+import numpy as np
+from scipy import sparse
+
+from tqdm import tqdm
+
+from data_loader.BatchEnv import BatchGlobalFeatureEnv, BatchSpatialEnv
+
+def global_feature_vector(rng, length, race, enemy_race, density):
+    """
+    (T, 15+M) matrix laid out as in README.md: reward, action, score, observation in [0, 1]
+    """
+    n_features = BatchGlobalFeatureEnv.n_features_dic[race][enemy_race]
+    F = sparse.random(length, 15+n_features, density=density, format='csc', random_state=rng).toarray()
+    F[:, 0] = rng.randint(2)
+    F[:, 1] = rng.randint(BatchGlobalFeatureEnv.n_actions_dic[race], size=length)
+    F[:, 2:15] = np.cumsum(rng.randint(100, size=(length, 13)), axis=0)
+    return sparse.csc_matrix(F)
+
+def spatial_feature_tensor(rng, length, race, density, quantize):
+    """
+    {group: S of the channel group} and the (T, 26) matrix G, laid out as in README.md
+    """
+    S = {}
+    for group, scales in BatchSpatialEnv.channel_scales.items():
+        scales = np.asarray(scales)
+        n_columns = len(scales)*64*64
+        # Sample the non-zero entries directly, dense float layers would not fit in memory for long replays
+        idx = rng.randint(length*n_columns, size=int(density*length*n_columns))
+        row, col = idx // n_columns, idx % n_columns
+        raw = 1 + rng.randint(1 << 16, size=len(idx)) % (scales[col // (64*64)] - 1).clip(1)
+        if quantize:
+            S_raw = np.zeros((length, n_columns), dtype=np.uint16 if group == 'unit_type' else np.uint8)
+            S_raw[row, col] = raw
+            S[group] = {'S': S_raw.reshape([length, len(scales), 64, 64]), 'scale': scales}
+        else:
+            S[group] = sparse.csc_matrix((raw / scales[col // (64*64)], (row, col)), shape=(length, n_columns))
+
+    G = np.zeros((length, 26))
+    G[:, :11] = rng.rand(length, 11)
+    G[:, 11:24] = np.cumsum(rng.randint(100, size=(length, 13)), axis=0)
+    G[:, 24] = rng.randint(2)
+    G[:, 25] = rng.randint(BatchSpatialEnv.n_actions_dic[race], size=length)
+    return S, sparse.csc_matrix(G)
+
+def generate(root, race='Terran', enemy_race='Terran', n_replays=64, min_length=500, max_length=2000,
+                spatial=False, quantize=False, density=0.1, seed=1):
+    """
+    Write n_replays synthetic replay-perspectives of race under root, and a split listing them.
+    Returns the path of the split
+    """
+    rng = np.random.RandomState(seed)
+    race_vs_race = '{}_vs_{}'.format(*sorted([race, enemy_race]))
+    global_root = os.path.join('GlobalFeatureVector', race_vs_race, race)
+    spatial_root = os.path.join('SpatialFeatureTensor', race_vs_race, race)
+    for path in [global_root, spatial_root]:
+        if not os.path.isdir(os.path.join(root, path)):
+            os.makedirs(os.path.join(root, path))
+
+    replays = []
+    for i in tqdm(range(n_replays), desc='#Replay'):
+        length = rng.randint(min_length, max_length+1)
+        name = '1@{:08d}.SC2Replay'.format(i)
+        player_path = {'global_path': os.path.join(global_root, name+'.npz')}
+        sparse.save_npz(os.path.join(root, player_path['global_path']),
+                        global_feature_vector(rng, length, race, enemy_race, density))
+
+        if spatial:
+            player_path['spatial_path_S'] = os.path.join(spatial_root, name+'@S.npz')
+            player_path['spatial_path_G'] = os.path.join(spatial_root, name+'@G.npz')
+            S, G = spatial_feature_tensor(rng, length, race, density, quantize)
+            for group, S_group in S.items():
+                path = os.path.join(root, spatial_root, '{}@S_{}.npz'.format(name, group))
+                if quantize:
+                    np.savez_compressed(path, **S_group)
+                else:
+                    sparse.save_npz(path, S_group)
+            sparse.save_npz(os.path.join(root, player_path['spatial_path_G']), G)
+
+        replays.append({race: [player_path]} if race == enemy_race else {race: [player_path], enemy_race: []})
+
+    split_path = os.path.join(root, 'train_val_test', race_vs_race, 'train.json')
+    if not os.path.isdir(os.path.dirname(split_path)):
+        os.makedirs(os.path.dirname(split_path))
+    with open(split_path, 'w') as f:
+        json.dump(replays, f)
+
+    return split_path
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic replays with the schemas of the real dataset')
+    parser.add_argument('--root', default='benchmarks/data', help='Where to write (default: benchmarks/data)')
+    parser.add_argument('--race', default='Terran', help='Which race? (default: Terran)')
+    parser.add_argument('--enemy_race', default='Terran', help='Which the enemy race? (default: Terran)')
+    parser.add_argument('--n_replays', type=int, default=64, help='# of replays (default: 64)')
+    parser.add_argument('--min_length', type=int, default=500, help='Min # of frames (default: 500)')
+    parser.add_argument('--max_length', type=int, default=2000, help='Max # of frames (default: 2000)')
+    parser.add_argument('--spatial', action='store_true', help='Also write spatial feature tensors')
+    parser.add_argument('--quantize', action='store_true', help='Store S as raw uint8/uint16 layers')
+    parser.add_argument('--density', type=float, default=0.1, help='Fraction of non-zero values (default: 0.1)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+    args = parser.parse_args()
+
+    print(generate(args.root, args.race, args.enemy_race, args.n_replays, args.min_length, args.max_length,
+                   args.spatial, args.quantize, args.density, args.seed))
+
+if __name__ == '__main__':
+    main()
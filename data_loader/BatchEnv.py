@@ -1,17 +1,79 @@
 import os
 import json
-from collections import namedtuple
+import heapq
 
 import numpy as np
 from scipy import sparse
 
 from tqdm import tqdm
 
+def global_column_groups(race, enemy_race):
+    """
+    [(group, start, end)] columns of every group of F, see BatchGlobalFeatureEnv.
+    Shared with extract_features/pack_split.py, so packed columnar files match the projection of the env
+    """
+    env = BatchGlobalFeatureEnv
+    ends = [1, 2, 15, 27] + env.column_ends_dic[race]
+    ends.append(ends[-1] + env.n_enemy_units_dic[enemy_race])
+    return list(zip(env.label_groups+env.observation_groups, [0]+ends[:-1], ends))
+
+def load_packed_split(index_path, root):
+    """
+    Memory-map a split packed by extract_features/pack_split.py
+    Returns {path: (T, M) read-only view}, with paths joined to root as in the split,
+    or {path: {group: (T, #columns) read-only view}} if packed with --columnar
+    """
+    with open(index_path) as f:
+        index = json.load(f)
+    if index['n_rows'] == 0: # Empty files can not be memory-mapped
+        return {}
+
+    if 'groups' in index:
+        groups = {name: np.memmap(os.path.join(os.path.dirname(index_path), group['data']), dtype=index['dtype'],
+                                  mode='r', shape=(index['n_rows'], group['n_features']))
+                    for name, group in index['groups'].items()}
+        return {os.path.join(root, path): {name: data[offset:offset+length] for name, data in groups.items()}
+                    for path, (offset, length) in index['replays'].items()}
+
+    data = np.memmap(os.path.join(os.path.dirname(index_path), index['data']), dtype=index['dtype'],
+                     mode='r', shape=(index['n_rows'], index['n_features']))
+
+    return {os.path.join(root, path): data[offset:offset+length]
+                for path, (offset, length) in index['replays'].items()}
+
+def copy_to(result, out):
+    """
+    Write the arrays of a batch into out, e.g. (pinned) torch tensors of the shapes and dtypes the model takes,
+    casting in place without intermediate copies. Returns result itself if out is None
+    """
+    if out is None:
+        return result
+
+    assert len(result) == len(out)
+    for r, buf in zip(result, out):
+        # CPU torch tensors share memory with their numpy() view
+        view = buf.numpy() if hasattr(buf, 'numpy') else buf
+        np.copyto(view, r.reshape(view.shape), casting='unsafe')
+    return out
+
+def load_manifest(path):
+    """
+    Load the manifest written by extract_features/split.py next to [SPLIT].json,
+    a structured array with one row per replay-perspective
+    """
+    return np.load(path)
+
 class BatchEnv(object):
     def __init__(self):
         pass
 
-    def init(self, path, root, race, enemy_race, step_mul=8, n_replays=4, n_steps=5, epochs=10, seed=None):
+    def init(self, path, root, race, enemy_race, step_mul=8, n_replays=4, n_steps=5, epochs=10, seed=None,
+                cache=None, rank=0, world_size=1, packing=False, manifest=None, where=None, **kwargs):
+        """
+        manifest: [SPLIT].manifest.npy or its rows, provides the replay lengths without opening feature files
+        where: keep only the replays whose manifest rows pass,
+               e.g. lambda m: (m['mmr'] > 3000) & (m['global_length'] < 20000)
+        """
         np.random.seed(seed)
 
         with open(path) as f:
@@ -19,6 +81,13 @@ class BatchEnv(object):
 
         self.replays = self.__generate_replay_list__(replays, root, race)
 
+        self.lengths = None
+        if manifest is not None:
+            self.__apply_manifest__(load_manifest(manifest) if isinstance(manifest, str) else manifest, root, where)
+        else:
+            assert where is None, 'Filtering requires a manifest'
+
+        self.root = root
         self.race = race
         self.enemy_race = enemy_race
 
@@ -28,80 +97,320 @@ class BatchEnv(object):
 
         self.epochs = epochs
         self.epoch = -1
+        self.data_epoch = -1
         self.steps = 0
+        self.padding = 0
+        self.n_batches = 0
+        self.finished = False
+        self.out_of_replays = False
+
+        ## Decoded replays, see data_loader/ReplayCache.py
+        self.cache = cache
 
         self.replay_idx = -1
+        self.epoch_replays = []
         self.replay_list = [None for _ in range(self.n_replays)]
+        self.ptr = np.zeros(self.n_replays, dtype=np.int64)
+        self.length = np.zeros(self.n_replays, dtype=np.int64)
+        self.done = np.zeros(self.n_replays, dtype=bool)
 
         ## Display Progress Bar
         self.epoch_pbar = tqdm(total=self.epochs, desc='Epoch')
         self.replay_pbar = None
 
-        self.__post_init__()
+        self.__post_init__(**kwargs)
+
+        ## Refill finished slots inside the window instead of zero padding, see __packed_step__
+        self.packing = packing
+
+        ## Sharding across processes
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        if self.world_size > 1:
+            assert not self.packing, 'The shard schedule assumes one replay per slot and window'
+            self.__shard__()
 
     def __generate_replay_list__(self, replays, race):
         raise NotImplementedError
 
+    def __apply_manifest__(self, manifest, root, where):
+        rows = manifest[manifest[self.manifest_path] != '']
+        if where is not None:
+            rows = rows[where(rows)]
+
+        self.lengths = {os.path.join(root, path): int(length)
+                            for path, length in zip(rows[self.manifest_path], rows[self.manifest_length])}
+        self.replays = [path for path in self.replays if self.__manifest_key__(path) in self.lengths]
+
+    def __manifest_key__(self, path):
+        return path
+
+    def __shard__(self):
+        """
+        Split the replays of every epoch into world_size disjoint shards with balanced #frames,
+        reproducible from (seed, epoch). Every rank stops after the same # of step()
+        """
+        assert len(self.replays) >= self.world_size
+        lengths = np.asarray([self.__replay_length__(path) for path in self.replays])
+
+        self.shards = []
+        for epoch in range(self.epochs):
+            rng = np.random.RandomState([0 if self.seed is None else self.seed, epoch])
+            perm = rng.permutation(len(self.replays))
+            # Longest first to the rank with the fewest frames
+            shards = [[] for _ in range(self.world_size)]
+            frames = [(0, rank) for rank in range(self.world_size)]
+            for idx in perm[np.argsort(-lengths[perm], kind='stable')]:
+                n_frames, rank = heapq.heappop(frames)
+                shards[rank].append(idx)
+                heapq.heappush(frames, (n_frames+lengths[idx], rank))
+            for shard in shards:
+                rng.shuffle(shard)
+            self.shards.append(shards)
+
+        # Replay the slot schedule of every rank: a replay of length T occupies its slot for ceil(T/n_steps) batches
+        n_batches, epoch_starts = [], []
+        for rank in range(self.world_size):
+            free = [0 for _ in range(self.n_replays)]
+            starts = []
+            for shards in self.shards:
+                for i, idx in enumerate(shards[rank]):
+                    t = heapq.heappop(free)
+                    if i == 0:
+                        starts.append(t)
+                    heapq.heappush(free, t + max(1, -(-lengths[idx] // self.n_steps)))
+            n_batches.append(free[0])
+            epoch_starts.append(starts)
+
+        self.max_batches = min(n_batches)
+        # A rank enters an epoch once every rank has started it, so all of them see the same epoch
+        self.epoch_starts = np.max(epoch_starts, axis=0)
+        self.shards = [[self.replays[idx] for idx in shards[self.rank]] for shards in self.shards]
+
+    def __replay_length__(self, path):
+        """
+        Return T of the replay at path, used for sharding
+        """
+        raise NotImplementedError
+
     def __init_epoch__(self):
-        self.epoch += 1
-        if self.epoch > 0:
+        self.data_epoch += 1
+        if self.world_size == 1:
+            self.epoch = self.data_epoch
+        if self.data_epoch > 0:
             self.epoch_pbar.update(1)
-        if self.epoch == self.epochs:
+        if self.data_epoch == self.epochs:
             return False
 
-        np.random.shuffle(self.replays)
+        if self.world_size > 1:
+            self.epoch_replays = self.shards[self.data_epoch]
+        else:
+            np.random.shuffle(self.replays)
+            self.epoch_replays = self.replays
         ## Display Progress Bar
         if self.replay_pbar is not None:
             self.replay_pbar.close()
-        self.replay_pbar = tqdm(total=len(self.replays), desc='  Replays')
+        self.replay_pbar = tqdm(total=len(self.epoch_replays), desc='  Replays')
         return True
 
     def __reset__(self):
         self.replay_idx += 1
-        if self.replay_idx % len(self.replays) == 0:
+        if self.replay_idx == len(self.epoch_replays):
             has_more = self.__init_epoch__()
             if not has_more:
                 return None
+            self.replay_idx = 0
+
+        return self.__cached_load__(self.epoch_replays[self.replay_idx])
+
+    def __cached_load__(self, path):
+        """
+        __load_replay__, read from the cache if there is one
+        """
+        if self.cache is None:
+            return self.__load_replay__(path)
+
+        key = self.__cache_key__(path)
+        replay_dict = self.cache.get(key)
+        if replay_dict is not None:
+            replay_dict = self.__from_cache__(replay_dict)
+        if replay_dict is None:
+            replay_dict = self.__load_replay__(path)
+            self.cache.put(key, replay_dict)
 
-        path = self.replays[self.replay_idx%len(self.replays)]
+        return replay_dict
+
+    def __cache_key__(self, path):
+        """
+        Identifies the replay at path and the features read from it, but not the labels selected by step(),
+        so that a store published with every label serves any selection, see data_loader/SharedStore.py
+        """
+        return (type(self).__name__, str(path))
 
-        return self.__load_replay__(path)
+    def __from_cache__(self, replay_dict):
+        """
+        Keep the arrays of a cached replay_dict which __load_replay__ would return, None if some are missing
+        """
+        return replay_dict
 
     def __load_replay__(self, path):
+        """
+        Return {name: (T, ...) array} for the replay at path
+        """
         raise NotImplementedError
 
-    def step(self, **kwargs):
+    def __load_window__(self, path, start, end):
+        """
+        Return {name: (end-start, ...) array}, frames [start, end) of the replay at path
+        """
+        return {k: v[start:end] for k, v in self.__load_replay__(path).items()}
+
+    def __select__(self, **kwargs):
+        """
+        Called with the arguments of step() before loading, to read only what __post_process__ returns
+        """
+        pass
+
+    def __outputs__(self, **kwargs):
+        """
+        [(name, columns)] if output j of __post_process__ is result[name][..., columns] (all of it for None),
+        so that step() writes every replay straight into out. None if __post_process__ computes its outputs
+        """
+        return None
+
+    def __targets__(self, replay_dict, out, **kwargs):
+        """
+        [(name, columns, (n_steps, n_replays, ...) array)] to write the frames of every replay into,
+        the views of out if possible, otherwise a result dict for __post_process__
+        """
+        outputs = None if out is None else self.__outputs__(**kwargs)
+        if outputs is None:
+            return [(k, None, np.empty((self.n_steps, self.n_replays)+states.shape[1:], dtype=states.dtype))
+                        for k, states in replay_dict.items()]
+
+        assert len(outputs) == len(out)
+        targets = []
+        for (k, columns), buf in zip(outputs, out):
+            # CPU torch tensors share memory with their numpy() view
+            view = buf.numpy() if hasattr(buf, 'numpy') else buf
+            assert view.shape[:2] == (self.n_steps, self.n_replays)
+            targets.append((k, columns, view))
+        return targets
+
+    def __write__(self, targets, i, t, replay_dict, ptr, n):
+        """
+        Write frames [ptr, ptr+n) of replay_dict into steps [t, t+n) of slot i, casting to the dtype of the targets
+        """
+        for k, columns, array in targets:
+            states = replay_dict[k][ptr:ptr+n]
+            if columns is not None:
+                states = states[:, columns]
+            array[t:t+n, i] = states.reshape((n,)+array.shape[2:])
+
+    def __return__(self, targets, out, **kwargs):
+        if out is None or self.__outputs__(**kwargs) is None:
+            return copy_to(self.__post_process__({k: array for k, _, array in targets}, **kwargs), out)
+        return out
+
+    def step(self, out=None, **kwargs):
         """
         Perform one batch of n_replays for training
+        out: buffers to write the batch into, see copy_to
         """
+        self.__select__(**kwargs)
+        if self.world_size > 1 and self.n_batches == self.max_batches:
+            return None
+        if self.packing:
+            return self.__packed_step__(out, **kwargs)
+
         require_init = [False for _ in range(self.n_replays)]
         for i in range(self.n_replays):
-            if self.replay_list[i] is None or self.replay_list[i]['done']: # Set replay_list elements
-                if self.replay_list[i] is not None: # self.replay_list[i]['done']
-                    keys = set(self.replay_list[i].keys())
-                    for k in keys:
-                        del self.replay_list[i][k]
-                self.replay_list[i] = self.__reset__() 
+            if self.replay_list[i] is None or self.done[i]: # Set replay_list elements
+                self.replay_list[i] = self.__reset__()
+                if self.replay_list[i] is None:
+                    return None
+                self.ptr[i] = 0
+                self.length[i] = len(next(iter(self.replay_list[i].values())))
+                self.done[i] = False
                 require_init[i] = True
-            if self.replay_list[i] is None:
-                return None
 
-        result = []
-        for step in range(self.n_steps):
-            result_per_step = []
-            for i in range(self.n_replays):
-                replay_dict = self.replay_list[i]
+        # Copy [ptr, ptr+n_steps) of every replay into (n_steps, n_replays, ...), zero padding the finished ones
+        n = np.minimum(self.length - self.ptr, self.n_steps)
+        targets = self.__targets__(self.replay_list[0], out, **kwargs)
+        for i, replay_dict in enumerate(self.replay_list):
+            self.__write__(targets, i, 0, replay_dict, self.ptr[i], n[i])
+            for _, _, array in targets:
+                array[n[i]:, i] = 0
 
-                features = self.__one_step__(replay_dict, replay_dict['done'])
+        self.ptr += n
+        self.steps += int(np.sum(n))
+        self.padding += self.n_steps*self.n_replays - int(np.sum(n))
+        self.done = self.ptr == self.length
+        self.replay_pbar.update(int(np.sum(self.done)))
 
-                result_per_step.append(features)
+        self.n_batches += 1
+        if self.world_size > 1:
+            self.epoch = int(np.searchsorted(self.epoch_starts, self.n_batches-1, side='right')) - 1
 
-            result.append(result_per_step)
+        return self.__return__(targets, out, **kwargs), require_init
 
-        return self.__post_process__(result, **kwargs), require_init
+    def __packed_step__(self, out=None, **kwargs):
+        """
+        Perform one batch of n_replays, starting the next replay of a slot right after the previous one ends.
+        Returns a (n_steps, n_replays) mask instead of require_init, True where a replay starts
+        """
+        if self.finished:
+            return None
 
-    def __one_step__(self, replay_dict, done):
-        raise NotImplementedError
+        targets, padding = None, 0
+        reset = np.zeros((self.n_steps, self.n_replays), dtype=bool)
+        for i in range(self.n_replays):
+            t = 0
+            while t < self.n_steps:
+                if self.replay_list[i] is None or self.done[i]:
+                    # Out of replays, pad this slot while the others finish their replays
+                    if self.out_of_replays:
+                        self.replay_list[i] = None
+                        break
+                    self.replay_list[i] = self.__reset__()
+                    if self.replay_list[i] is None:
+                        self.out_of_replays = True
+                        break
+                    self.ptr[i] = 0
+                    self.length[i] = len(next(iter(self.replay_list[i].values())))
+                    self.done[i] = False
+                    reset[t, i] = True
+
+                if targets is None:
+                    targets = self.__targets__(self.replay_list[i], out, **kwargs)
+                    # Slots before this one are empty
+                    for _, _, array in targets:
+                        array[:, :i] = 0
+
+                n = int(min(self.n_steps - t, self.length[i] - self.ptr[i]))
+                self.__write__(targets, i, t, self.replay_list[i], self.ptr[i], n)
+                self.ptr[i] += n
+                t += n
+                self.steps += n
+                if self.ptr[i] == self.length[i]:
+                    self.done[i] = True
+                    self.replay_pbar.update(1)
+
+            padding += self.n_steps - t
+            if targets is not None:
+                for _, _, array in targets:
+                    array[t:, i] = 0
+
+        self.finished = self.out_of_replays and all(replay is None or done
+                                                    for replay, done in zip(self.replay_list, self.done))
+        if targets is None:
+            self.finished = True
+            return None
+        self.padding += padding
+        self.n_batches += 1
+
+        return self.__return__(targets, out, **kwargs), reset
 
     def __post_process__(self, result, **kwargs):
         raise NotImplementedError
@@ -109,6 +418,13 @@ class BatchEnv(object):
     def step_count(self):
         return self.steps
 
+    def padding_stats(self):
+        """
+        Zero padded frames, waste is their share of all frames returned
+        """
+        return {'frames': self.steps, 'padding': self.padding,
+                'waste': self.padding / max(1, self.steps + self.padding)}
+
     def close(self):
         if self.epoch_pbar is not None:
             self.epoch_pbar.close()
@@ -120,11 +436,38 @@ class BatchGlobalFeatureEnv(BatchEnv):
                       'Protoss': {'Terran': 638,  'Protoss': 548,  'Zerg': 1016},
                       'Zerg':    {'Terran': 1106, 'Protoss': 1016, 'Zerg': 1484}}
     n_actions_dic = {'Terran': 75, 'Protoss': 61, 'Zerg': 74}
-
-    def __post_init__(self):
-        self.n_features = self.n_features_dic[self.race][self.enemy_race]
+    # Column groups of F, packed separately by extract_features/pack_split.py --columnar
+    label_groups = ['reward', 'action', 'score']
+    observation_groups = ['player', 'alerts', 'upgrades', 'research', 'friendly_units', 'enemy_units']
+    # End of alerts, upgrades, research and friendly_units [#1-#4 in README.md], and # of enemy_units columns
+    column_ends_dic = {'Terran': [29, 60, 81, 417], 'Protoss': [29, 55, 71, 317], 'Zerg': [29, 55, 71, 785]}
+    n_enemy_units_dic = {'Terran': 336, 'Protoss': 246, 'Zerg': 714}
+    # Columns of the manifest rows
+    manifest_path = 'global_path'
+    manifest_length = 'global_length'
+
+    def __post_init__(self, packed_path=None, observation=None):
+        """
+        observation: observation groups returned as features, all of them by default
+        """
         self.n_actions = self.n_actions_dic[self.race]
 
+        groups = global_column_groups(self.race, self.enemy_race)
+        self.column_groups = {name: slice(start, end) for name, start, end in groups}
+
+        self.observation = list(self.observation_groups if observation is None else observation)
+        self.n_features = sum(self.column_groups[g].stop - self.column_groups[g].start for g in self.observation)
+        assert self.n_features_dic[self.race][self.enemy_race] == groups[-1][2] - 15
+        self.__select__()
+
+        ## Packed split, see extract_features/pack_split.py
+        self.packed = None
+        if packed_path is not None:
+            self.packed = load_packed_split(packed_path, self.root)
+
+    def __select__(self, reward=True, action=False, score=False):
+        self.selected = [g for g, keep in zip(self.label_groups, [reward, action, score]) if keep]
+
     def __generate_replay_list__(self, replays, root, race):
         result = []
         for path_dict in replays:
@@ -133,53 +476,89 @@ class BatchGlobalFeatureEnv(BatchEnv):
 
         return result
 
-    def __load_replay__(self, path):
-        replay_dict = {}
-        replay_dict['ptr'] = 0
-        replay_dict['done'] = False
-        replay_dict['states'] = np.asarray(sparse.load_npz(path).todense())
-
+    def __cache_key__(self, path):
+        return (type(self).__name__, str(path), tuple(self.observation))
+
+    def __from_cache__(self, replay_dict):
+        keys = self.selected + ['observation']
+        if not all(k in replay_dict for k in keys):
+            return None
+        return {k: replay_dict[k] for k in keys}
+
+    def __replay_length__(self, path):
+        if self.lengths is not None:
+            return self.lengths[path]
+        if self.packed is not None:
+            states = self.packed[path]
+            return (next(iter(states.values())) if isinstance(states, dict) else states).shape[0]
+        with np.load(path) as f:
+            return int(f['shape'][0])
+
+    def __project__(self, states):
+        """
+        Split (T, M) rows or {group: (T, #columns)} columns into the selected labels and observation
+        """
+        if isinstance(states, dict):
+            replay_dict = {g: states[g] for g in self.selected}
+            observation = [states[g] for g in self.observation]
+        else:
+            replay_dict = {g: states[:, self.column_groups[g]] for g in self.selected}
+            if self.observation == self.observation_groups:
+                observation = [states[:, 15:]]
+            else:
+                observation = [states[:, self.column_groups[g]] for g in self.observation]
+
+        replay_dict['observation'] = observation[0] if len(observation) == 1 else np.hstack(observation)
         return replay_dict
 
-    def __one_step__(self, replay_dict, done):
-        states = replay_dict['states']
-        feature_shape = states.shape[1:]
-        if done:
-            return np.zeros(feature_shape)
-
-        self.steps += 1
-        state = states[replay_dict['ptr']]
-        replay_dict['ptr'] += 1
-        if replay_dict['ptr'] == states.shape[0]:
-            self.replay_pbar.update(1)
-            replay_dict['done'] = True
-
-        return state
-
-    def __post_process__(self, result, reward=True, action=False, score=False):
-        result = np.asarray(result)
+    def __load_replay__(self, path):
+        if self.packed is not None:
+            return self.__project__(self.packed[path])
+        return self.__project__(np.asarray(sparse.load_npz(path).todense()))
+
+    def __load_window__(self, path, start, end):
+        if self.packed is not None:
+            states = self.packed[path]
+            if isinstance(states, dict):
+                return self.__project__({g: v[start:end] for g, v in states.items()})
+            return self.__project__(states[start:end])
+        # Only densify the rows of the window
+        return self.__project__(np.asarray(sparse.load_npz(path).tocsr()[start:end].todense()))
+
+    def __outputs__(self, reward=True, action=False, score=False):
+        return [('observation', None)] + [(g, None) for g, keep in zip(self.label_groups, [reward, action, score])
+                                            if keep]
 
+    def __post_process__(self, result, **kwargs):
         # First dimension of result is the step, second is the replay, third is state
-
-        result_return = [result[:, :, 15:]]
-        if reward:
-            result_return.append(result[:, :, 0:1])
-        if action:
-            result_return.append(result[:, :, 1:2])
-        if score:
-            result_return.append(result[:, :, 2:15])
-
-        return result_return
+        return [result[k] for k, _ in self.__outputs__(**kwargs)]
 
 class BatchSpatialEnv(BatchEnv):
     n_channels = 5
     n_features = 11
     n_actions_dic = {'Terran': 75, 'Protoss': 61, 'Zerg': 74}
-    Feature = namedtuple('Feature', ['S', 'G'])
-
-    def __post_init__(self):
+    manifest_path = 'spatial_path_G'
+    manifest_length = 'spatial_length'
+    # Channel groups of S, stored as [PATH]@S_[GROUP].npz by extract_features/spatial_feature_tensor.py
+    channel_groups = {'screen': slice(0, 8), 'minimap': slice(8, 12), 'unit_type': slice(12, 13)}
+    n_channels_dic = {'screen': 8, 'minimap': 4, 'unit_type': 1}
+    # Scale of each layer, quantized S is stored as the raw integer layers S*scale
+    channel_scales = {'screen': [256, 4, 2, 2, 5, 1962, 16, 256],
+                      'minimap': [256, 4, 2, 5],
+                      'unit_type': [1962]}
+
+    def __post_init__(self, channels=('minimap', 'unit_type'), dequantize=True):
+        """
+        dequantize: scale quantized S into [0, 1], otherwise return its raw integer layers
+        """
         self.n_actions = self.n_actions_dic[self.race]
 
+        self.channels = channels
+        self.n_channels = sum(self.n_channels_dic[c] for c in channels)
+
+        self.dequantize = dequantize
+        self.scale = np.asarray(sum([self.channel_scales[c] for c in channels], []), dtype=np.float32)
+
     def __generate_replay_list__(self, replays, root, race):
         result = []
         for path_dict in replays:
@@ -190,50 +569,78 @@ class BatchSpatialEnv(BatchEnv):
 
     def __load_replay__(self, path):
         replay_dict = {}
-        replay_dict['ptr'] = 0
-        replay_dict['done'] = False
-        replay_dict['states_S'] = np.asarray(sparse.load_npz(path[0]).todense()).reshape([-1, 13, 64, 64])
+        replay_dict['states_S'] = self.__load_channels__(path[0])
         replay_dict['states_G'] = np.asarray(sparse.load_npz(path[1]).todense())
 
         return replay_dict
 
-    def __one_step__(self, replay_dict, done):
-        states_S = replay_dict['states_S']
-        states_G = replay_dict['states_G']
-        feature_shape_S = states_S.shape[1:]
-        feature_shape_G = states_G.shape[1:]
-        if done:
-            return self.Feature(np.zeros(feature_shape_S), np.zeros(feature_shape_G))
+    def __cache_key__(self, path):
+        return (type(self).__name__, str(path), tuple(self.channels))
 
-        self.steps += 1
-        state_S = states_S[replay_dict['ptr']]
-        state_G = states_G[replay_dict['ptr']]
-        replay_dict['ptr'] += 1
-        if replay_dict['ptr'] == states_S.shape[0]:
-            self.replay_pbar.update(1)
-            replay_dict['done'] = True
+    def __manifest_key__(self, path):
+        return path[1]
 
-        return self.Feature(state_S, state_G)
+    def __replay_length__(self, path):
+        if self.lengths is not None:
+            return self.lengths[path[1]]
+        with np.load(path[1]) as f:
+            return int(f['shape'][0])
 
-    def __post_process__(self, result, reward=True, action=False, score=False):
+    def __load_channels__(self, path):
         """
-        Extract reward and actions
+        Read and decode only the selected channel groups of S
         """
+        group_paths = [path.replace('@S.npz', '@S_{}.npz'.format(c)) for c in self.channels]
+        if not all(os.path.isfile(p) for p in group_paths):
+            # Stored as a single (T, 13*64*64) matrix
+            S = np.asarray(sparse.load_npz(path).todense()).reshape([-1, 13, 64, 64])
+            return np.concatenate([S[:, self.channel_groups[c]] for c in self.channels], axis=1)
 
-        result = self.Feature(*zip(*[self.Feature(*zip(*result_per_step)) for result_per_step in result]))
-
-        S = np.asarray(result.S)
-        G = np.asarray(result.G)
-
-        result_return = [S[:, :, 8:13, :, :], G[:,:, :11]]
+        result = []
+        for p, c in zip(group_paths, self.channels):
+            with np.load(p) as f:
+                if 'S' in f.files: # Quantized, (T, C, 64, 64) integer layers
+                    # Dequantized by channel_scales, which have to be the scales the layers were stored with
+                    if not np.array_equal(f['scale'], self.channel_scales[c]):
+                        raise ValueError('{} is quantized with scales {}, expected {}'.format(
+                            p, f['scale'].tolist(), self.channel_scales[c]))
+                    result.append(f['S'])
+                    continue
+            result.append(np.asarray(sparse.load_npz(p).todense()).reshape([-1, self.n_channels_dic[c], 64, 64]))
+
+        return np.concatenate(result, axis=1)
+
+    def __outputs__(self, reward=True, action=False, score=False):
+        """
+        S, then the features, reward, actions and score columns of G
+        """
+        outputs = [('states_S', None), ('states_G', slice(0, 11))]
         if reward:
-            result_return.append(G[:, :, 24:25])
+            outputs.append(('states_G', slice(24, 25)))
         if action:
-            result_return.append(G[:, :, 25:26])
+            outputs.append(('states_G', slice(25, 26)))
         if score:
-            result_return.append(G[:, :, 11:24])
+            outputs.append(('states_G', slice(11, 24)))
+        return outputs
+
+    def __write__(self, targets, i, t, replay_dict, ptr, n):
+        super(BatchSpatialEnv, self).__write__(targets, i, t, replay_dict, ptr, n)
+        # Dequantize the raw integer layers in place once written into float buffers of out
+        S = targets[0][2]
+        if self.dequantize and replay_dict['states_S'].dtype.kind in 'ui' and S.dtype.kind == 'f':
+            S[t:t+n, i] /= self.scale[:, None, None]
+
+    def __post_process__(self, result, **kwargs):
+        """
+        Extract reward and actions
+        """
+        S = result['states_S']
+        if self.dequantize and S.dtype.kind in 'ui':
+            # Same values as SpatialFeatures.transform_obs
+            S = S.astype(np.float32)
+            S /= self.scale[:, None, None]
 
-        return result_return
+        return [S] + [result[k][..., columns] for k, columns in self.__outputs__(**kwargs)[1:]]
 
 if __name__ == '__main__':
     env = BatchSpatialEnv()
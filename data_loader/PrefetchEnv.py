@@ -0,0 +1,241 @@
+import heapq
+import traceback
+import queue as Queue
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from data_loader.BatchEnv import copy_to
+
+def producer(env_cls, args, kwargs, replays, start, end, step_kwargs, in_queue, out_queue):
+    """
+    Run one BatchEnv over replays and write its columns [start, end)
+    of each batch into the shared memory slot received from in_queue
+    """
+    try:
+        env = env_cls()
+        env.init(*args, n_replays=end-start, **kwargs)
+        env.replays = replays
+
+        buffers = None
+        while True:
+            env_return = env.step(**step_kwargs)
+            if env_return is None:
+                out_queue.put(None)
+                break
+            result, require_init = env_return
+
+            if buffers is None:
+                # Shapes are only known after the first batch, wait for the consumer to allocate slots
+                out_queue.put([(r.shape[2:], r.dtype.str) for r in result])
+                names, shapes = in_queue.get()
+                shms = [[shared_memory.SharedMemory(name=name) for name in slot] for slot in names]
+                buffers = [[np.ndarray(shape, dtype=r.dtype, buffer=shm.buf)
+                                for r, shm, shape in zip(result, slot, shapes)] for slot in shms]
+
+            slot = in_queue.get()
+            for buf, r in zip(buffers[slot], result):
+                buf[:, start:end] = r
+            out_queue.put((slot, require_init, env.epoch, env.step_count(), env.padding))
+    except Exception:
+        out_queue.put(traceback.format_exc())
+
+def balance(lengths, n_shards):
+    """
+    Split the indices of lengths into n_shards with balanced sums, longest first to the lightest shard
+    """
+    shards = [[] for _ in range(n_shards)]
+    frames = [(0, i) for i in range(n_shards)]
+    for idx in np.argsort(-np.asarray(lengths), kind='stable'):
+        n_frames, i = heapq.heappop(frames)
+        shards[i].append(idx)
+        heapq.heappush(frames, (n_frames+lengths[idx], i))
+    return shards
+
+class PrefetchBatchEnv(object):
+    """
+    Assemble the batches of env_cls in n_workers processes, up to n_prefetch batches ahead.
+    Worker i owns a disjoint part of the n_replays slots and a shard of the replays with balanced #frames.
+    A worker out of replays leaves its columns zero padded until the others are done.
+    step() returns the same ((features, ...), require_init) as env_cls.step()
+    """
+    def __init__(self, env_cls, n_workers=4, n_prefetch=4, timeout=10):
+        self.env_cls = env_cls
+        self.n_workers = n_workers
+        self.n_prefetch = n_prefetch
+        self.timeout = timeout  # Seconds between checks that the workers are alive
+
+        self.env = None
+        self.workers = None
+        self.buffers = None
+        self.shms = []
+
+    def init(self, path, root, race, enemy_race, step_mul=8, n_replays=4, n_steps=5, epochs=10, seed=None, **kwargs):
+        assert kwargs.get('world_size', 1) == 1, 'Workers split the replays themselves, shard with BatchEnv directly'
+        self.args = (path, root, race, enemy_race)
+        self.kwargs = dict(kwargs, step_mul=step_mul, n_steps=n_steps, epochs=epochs, seed=seed)
+        self.n_replays = n_replays
+        self.n_steps = n_steps
+
+        self.epoch = -1
+        self.steps = 0
+        self.padding = 0
+        self.n_batches = 0
+        self.finished = False
+
+        ## Expose n_features, n_actions, ... of env_cls
+        self.env = self.env_cls()
+        self.env.init(*self.args, n_replays=n_replays, **self.kwargs)
+        self.env.close()
+
+    def __getattr__(self, name):
+        if name == 'env' or self.__dict__.get('env') is None:
+            raise AttributeError(name)
+        return getattr(self.env, name)
+
+    def __start__(self, step_kwargs):
+        self.step_kwargs = step_kwargs
+
+        n_workers = min(self.n_workers, self.n_replays)
+        self.bounds = np.cumsum([0]+[len(s) for s in np.array_split(np.arange(self.n_replays), n_workers)]).tolist()
+        replays = self.env.replays
+        shards = balance([self.env.__replay_length__(path) for path in replays], n_workers)
+        self.exhausted = [False for _ in range(n_workers)]
+        self.worker_steps = [0 for _ in range(n_workers)]
+        self.worker_padding = [0 for _ in range(n_workers)]
+
+        ctx = multiprocessing.get_context()
+        # Workers share the resource tracker of the consumer, which owns and unlinks the segments
+        resource_tracker.ensure_running()
+        self.in_queues = [ctx.Queue() for _ in range(n_workers)]
+        self.out_queues = [ctx.Queue() for _ in range(n_workers)]
+        self.workers = []
+        for i in range(n_workers):
+            p = ctx.Process(target=producer, args=(self.env_cls, self.args, self.kwargs,
+                                                   [replays[idx] for idx in shards[i]],
+                                                   self.bounds[i], self.bounds[i+1], step_kwargs,
+                                                   self.in_queues[i], self.out_queues[i]))
+            p.daemon = True
+            p.start()
+            self.workers.append(p)
+
+        specs = [self.__receive__(i) for i in range(n_workers)]
+        self.exhausted = [spec is None for spec in specs]
+        if all(self.exhausted):
+            self.finished = True
+            return
+        spec = next(spec for spec in specs if spec is not None)
+
+        ## Allocate n_prefetch slots of (n_steps, n_replays, ...) arrays in shared memory
+        self.buffers = []
+        for _ in range(self.n_prefetch):
+            slot = []
+            for feature_shape, dtype in spec:
+                shape = (self.n_steps, self.n_replays) + tuple(feature_shape)
+                shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape))*np.dtype(dtype).itemsize))
+                self.shms.append(shm)
+                slot.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+            self.buffers.append(slot)
+
+        n_buffers = len(spec)
+        names = [[shm.name for shm in self.shms[i*n_buffers:(i+1)*n_buffers]] for i in range(self.n_prefetch)]
+        for q in self.in_queues:
+            q.put((names, [buf.shape for buf in self.buffers[0]]))
+            for slot in range(self.n_prefetch):
+                q.put(slot)
+
+    def __receive__(self, i):
+        while True:
+            try:
+                msg = self.out_queues[i].get(timeout=self.timeout)
+                break
+            except Queue.Empty:
+                p = self.workers[i]
+                if p.is_alive():
+                    continue
+                # Its last message may have reached the queue after the timeout
+                p.join()
+                try:
+                    msg = self.out_queues[i].get_nowait()
+                    break
+                except Queue.Empty:
+                    self.close()
+                    raise RuntimeError('Producer {} exited with code {}'.format(i, p.exitcode))
+        if isinstance(msg, str):
+            self.close()
+            raise RuntimeError('Producer failed:\n' + msg)
+        return msg
+
+    def step(self, out=None, **kwargs):
+        """
+        Perform one batch of n_replays for training
+        out: buffers to copy the batch into straight from shared memory, see data_loader/BatchEnv.py: copy_to
+        """
+        if self.workers is None:
+            self.__start__(kwargs)
+        assert kwargs == self.step_kwargs, 'step() arguments can not change between batches'
+        if self.finished:
+            return None
+
+        slot = self.n_batches % self.n_prefetch
+        msgs = [None for _ in self.out_queues]
+        for i in range(len(self.out_queues)):
+            if not self.exhausted[i]:
+                msgs[i] = self.__receive__(i)
+                self.exhausted[i] = msgs[i] is None
+        if all(self.exhausted):
+            self.finished = True
+            return None
+
+        require_init, epochs = [], []
+        for i, msg in enumerate(msgs):
+            start, end = self.bounds[i], self.bounds[i+1]
+            if msg is None:
+                # Zero padded until the other workers are done
+                for buf in self.buffers[slot]:
+                    buf[:, start:end] = 0
+                require_init.append(np.zeros((self.n_steps, end-start), dtype=bool) if self.kwargs.get('packing')
+                                        else [False for _ in range(end-start)])
+                self.worker_padding[i] += self.n_steps * (end-start)
+                continue
+            assert msg[0] == slot
+            require_init.append(msg[1])
+            epochs.append(msg[2])
+            self.worker_steps[i], self.worker_padding[i] = msg[3], msg[4]
+        # require_init, or the (n_steps, n_replays) reset mask with packing
+        require_init = np.concatenate(require_init, axis=1) if self.kwargs.get('packing') \
+                            else sum(require_init, [])
+
+        # Copy out, the slot is refilled as soon as it is released
+        result = [np.array(buf) for buf in self.buffers[slot]] if out is None else copy_to(self.buffers[slot], out)
+        for q in self.in_queues:
+            q.put(slot)
+
+        self.n_batches += 1
+        self.epoch = min(epochs)
+        self.steps = sum(self.worker_steps)
+        self.padding = sum(self.worker_padding)
+
+        return result, require_init
+
+    def step_count(self):
+        return self.steps
+
+    def padding_stats(self):
+        return {'frames': self.steps, 'padding': self.padding,
+                'waste': self.padding / max(1, self.steps + self.padding)}
+
+    def close(self):
+        if self.workers is not None:
+            for i, p in enumerate(self.workers):
+                # Workers out of replays exit on their own, terminating them could leave the tqdm lock held
+                if not self.exhausted[i]:
+                    p.terminate()
+                p.join()
+            self.workers = []
+        self.buffers = None
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.shms = []
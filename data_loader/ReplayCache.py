@@ -0,0 +1,64 @@
+from collections import OrderedDict
+
+from data_loader.SharedStore import SharedReplayStore
+
+def make_cache(cache_size=0, shared_store=None):
+    """
+    Cache of the decoded replays for BatchEnv.init(cache=...): the split published as shared_store
+    by data_loader/SharedStore.py, or a ReplayCache of cache_size MB [0 indicate no cache]
+    """
+    if shared_store is not None:
+        return SharedReplayStore(shared_store)
+    return ReplayCache(cache_size*2**20) if cache_size > 0 else None
+
+class ReplayCache(object):
+    """
+    In-process LRU cache of decoded replays, bounded by max_bytes.
+    Pass the same instance to several BatchEnv.init(cache=...) to share it across epochs and envs.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.replays = OrderedDict()
+
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def nbytes(replay_dict):
+        return sum(v.nbytes for v in replay_dict.values())
+
+    def get(self, key):
+        replay_dict = self.replays.get(key)
+        if replay_dict is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.replays.move_to_end(key)
+        return replay_dict
+
+    def put(self, key, replay_dict):
+        size = self.nbytes(replay_dict)
+        if size > self.max_bytes:
+            return
+        if key in self.replays:
+            self.bytes -= self.nbytes(self.replays.pop(key))
+
+        while self.bytes + size > self.max_bytes:
+            _, evicted = self.replays.popitem(last=False)
+            self.bytes -= self.nbytes(evicted)
+            self.evictions += 1
+
+        self.replays[key] = replay_dict
+        self.bytes += size
+
+    def stats(self):
+        return {'replays': len(self.replays), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / max(1, self.hits + self.misses)}
+
+    def __str__(self):
+        return 'ReplayCache: {replays} replays, {bytes}/{max_bytes} bytes, {hits} hits, {misses} misses, ' \
+               '{evictions} evictions, hit rate {hit_rate:.2%}'.format(**self.stats())
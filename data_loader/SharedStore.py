@@ -0,0 +1,162 @@
+import json
+import argparse
+import warnings
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from tqdm import tqdm
+
+from data_loader.BatchEnv import BatchGlobalFeatureEnv, BatchSpatialEnv
+
+def untrack(shm):
+    """
+    Keep the resource tracker from unlinking shm when this process exits: the segments of a store outlive
+    the processes creating or attaching them. The tracker unlinks every segment a process opened, even those
+    it does not own (CPython issue 82300), which is fixed by SharedMemory(track=False) from Python 3.13
+    """
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+def attach(name):
+    return untrack(shared_memory.SharedMemory(name=name))
+
+def publish(env, name):
+    """
+    Decode every replay of an initialized env once into shared memory segments [name]_[i],
+    described by the JSON index in segment [name]. The segments outlive this process until unlink(name).
+    Every label is published, consumers select theirs when attaching, see BatchEnv.__from_cache__
+    """
+    env.__select__(reward=True, action=True, score=True)
+    lengths = [env.__replay_length__(path) for path in env.replays]
+    first = env.__load_replay__(env.replays[0])
+    keys = sorted(first.keys())
+
+    index = {'keys': {}, 'replays': {}}
+    offset = 0
+    for path, length in zip(env.replays, lengths):
+        index['replays'][repr(env.__cache_key__(path))] = [offset, length]
+        offset += length
+    buffers = []
+    for i, k in enumerate(keys):
+        shape = (offset,) + first[k].shape[1:]
+        shm = untrack(shared_memory.SharedMemory(name='{}_{}'.format(name, i), create=True,
+                                                 size=max(1, int(np.prod(shape))*first[k].dtype.itemsize)))
+        buffers.append((shm, np.ndarray(shape, dtype=first[k].dtype, buffer=shm.buf)))
+        index['keys'][k] = {'segment': shm.name, 'shape': shape, 'dtype': first[k].dtype.str}
+
+    for path, length in tqdm(zip(env.replays, lengths), total=len(lengths), desc='#Replay'):
+        replay_dict = env.__load_replay__(path)
+        offset = index['replays'][repr(env.__cache_key__(path))][0]
+        for k, (_, buf) in zip(keys, buffers):
+            assert len(replay_dict[k]) == length
+            buf[offset:offset+length] = replay_dict[k]
+
+    data = json.dumps(index).encode()
+    shm = untrack(shared_memory.SharedMemory(name=name, create=True, size=8+len(data)))
+    shm.buf[:8] = len(data).to_bytes(8, 'little')
+    shm.buf[8:8+len(data)] = data
+
+    for s, _ in buffers + [(shm, None)]:
+        s.close()
+
+def unlink(name):
+    store = SharedReplayStore(name)
+    names = [shm.name for shm in store.shms]
+    store.close()
+    for name in names:
+        shared_memory.SharedMemory(name=name).unlink()
+
+class SharedReplayStore(object):
+    """
+    Replays published by publish(), attached read-only by name.
+    Pass it as BatchEnv.init(cache=...) to share one decoded copy of a split across the train, val and test processes
+    """
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+        index_shm = attach(name)
+        n = int.from_bytes(bytes(index_shm.buf[:8]), 'little')
+        index = json.loads(bytes(index_shm.buf[8:8+n]).decode())
+
+        self.shms = [index_shm]
+        self.data = {}
+        for k, key in index['keys'].items():
+            shm = attach(key['segment'])
+            self.shms.append(shm)
+            self.data[k] = np.ndarray(key['shape'], dtype=key['dtype'], buffer=shm.buf)
+            self.data[k].flags.writeable = False
+        self.replays = index['replays']
+
+    def __getstate__(self):
+        # Attach again by name in other processes, e.g. PrefetchBatchEnv workers
+        return {'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'])
+
+    def get(self, key):
+        replay = self.replays.get(repr(key))
+        if replay is None:
+            if self.misses == 0:
+                warnings.warn('{} is not in SharedReplayStore[{}], decoding it and the other missing replays '
+                              'from disk. Publish the store with the same split, observation and channels'
+                              .format(key, self.name))
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        offset, length = replay
+        return {k: v[offset:offset+length] for k, v in self.data.items()}
+
+    def put(self, key, replay_dict):
+        # Read-only, replays missing from the store are decoded by the env every time
+        pass
+
+    def stats(self):
+        return {'replays': len(self.replays), 'bytes': sum(v.nbytes for v in self.data.values()),
+                'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / max(1, self.hits + self.misses)}
+
+    def __str__(self):
+        return 'SharedReplayStore[{name}]: {replays} replays, {bytes} bytes, {hits} hits, {misses} misses, ' \
+               'hit rate {hit_rate:.2%}'.format(name=self.name, **self.stats())
+
+    def close(self):
+        self.data = {}
+        for shm in self.shms:
+            shm.close()
+        self.shms = []
+
+def main():
+    parser = argparse.ArgumentParser(description='Publish decoded replays of a split in shared memory')
+    parser.add_argument('--name', type=str, required=True, help='Name of the store')
+    parser.add_argument('--unlink', action='store_true', help='Remove the store instead')
+    parser.add_argument('--replays_path', default='train_val_test/Terran_vs_Terran/train.json',
+                        help='Split to publish (default: train_val_test/Terran_vs_Terran/train.json)')
+    parser.add_argument('--race', default='Terran', help='Which race? (default: Terran)')
+    parser.add_argument('--enemy_race', default='Terran', help='Which the enemy race? (default: Terran)')
+    parser.add_argument('--spatial', action='store_true', help='Publish spatial feature tensors')
+    parser.add_argument('--channels', default='minimap,unit_type',
+                        help='Channel groups of spatial feature tensors (default: minimap,unit_type)')
+    args = parser.parse_args()
+
+    if args.unlink:
+        unlink(args.name)
+        return
+
+    if args.spatial:
+        env = BatchSpatialEnv()
+        env.init(args.replays_path, './', args.race, args.enemy_race, channels=tuple(args.channels.split(',')))
+    else:
+        env = BatchGlobalFeatureEnv()
+        env.init(args.replays_path, './', args.race, args.enemy_race)
+    env.close()
+
+    publish(env, args.name)
+    print(SharedReplayStore(args.name))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import numpy as np
+
+from tqdm import tqdm
+
+from data_loader.BatchEnv import copy_to
+from data_loader.ReplayCache import ReplayCache
+
+class WindowBatchEnv(object):
+    """
+    Sample batches of n_replays random (replay, offset) windows of burn_in+n_steps frames from env_cls,
+    instead of streaming every replay from front to back.
+    Windows are independent, so require_init is always True and the first burn_in steps only warm up the model.
+    step() returns the same ((features, ...), require_init) as env_cls.step()
+    """
+    def __init__(self, env_cls):
+        self.env_cls = env_cls
+        self.env = None
+
+    def init(self, path, root, race, enemy_race, step_mul=8, n_replays=4, n_steps=5, epochs=10, seed=None,
+                burn_in=0, weighting='length', cache_size=1024, **kwargs):
+        """
+        weighting: 'uniform' picks every replay with the same probability,
+                   'length' with probability proportional to its # of windows, i.e. every window alike
+        cache_size: MB of decoded replays to slice the windows from, unless env_cls reads windows from
+                    a packed split or is given a cache [0 indicate decoding the whole replay for every window]
+        """
+        assert weighting in ('uniform', 'length')
+        assert kwargs.get('world_size', 1) == 1 and not kwargs.get('packing', False)
+
+        ## Reuse the replay list, loading and post processing of env_cls
+        self.env = self.env_cls()
+        self.env.init(path, root, race, enemy_race, step_mul=step_mul, n_replays=n_replays, n_steps=n_steps,
+                      epochs=epochs, seed=seed, **kwargs)
+        self.env.close()
+        if self.env.cache is None and getattr(self.env, 'packed', None) is None and cache_size > 0:
+            self.env.cache = ReplayCache(cache_size*2**20)
+
+        self.n_replays = n_replays
+        self.n_steps = n_steps
+        self.burn_in = burn_in
+        self.window = burn_in + n_steps
+
+        self.rng = np.random.RandomState(seed)
+        self.lengths = np.asarray([self.env.__replay_length__(p) for p in self.env.replays], dtype=np.int64)
+        n_windows = np.maximum(1, self.lengths - self.window + 1)
+        self.probs = n_windows / n_windows.sum() if weighting == 'length' else None
+
+        # One epoch returns as many frames as there are in the split
+        self.epochs = epochs
+        self.batches_per_epoch = max(1, -(-int(self.lengths.sum()) // (n_steps*n_replays)))
+
+        self.epoch = 0
+        self.steps = 0
+        self.padding = 0
+        self.n_batches = 0
+
+        ## Display Progress Bar
+        self.epoch_pbar = tqdm(total=self.epochs, desc='Epoch')
+        self.batch_pbar = tqdm(total=self.batches_per_epoch, desc='  Batches')
+
+    def __getattr__(self, name):
+        if name == 'env' or self.__dict__.get('env') is None:
+            raise AttributeError(name)
+        return getattr(self.env, name)
+
+    def __load_window__(self, path, start, end):
+        """
+        Return {name: (end-start, ...) array}, read from the cache if env_cls has one
+        """
+        if self.env.cache is None:
+            return self.env.__load_window__(path, start, end)
+        return {k: v[start:end] for k, v in self.env.__cached_load__(path).items()}
+
+    def step(self, out=None, **kwargs):
+        """
+        Perform one batch of n_replays windows for training
+        out: buffers to write the batch into, see data_loader/BatchEnv.py: copy_to
+        """
+        if self.n_batches == self.epochs*self.batches_per_epoch:
+            return None
+
+        self.env.__select__(**kwargs)
+        idx = self.rng.choice(len(self.lengths), size=self.n_replays, p=self.probs)
+        offsets = self.rng.randint(0, np.maximum(1, self.lengths[idx] - self.window + 1))
+
+        result = None
+        for i, (j, offset) in enumerate(zip(idx, offsets.tolist())):
+            end = int(min(offset + self.window, self.lengths[j]))
+            window = self.__load_window__(self.env.replays[j], offset, end)
+            if result is None:
+                result = {k: np.zeros((self.window, self.n_replays)+v.shape[1:], dtype=v.dtype)
+                            for k, v in window.items()}
+            for k, v in window.items():
+                result[k][:end-offset, i] = v
+
+            # Replays shorter than a window are zero padded
+            self.steps += max(0, end - offset - self.burn_in)
+            self.padding += self.window - (end - offset)
+
+        self.n_batches += 1
+        self.batch_pbar.update(1)
+        if self.n_batches % self.batches_per_epoch == 0:
+            self.epoch += 1
+            self.epoch_pbar.update(1)
+            if self.epoch < self.epochs:
+                self.batch_pbar.close()
+                self.batch_pbar = tqdm(total=self.batches_per_epoch, desc='  Batches')
+
+        return copy_to(self.env.__post_process__(result, **kwargs), out), [True for _ in range(self.n_replays)]
+
+    def step_count(self):
+        return self.steps
+
+    def padding_stats(self):
+        return {'frames': self.steps, 'padding': self.padding,
+                'waste': self.padding / max(1, self.steps + self.padding)}
+
+    def close(self):
+        self.epoch_pbar.close()
+        self.batch_pbar.close()
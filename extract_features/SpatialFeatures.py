@@ -24,7 +24,7 @@ class ScreenFeatures(collections.namedtuple("ScreenFeatures", ["height_map", "vi
 
 
 class MinimapFeatures(collections.namedtuple("MinimapFeatures", [
-    "height_map", "visibility_map", "creep", "player_relative"])):
+    "height_map", "visibility_map", "creep", "player_relative", "unit_type"])):
   """The set of minimap feature layers."""
   __slots__ = ()
 
@@ -60,7 +60,8 @@ MINIMAP_FEATURES = MinimapFeatures(
     visibility_map=(4, FeatureType.CATEGORICAL, colors.VISIBILITY_PALETTE),
     creep=(2, FeatureType.CATEGORICAL, colors.CREEP_PALETTE),
     player_relative=(5, FeatureType.CATEGORICAL,
-                     colors.PLAYER_RELATIVE_PALETTE)
+                     colors.PLAYER_RELATIVE_PALETTE),
+    unit_type=(1962, FeatureType.CATEGORICAL, colors.unit_type) # Cheat layer, only available in replays
 )
 
 class SpatialFeatures(Features):
@@ -159,15 +160,23 @@ class SpatialFeatures(Features):
         }
 
     @sw.decorate
-    def transform_obs(self, obs):
-        """Render some SC2 observations into something an agent can handle."""
+    def transform_obs(self, obs, raw=False):
+        """Render some SC2 observations into something an agent can handle.
+
+        Args:
+            raw: keep the integer feature layers instead of dividing them by their scale.
+        """
         out = {}
 
         with sw("feature_layers"):
-            out["screen"] = np.stack(
-                f.unpack(obs)/f.scale for f in SCREEN_FEATURES).astype(np.float32, copy=False)
-            out["minimap"] = np.stack(
-                f.unpack(obs)/f.scale for f in MINIMAP_FEATURES).astype(np.float32, copy=False)
+            if raw:
+                out["screen"] = np.stack(f.unpack(obs) for f in SCREEN_FEATURES)
+                out["minimap"] = np.stack(f.unpack(obs) for f in MINIMAP_FEATURES)
+            else:
+                out["screen"] = np.stack(
+                    f.unpack(obs)/f.scale for f in SCREEN_FEATURES).astype(np.float32, copy=False)
+                out["minimap"] = np.stack(
+                    f.unpack(obs)/f.scale for f in MINIMAP_FEATURES).astype(np.float32, copy=False)
 
         out["player"] = np.array([
             obs.game_loop - 1,
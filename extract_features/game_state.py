@@ -1,6 +1,6 @@
-import os
 import json
 import pprint
+import functools
 import numpy as np
 
 def load_stat(path):
@@ -23,13 +23,40 @@ def load_stat(path):
 
     return stat
 
+def new_units(name):
+    """
+    Units of one type, aggregated as GameState and replay_stat.py use them
+    """
+    return {'name': name, 'built': 0, 'building': 0,
+            'max_building_progress': 0., 'min_building_progress': 1., 'sum_building_progress': 0.}
+
+def add_unit(units, build_progress):
+    if build_progress >= 1:
+        units['built'] += 1
+    else:
+        units['building'] += 1
+        units['max_building_progress'] = max(units['max_building_progress'], build_progress)
+        units['min_building_progress'] = min(units['min_building_progress'], build_progress)
+        units['sum_building_progress'] += build_progress
+
+def aggregate_units(unit):
+    # GlobalFeatures written without --compact list the units one by one, with their tag
+    if 'units' not in unit:
+        return unit
+    units = new_units(unit['name'])
+    for unit_instance in unit['units']:
+        add_unit(units, unit_instance['build_progress'])
+    return units
+
+@functools.lru_cache(maxsize=None)
+def cached_stat(path):
+    # Shared by every GameState of a process, which only reads it
+    return load_stat(path)
+
 class GameState(object):
     ## Starcraft Stat
     eps = 1e-9
 
-    stat_path, stat = None, None
-    enemy_stat_path, enemy_stat = None, None
-
     max_vars = ['frame_id', 'minerals', 'vespene', 'food_cap',
                     'food_used', 'food_army', 'food_workers', 'idle_worker_count',
                         'army_count', 'warp_gate_count', 'larva_count', 'n_power_source']
@@ -40,12 +67,8 @@ class GameState(object):
     int_vars = max_vars
 
     def __init__(self, stat_path, enemy_stat_path):
-        if self.stat_path is None or not os.path.samefile(self.stat_path, stat_path):
-            self.stat_path = stat_path
-            self.stat = load_stat(stat_path)
-        if self.enemy_stat_path is None or not os.path.samefile(self.enemy_stat_path, enemy_stat_path):
-            self.enemy_stat_path = enemy_stat_path
-            self.enemy_stat = load_stat(enemy_stat_path)
+        self.stat_path, self.stat = stat_path, cached_stat(stat_path)
+        self.enemy_stat_path, self.enemy_stat = enemy_stat_path, cached_stat(enemy_stat_path)
 
         for k in self.int_vars:
             setattr(self, k, -1)
@@ -85,17 +108,7 @@ class GameState(object):
         return self.stat['action_id'][self.action]
 
     def __set_units__(self, units):
-        results = {}
-        for unit_type_id, unit in units.items():
-            unit_type_id = int(unit_type_id)
-            if unit_type_id not in results:
-                results[unit_type_id] = {'built': [], 'building': []}
-            for unit_instance in unit['units']:
-                if unit_instance['build_progress'] >= 1:
-                    results[unit_type_id]['built'].append(unit_instance)
-                else:
-                    results[unit_type_id]['building'].append(unit_instance)
-        return results
+        return {int(unit_type_id): aggregate_units(unit) for unit_type_id, unit in units.items()}
 
     def __set_action__(self, action):
         self.action = action
@@ -117,25 +130,17 @@ class GameState(object):
             if k not in units_stat:
                 continue
             start = units_stat[k] * len(name2id)
-            result[start + name2id['total_num']] = len(unit['built'])+len(unit['building'])
+            result[start + name2id['total_num']] = unit['built'] + unit['building']
             if result[start + name2id['total_num']] == 0:
                 continue
 
-            result[start + name2id['finished_num']] = len(unit['built'])
-            result[start + name2id['building_num']] = len(unit['building'])
-
-            if result[start + name2id['building_num']] > 0:
-                ## Init min value
-                result[start+name2id['min_building_progress']] = 1.0
-
-                for u in unit['building']:
-                    result[start + name2id['max_building_progress']] = \
-                        max(result[start + name2id['max_building_progress']], u['build_progress'])
-                    result[start + name2id['min_building_progress']] = \
-                        min(result[start + name2id['min_building_progress']], u['build_progress'])
-                    result[start + name2id['avg_building_progress']] += u['build_progress']
+            result[start + name2id['finished_num']] = unit['built']
+            result[start + name2id['building_num']] = unit['building']
 
-                result[start+name2id['avg_building_progress']] /= result[start+name2id['building_num']]
+            if unit['building'] > 0:
+                result[start + name2id['max_building_progress']] = unit['max_building_progress']
+                result[start + name2id['min_building_progress']] = unit['min_building_progress']
+                result[start + name2id['avg_building_progress']] = unit['sum_building_progress'] / unit['building']
 
             for name in {'total_num', 'finished_num', 'building_num'}:
                 result[start+name2id[name]] /= stat['max_unit_num']
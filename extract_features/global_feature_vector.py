@@ -3,6 +3,7 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import sys
 import json
 from absl import app
 from absl import flags
@@ -10,24 +11,35 @@ from absl import flags
 import numpy as np
 from scipy import sparse
 
-from tqdm import tqdm
+from game_state import GameState, cached_stat
+from global_states import player_states
 
-from google.protobuf.json_format import Parse
-
-from s2clientprotocol import sc2api_pb2 as sc_pb
-from s2clientprotocol import common_pb2 as common_pb
-
-from game_state import GameState
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import replay_infos
+from parallel import Executor
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string(name='hq_replay_set', default='../high_quality_replays/Terran_vs_Terran.json',
                     help='File storing replays list')
 flags.DEFINE_string(name='parsed_replay_path', default='../parsed_replays',
                     help='Path storing parsed replays')
-
-def parse_replay(replay_player_path, reward, race, enemy_race):
-    with open(os.path.join(FLAGS.parsed_replay_path, 'GlobalFeatures', replay_player_path)) as f:
-        states = json.load(f)
+flags.DEFINE_integer(name='n_workers', default=0,
+                     help='# of processes [0 indicate all cores]')
+flags.DEFINE_integer(name='chunk_size', default=0,
+                     help='# of replays per task [0 indicate automatic]')
+flags.DEFINE_boolean(name='from_observations', default=False,
+                     help='Compute the vectors from the SampledObservations, without the GlobalFeatures')
+flags.DEFINE_integer(name='step_mul', default=8,
+                     help='step size, with from_observations')
+
+def parse_replay(replay_player_path, sampled_frame_path, reward, race, enemy_race):
+    if FLAGS.from_observations:
+        # Streamed with the units aggregated per type, without GlobalFeatures
+        states = player_states(FLAGS.parsed_replay_path, replay_player_path, sampled_frame_path,
+                               reward, FLAGS.step_mul, compact=True)
+    else:
+        with open(os.path.join(FLAGS.parsed_replay_path, 'GlobalFeatures', replay_player_path)) as f:
+            states = json.load(f)
 
     states_np = []
     game_state = GameState(os.path.join(FLAGS.parsed_replay_path, 'Stat', '{}.json'.format(race)),
@@ -41,6 +53,10 @@ def parse_replay(replay_player_path, reward, race, enemy_race):
     sparse.save_npz(os.path.join(FLAGS.parsed_replay_path, 'GlobalFeatureVector',
                                  replay_player_path), sparse.csc_matrix(states_np))
 
+def load_stats(stat_paths):
+    for path in stat_paths:
+        cached_stat(path)
+
 def main(argv):
     with open(FLAGS.hq_replay_set) as f:
         replay_list = sorted(json.load(f))
@@ -53,22 +69,24 @@ def main(argv):
         if not os.path.isdir(path):
             os.makedirs(path)
 
-    pbar = tqdm(total=len(replay_list), desc='#Replay')
-    for replay_path, replay_info_path in replay_list:
-        with open(replay_info_path) as f:
-            info = json.load(f)
-        info = Parse(info['info'], sc_pb.ResponseReplayInfo())
+    tasks = []
+    for replay_path, infos_path in replay_list:
+        infos = replay_infos.load(infos_path)
 
         replay_name = os.path.basename(replay_path)
-        for player_info in info.player_info:
-            race = common_pb.Race.Name(player_info.player_info.race_actual)
-            player_id = player_info.player_info.player_id
-            reward = player_info.player_result.result
+        sampled_frame_path = os.path.join(FLAGS.parsed_replay_path, 'SampledFrames', race_vs_race, replay_name)
+        for player_id, race, reward in infos.players(replay_path):
 
             replay_player_path = os.path.join(race_vs_race, race, '{}@{}'.format(player_id, replay_name))
-            parse_replay(replay_player_path, reward, race, race if len(races) == 1 else list(races - {race})[0])
-
-        pbar.update()
+            tasks.append((replay_player_path, sampled_frame_path, reward, race,
+                          race if len(races) == 1 else list(races - {race})[0]))
+
+    # Every worker loads the Stat of both races once
+    executor = Executor(FLAGS.n_workers, FLAGS.chunk_size, initializer=load_stats,
+                        initargs=([os.path.join(FLAGS.parsed_replay_path, 'Stat', '{}.json'.format(race))
+                                        for race in races],))
+    executor.run(parse_replay, tasks, star=True)
+    return executor.report()
 
 if __name__ == '__main__':
     app.run(main)
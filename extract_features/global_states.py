@@ -0,0 +1,137 @@
+import os
+import json
+import stream
+import functools
+
+import numpy as np
+
+from google.protobuf.json_format import Parse
+
+from pysc2.lib.actions import FUNCTIONS
+from pysc2.lib import static_data
+from s2clientprotocol import sc2api_pb2 as sc_pb
+
+from game_state import new_units, add_unit
+
+@functools.lru_cache(maxsize=4)
+def load_units_info(data_raw):
+    # The same for every replay of a game version, parsed once per worker
+    return static_data.StaticData(Parse(data_raw, sc_pb.ResponseData())).units
+
+def process_replay(sampled_frames, sampled_actions, observations, units_info, reward, compact=False):
+    """
+    Yield the state of every sampled frame. Units are listed one by one with their tag,
+    or aggregated per unit type when compact
+    """
+    for frame_id, action, obs in zip(sampled_frames, sampled_actions, observations):
+        state = {}
+        # actions
+        state['action'] = None
+        if action >= 0: # Get name of the macro action executed during this frame
+            state['action'] = (int(action), FUNCTIONS[action].name)
+
+        observation = obs.observation
+        #####################################################
+        # frame_id
+        assert frame_id == observation.game_loop-1
+        state['frame_id'] = frame_id
+        # reward
+        state['reward'] = reward
+
+        state['score_cumulative'] = [
+            observation.score.score,
+            observation.score.score_details.idle_production_time,
+            observation.score.score_details.idle_worker_time,
+            observation.score.score_details.total_value_units,
+            observation.score.score_details.total_value_structures,
+            observation.score.score_details.killed_value_units,
+            observation.score.score_details.killed_value_structures,
+            observation.score.score_details.collected_minerals,
+            observation.score.score_details.collected_vespene,
+            observation.score.score_details.collection_rate_minerals,
+            observation.score.score_details.collection_rate_vespene,
+            observation.score.score_details.spent_minerals,
+            observation.score.score_details.spent_vespene,
+        ]
+        # resources
+        resources = observation.player_common
+        state['minerals'] = resources.minerals
+        state['vespene'] = resources.vespene
+        state['food_cap'] = resources.food_cap
+        state['food_used'] = resources.food_used
+        state['food_army'] = resources.food_army
+        state['food_workers'] = resources.food_workers
+        state['idle_worker_count'] = resources.idle_worker_count
+        state['army_count'] = resources.army_count
+        state['warp_gate_count'] = resources.warp_gate_count
+        state['larva_count'] = resources.larva_count
+        #####################################################
+        # alert
+        state['alert'] = list(observation.alerts)
+
+        #####################################################
+        ### raw data
+        raw_data = observation.raw_data
+        ## player
+        player = raw_data.player
+        # upgrades
+        state['upgrades'] = list(player.upgrade_ids)
+        # power
+        state['n_power_source'] = len(player.power_sources)
+        #####################################################
+        ## units
+        state['friendly_units'] = {}
+        state['enemy_units'] = {}
+        for unit in raw_data.units:
+            if unit.display_type == 3: # Make sure unit is not hidden
+                continue
+            if unit.alliance != 1 and unit.alliance != 4: # Make sure unit is either ally or enemy
+                continue
+            # Friendly or Enemy
+            units = state['friendly_units'] if unit.alliance == 1 else state['enemy_units']
+            # Already have this unit_type ?
+            unit_type = unit.unit_type
+            if compact:
+                if unit_type not in units:
+                    units[unit_type] = new_units(units_info[unit_type])
+                add_unit(units[unit_type], unit.build_progress)
+                continue
+
+            if unit_type not in units:
+                units[unit_type] = {'units': [], 'name': units_info[unit_type]}
+            # Basic info
+            unit_info = {'tag': unit.tag,
+                         'build_progress': unit.build_progress}
+
+            units[unit_type]['units'].append(unit_info)
+
+        yield state
+
+def player_states(parsed_replay_path, replay_player_path, sampled_frame_path, reward, step_mul, compact=False):
+    """
+    Stream the states of a player from its SampledObservations
+    """
+    # Global Info
+    with open(os.path.join(parsed_replay_path, 'GlobalInfos', replay_player_path)) as f:
+        global_info = json.load(f)
+    units_info = load_units_info(global_info['data_raw'])
+
+    # Sampled Frames
+    with open(sampled_frame_path) as f:
+        sampled_frames = json.load(f)
+    sampled_actions_idx = [frame // step_mul - 1 for frame in sampled_frames] # Create index to retrieve actions corresponding to sampled frames
+
+    # Actions
+    macro_actions = np.load(os.path.join(parsed_replay_path, 'Actions', replay_player_path+'@macro.npy'))
+    sampled_actions = macro_actions[sampled_actions_idx].tolist() # Get first macro action executed after each sampled frame
+
+    # Observations
+    observations = iter(stream.parse(os.path.join(parsed_replay_path, 'SampledObservations', replay_player_path),
+                                     sc_pb.ResponseObservation))
+
+    n_states = 0
+    for state in process_replay(sampled_frames, sampled_actions, observations, units_info, reward, compact):
+        n_states += 1
+        yield state
+
+    assert len(sampled_frames) == len(sampled_actions) == n_states and next(observations, None) is None
@@ -0,0 +1,94 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+from absl import app
+from absl import flags
+
+import numpy as np
+from scipy import sparse
+
+from tqdm import tqdm
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from data_loader.BatchEnv import global_column_groups
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(name='split_path', default='../train_val_test/Terran_vs_Terran/train.json',
+                    help='File storing the train|val|test split')
+flags.DEFINE_string(name='root', default='..',
+                    help='Root for parsed replays')
+flags.DEFINE_string(name='save_path', default='../parsed_replays/PackedGlobalFeatureVector',
+                    help='Path for saving packed splits')
+flags.DEFINE_string(name='dtype', default='float32',
+                    help='Storage dtype, float32|float16 (float16 loses precision on the cumulative score)')
+flags.DEFINE_boolean(name='columnar', default=False,
+                     help='Store every column group in its own file, so only the requested groups are read')
+
+def pack(replays, race, enemy_race, data_path, index_path):
+    """
+    Concatenate the global feature vectors of one race into a single (N, M) file,
+    or with --columnar into one (N, #columns) file [SPLIT]@[GROUP].bin per column group.
+    The index maps every global_path to the [offset, length] of its rows.
+    """
+    dtype = np.dtype(FLAGS.dtype)
+
+    groups = global_column_groups(race, enemy_race)
+    index = {'data': os.path.basename(data_path), 'dtype': dtype.name,
+             'n_rows': 0, 'n_features': groups[-1][2], 'replays': {}}
+    files = {None: data_path}
+    if FLAGS.columnar:
+        files = {name: data_path.replace('.bin', '@{}.bin'.format(name)) for name, _, _ in groups}
+        index['data'] = None
+        index['groups'] = {name: {'data': os.path.basename(files[name]), 'n_features': end-start}
+                                for name, start, end in groups}
+    files = {name: open(path, 'wb') for name, path in files.items()}
+
+    pbar = tqdm(total=len(replays), desc='#Replay[{}]'.format(race))
+    try:
+        for path_dict in replays:
+            for player_path in path_dict[race]:
+                if 'global_path' not in player_path:
+                    continue
+                global_path = player_path['global_path']
+                states = np.asarray(sparse.load_npz(os.path.join(FLAGS.root, global_path)).todense())
+                assert index['n_features'] == states.shape[1]
+
+                if FLAGS.columnar:
+                    for name, start, end in groups:
+                        files[name].write(np.ascontiguousarray(states[:, start:end], dtype=dtype).tobytes())
+                else:
+                    files[None].write(np.ascontiguousarray(states, dtype=dtype).tobytes())
+                index['replays'][global_path] = [index['n_rows'], states.shape[0]]
+                index['n_rows'] += states.shape[0]
+            pbar.update()
+    finally:
+        for f in files.values():
+            f.close()
+    pbar.close()
+    if index['n_rows'] == 0: # Still a valid split, loaded as no replays
+        print('No global feature vectors of {} in the split, packed an empty split'.format(race))
+
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+
+def main(argv):
+    with open(FLAGS.split_path) as f:
+        replays = json.load(f)
+
+    split = os.path.basename(FLAGS.split_path).split('.')[0]
+    race_vs_race = os.path.basename(os.path.dirname(os.path.abspath(FLAGS.split_path)))
+    for race in set(race_vs_race.split('_vs_')):
+        path = os.path.join(FLAGS.save_path, race_vs_race, race)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        races = race_vs_race.split('_vs_')
+        enemy_race = races[1] if races[0] == race else races[0]
+        pack(replays, race, enemy_race, os.path.join(path, split+'.bin'), os.path.join(path, split+'.json'))
+
+if __name__ == '__main__':
+    app.run(main)
@@ -7,11 +7,16 @@ import pprint
 import numpy as np
 
 import os
+import sys
 import json
 from absl import app
 from absl import flags
 
-from tqdm import tqdm
+from game_state import aggregate_units
+from global_states import player_states
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+from parallel import Executor
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string(name='hq_replay_path', default='../high_quality_replays',
@@ -20,6 +25,12 @@ flags.DEFINE_string(name='parsed_replay_path', default='../parsed_replays',
                     help='Path storing parsed replays')
 flags.DEFINE_string(name='race', default='Terran',
                      help='Race name')
+flags.DEFINE_integer(name='n_workers', default=0,
+                     help='# of processes [0 indicate all cores]')
+flags.DEFINE_boolean(name='from_observations', default=False,
+                     help='Read the SampledObservations instead of the GlobalFeatures')
+flags.DEFINE_integer(name='step_mul', default=8,
+                     help='step size, with from_observations')
 # MAX stat
 max_keys = {'frame_id', 'minerals', 'vespene', 'food_cap',
                 'idle_worker_count', 'army_count', 'warp_gate_count',
@@ -27,9 +38,19 @@ max_keys = {'frame_id', 'minerals', 'vespene', 'food_cap',
 # SET stat
 set_keys = {'alert', 'upgrades'}
 
+def load_states(replay_path):
+    if not FLAGS.from_observations:
+        with open(replay_path) as f:
+            return json.load(f)
+
+    race_vs_race, race, replay_player_name = replay_path.split(os.sep)[-3:]
+    sampled_frame_path = os.path.join(FLAGS.parsed_replay_path, 'SampledFrames', race_vs_race,
+                                      replay_player_name.split('@', 1)[1])
+    return player_states(FLAGS.parsed_replay_path, os.path.join(race_vs_race, race, replay_player_name),
+                         sampled_frame_path, 0, FLAGS.step_mul, compact=True)
+
 def update(replay_path, stat):
-    with open(replay_path) as f:
-        states = json.load(f)
+    states = load_states(replay_path)
 
     research_count = {}
     for state in states:
@@ -46,7 +67,8 @@ def update(replay_path, stat):
         for unit_type, unit in units.items():
             stat['units_type'].add(unit_type)
             stat['units_name'][unit_type] = unit['name']
-            stat['max_unit_num'] = max(stat['max_unit_num'], len(unit['units']))
+            unit = aggregate_units(unit)
+            stat['max_unit_num'] = max(stat['max_unit_num'], unit['built'] + unit['building'])
         ## Actions
         if state['action'] is None:
             continue
@@ -63,6 +85,42 @@ def update(replay_path, stat):
     if len(research_count) > 0:
         stat['max_research_num'] = max(stat['max_research_num'], max(research_count.values()))
 
+def new_stat():
+    stat = {}
+    # MAX stat
+    for key in max_keys:
+        stat['max_'+key] = 0
+    # SET stat
+    for key in set_keys:
+        stat[key] = set()
+    # score_cumulative
+    stat['max_score_cumulative'] = 0
+    ## Units stat
+    stat['units_type'] = set()
+    stat['units_name'] = {}
+    stat['max_unit_num'] = 0
+    ## Actions
+    stat['action_id'] = set()
+    stat['action_name'] = {}
+    stat['research_id'] = set()
+    stat['max_research_num'] = 0
+    return stat
+
+def replays_stat(replay_paths):
+    stat = new_stat()
+    for replay_path in replay_paths:
+        update(replay_path, stat)
+    return stat
+
+def merge(stat, other):
+    for key, value in other.items():
+        if isinstance(value, set):
+            stat[key] |= value
+        elif isinstance(value, dict):
+            stat[key].update(value)
+        else:
+            stat[key] = max(stat[key], value)
+
 def post_process(stat):
     for key in set_keys | {'action_id', 'research_id', 'units_type'}:
         values = np.asarray(list(stat[key]))
@@ -84,38 +142,21 @@ def main(argv):
     if not os.path.isdir(save_path):
         os.makedirs(save_path)
 
-    ## Init Stat Dict
-    stat = {}
-    # MAX stat
-    for key in max_keys:
-        stat['max_'+key] = 0
-    # SET stat
-    for key in set_keys:
-        stat[key] = set()
-    # score_cumulative
-    stat['max_score_cumulative'] = 0
-    ## Units stat
-    stat['units_type'] = set()
-    stat['units_name'] = {}
-    stat['max_unit_num'] = 0
-    ## Actions
-    stat['action_id'] = set()
-    stat['action_name'] = {}
-    stat['research_id'] = set()
-    stat['max_research_num'] = 0
-
-    set_bar = tqdm(total=len(replay_lists), desc='#SET')
+    replays = []
     for replay_list_path in replay_lists:
         race_vs_race = os.path.basename(replay_list_path).split('.')[0]
-        replays = glob.glob(os.path.join(FLAGS.parsed_replay_path, 'GlobalFeatures',
-                                         race_vs_race, FLAGS.race, '*.SC2Replay'))
-
-        pbar = tqdm(total=len(replays), desc='\t#Replay')
-        for replay in replays:
-            update(replay, stat)
-            pbar.update()
-
-        set_bar.update()
+        replays += glob.glob(os.path.join(FLAGS.parsed_replay_path,
+                                          'SampledObservations' if FLAGS.from_observations else 'GlobalFeatures',
+                                          race_vs_race, FLAGS.race, '*.SC2Replay'))
+
+    ## Every task reduces a group of replays, merged here
+    executor = Executor(FLAGS.n_workers, 1, desc='#Group')
+    groups = [replays[i::4*executor.n_workers] for i in range(min(len(replays), 4*executor.n_workers))]
+    stat = new_stat()
+    for group_stat in executor.map(replays_stat, groups):
+        merge(stat, group_stat)
+    if executor.report() != 0:
+        return 1
 
     stat = post_process(stat)
 
@@ -3,26 +3,25 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import sys
 import json
 import stream
 from absl import app
 from absl import flags
-from multiprocessing import Pool
 
 import numpy as np
 from scipy import sparse
 
-from tqdm import tqdm
-
 from google.protobuf.json_format import Parse
 
-from pysc2.lib import features
-from pysc2.lib.actions import FUNCTIONS
 from s2clientprotocol import sc2api_pb2 as sc_pb
-from s2clientprotocol import common_pb2 as common_pb
 
 from game_state import load_stat
-from SpatialFeatures import SpatialFeatures
+from SpatialFeatures import SpatialFeatures, SCREEN_FEATURES, MINIMAP_FEATURES
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import replay_infos
+from parallel import Executor
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string(name='hq_replay_set', default='../high_quality_replays/Terran_vs_Terran.json',
@@ -31,10 +30,18 @@ flags.DEFINE_string(name='parsed_replay_path', default='../parsed_replays',
                     help='Path storing parsed replays')
 flags.DEFINE_integer(name='step_mul', default=8,
                      help='step size')
-flags.DEFINE_integer(name='n_workers', default=16,
-                     help='#processes')
-
-def parse_replay(replay_player_path, sampled_action_path, reward, race, enemy_race, stat):
+flags.DEFINE_integer(name='n_workers', default=0,
+                     help='# of processes [0 indicate all cores]')
+flags.DEFINE_integer(name='chunk_size', default=0,
+                     help='# of replays per task [0 indicate automatic]')
+flags.DEFINE_boolean(name='quantize', default=False,
+                     help='Store the raw integer layers of S as uint8 (uint16 for unit_type) instead of scaled floats')
+
+# Channel groups of S, each saved as a separate [PATH]@S_[GROUP].npz
+channel_groups = [('screen', slice(0, 8)), ('minimap', slice(8, 12)), ('unit_type', slice(12, 13))]
+channel_scales = np.asarray([f.scale for f in SCREEN_FEATURES] + [f.scale for f in MINIMAP_FEATURES])
+
+def parse_replay(replay_player_path, sampled_frame_path, reward, race, enemy_race, stat):
     with open(os.path.join(FLAGS.parsed_replay_path, 'GlobalInfos', replay_player_path)) as f:
         global_info = json.load(f)
 
@@ -43,31 +50,19 @@ def parse_replay(replay_player_path, sampled_action_path, reward, race, enemy_ra
     states = [obs for obs in stream.parse(os.path.join(FLAGS.parsed_replay_path,
                     'SampledObservations', replay_player_path), sc_pb.ResponseObservation)]
 
-    # Sampled Actions
-    with open(sampled_action_path) as f:
-        sampled_action = json.load(f)
-    sampled_action_id = [id // FLAGS.step_mul + 1 for id in sampled_action]
+    # Sampled Frames, the same as in extract_features/global_states.py
+    with open(sampled_frame_path) as f:
+        sampled_frames = json.load(f)
+    sampled_actions_idx = [frame // FLAGS.step_mul - 1 for frame in sampled_frames]
     # Actions
-    with open(os.path.join(FLAGS.parsed_replay_path, 'Actions', replay_player_path)) as f:
-        actions = json.load(f)
-    actions = [None if len(actions[idx]) == 0 else Parse(actions[idx][0], sc_pb.Action())
-               for idx in sampled_action_id]
+    macro_actions = np.load(os.path.join(FLAGS.parsed_replay_path, 'Actions', replay_player_path+'@macro.npy'))
+    actions = macro_actions[sampled_actions_idx].tolist()
 
     assert len(states) == len(actions)
 
     spatial_states_np, global_states_np = [], []
-    for state, action in zip(states, actions):
-        action_id = -1
-        if action is not None:
-            try:
-                func_id = feat.reverse_action(action).function
-                func_name = FUNCTIONS[func_id].name
-                if func_name.split('_')[0] in {'Build', 'Train', 'Research', 'Morph', 'Cancel', 'Halt', 'Stop'}:
-                    action_id = func_id
-            except:
-                pass
-
-        obs = feat.transform_obs(state.observation)
+    for state, action_id in zip(states, actions):
+        obs = feat.transform_obs(state.observation, raw=FLAGS.quantize)
         spatial_states_np.append(np.concatenate([obs['screen'], obs['minimap']], axis=0))
 
         global_states_np.append(np.hstack([obs['player']/(stat['max']+1e-5), obs['score'], [reward],
@@ -76,39 +71,48 @@ def parse_replay(replay_player_path, sampled_action_path, reward, race, enemy_ra
     spatial_states_np = np.asarray(spatial_states_np)
     global_states_np = np.asarray(global_states_np)
 
-    spatial_states_np = spatial_states_np.reshape([len(states), -1])
-    sparse.save_npz(os.path.join(FLAGS.parsed_replay_path, 'SpatialFeatureTensor',
-                                 replay_player_path+'@S'), sparse.csc_matrix(spatial_states_np))
+    for group, channels in channel_groups:
+        path = os.path.join(FLAGS.parsed_replay_path, 'SpatialFeatureTensor', replay_player_path+'@S_'+group)
+        if FLAGS.quantize:
+            # Every layer is an integer below its scale, S = S_raw / scale
+            scale = channel_scales[channels]
+            dtype = np.uint8 if np.max(scale) <= 256 else np.uint16
+            np.savez_compressed(path, S=spatial_states_np[:, channels].astype(dtype), scale=scale)
+        else:
+            sparse.save_npz(path, sparse.csc_matrix(spatial_states_np[:, channels].reshape([len(states), -1])))
     sparse.save_npz(os.path.join(FLAGS.parsed_replay_path, 'SpatialFeatureTensor',
                                  replay_player_path+'@G'), sparse.csc_matrix(global_states_np))
 
 class Parser(object):
-    def __init__(self, race_vs_race, races, stats):
+    def __init__(self, race_vs_race, races):
         self.race_vs_race = race_vs_race
         self.races = races
-        self.stats = stats
 
     def __call__(self, line):
-        replay_path, replay_info_path = line
-        with open(replay_info_path) as f:
-            info = json.load(f)
-        info = Parse(info['info'], sc_pb.ResponseReplayInfo())
+        replay_path, infos_path = line
+        infos = replay_infos.load(infos_path)
 
         replay_name = os.path.basename(replay_path)
-        sampled_action_path = os.path.join(FLAGS.parsed_replay_path, 'SampledActions', self.race_vs_race, replay_name)
-        for player_info in info.player_info:
-            race = common_pb.Race.Name(player_info.player_info.race_actual)
-            player_id = player_info.player_info.player_id
-            reward = 2 - player_info.player_result.result
+        sampled_frame_path = os.path.join(FLAGS.parsed_replay_path, 'SampledFrames', self.race_vs_race, replay_name)
+        for player_id, race, result in infos.players(replay_path):
+            reward = 2 - result
 
             replay_player_path = os.path.join(self.race_vs_race, race, '{}@{}'.format(player_id, replay_name))
-            parse_replay(replay_player_path, sampled_action_path, reward, race,
-                                race if len(self.races) == 1 else list(self.races - {race})[0], self.stats[race])
+            parse_replay(replay_player_path, sampled_frame_path, reward, race,
+                                race if len(self.races) == 1 else list(self.races - {race})[0], stats[race])
 
 max_keys = ['frame_id', 'minerals', 'vespene', 'food_cap',
                     'food_cap', 'food_cap', 'food_cap', 'idle_worker_count',
                         'army_count', 'warp_gate_count', 'larva_count']
 
+stats = {} # race -> Stat used by parse_replay(), loaded once per worker
+
+def load_stats(races):
+    for race in races:
+        stat = load_stat(os.path.join(FLAGS.parsed_replay_path, 'Stat', '{}.json'.format(race)))
+        stats[race] = {'max': np.asarray([stat['max_'+k] for k in max_keys]),
+                       'action_id': stat['action_id']}
+
 def main(argv):
     with open(FLAGS.hq_replay_set) as f:
         replay_list = sorted(json.load(f))
@@ -116,20 +120,14 @@ def main(argv):
     race_vs_race = os.path.basename(FLAGS.hq_replay_set).split('.')[0]
     global_feature_vec_path = os.path.join(FLAGS.parsed_replay_path, 'SpatialFeatureTensor', race_vs_race)
     races = set(race_vs_race.split('_vs_'))
-    stats = {}
     for race in races:
         path = os.path.join(global_feature_vec_path, race)
         if not os.path.isdir(path):
             os.makedirs(path)
 
-        stat = load_stat(os.path.join(FLAGS.parsed_replay_path, 'Stat', '{}.json'.format(race)))
-        stats[race] = {'max': np.asarray([stat['max_'+k] for k in max_keys]),
-                       'action_id': stat['action_id']}
-
-    pbar = tqdm(total=len(replay_list), desc='#Replay')
-    with Pool(FLAGS.n_workers) as p:
-        for _ in p.imap(Parser(race_vs_race, races, stats), replay_list):
-            pbar.update()
+    executor = Executor(FLAGS.n_workers, FLAGS.chunk_size, initializer=load_stats, initargs=(sorted(races),))
+    executor.run(Parser(race_vs_race, races), replay_list)
+    return executor.report()
 
 if __name__ == '__main__':
     app.run(main)
@@ -1,12 +1,14 @@
 import os
+import sys
 import json
 import numpy as np
 from absl import app
 from absl import flags
 
-from google.protobuf.json_format import Parse
 from s2clientprotocol import sc2api_pb2 as sc_pb
-from s2clientprotocol import common_pb2 as common_pb
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import replay_infos
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string(name='hq_replay_set', default='../high_quality_replays/Terran_vs_Terran.json',
@@ -22,10 +24,33 @@ flags.DEFINE_string(name='ratio', default='7:1:2',
 flags.DEFINE_integer(name='seed', default=1,
                     help='random seed')
 
+# One row per replay-perspective, see data_loader/BatchEnv.py: load_manifest
+manifest_fields = [('replay', 'U'), ('player_id', 'i1'), ('race', 'U'), ('enemy_race', 'U'), ('map_name', 'U'),
+                   ('reward', 'i1'), ('mmr', 'i4'), ('apm', 'i4'), ('duration', 'i4'),
+                   ('global_length', 'i4'), ('spatial_length', 'i4'),
+                   ('global_path', 'U'), ('spatial_path_S', 'U'), ('spatial_path_G', 'U')]
+
+def n_frames(path):
+    # T of a sparse .npz, without decoding it
+    if not os.path.isfile(path):
+        return -1
+    with np.load(path) as f:
+        return int(f['shape'][0])
+
+def save_manifest(records, path):
+    dtype = []
+    for name, kind in manifest_fields:
+        if kind == 'U':
+            kind = 'U{}'.format(max([1]+[len(r[name]) for r in records]))
+        dtype.append((name, kind))
+    manifest = np.array([tuple(r[name] for name, _ in manifest_fields) for r in records], dtype=dtype)
+    np.save(path, manifest)
+
 def save(replays, prefix, folder):
     print('{}/{}: {}'.format(folder, prefix, len(replays)))
     with open(os.path.join(folder, prefix+'.json'), 'w') as f:
-        json.dump(replays, f)
+        json.dump([replay_path_dict for replay_path_dict, _ in replays], f)
+    save_manifest([r for _, records in replays for r in records], os.path.join(folder, prefix+'.manifest.npy'))
 
 def main(argv):
     np.random.seed(FLAGS.seed)
@@ -40,20 +65,18 @@ def main(argv):
 
     result = []
     race_vs_race = os.path.basename(FLAGS.hq_replay_set).split('.')[0]
-    for replay_path, info_path in replays_list:
+    for replay_path, infos_path in replays_list:
         replay_path_dict = {}
+        records = []
         replay_name = os.path.basename(replay_path)
 
         ## Parsed Replay
         for race in set(race_vs_race.split('_vs_')):
             replay_path_dict[race] = []
 
-        with open(info_path) as f:
-            info = json.load(f)
-        proto = Parse(info['info'], sc_pb.ResponseReplayInfo())
-        for p in proto.player_info:
-            player_id = p.player_info.player_id
-            race = common_pb.Race.Name(p.player_info.race_actual)
+        info = replay_infos.load(infos_path).fields(replay_path)
+        races = {int(info['player_id'][k]): str(info['race'][k]) for k in range(2)}
+        for k, (player_id, race) in enumerate(races.items()):
 
             parsed_replays_info = {}
             ## Global Feature
@@ -65,7 +88,9 @@ def main(argv):
             ## Spatial Feature
             spatial_path_S = os.path.join(FLAGS.parsed_replay_path, 'SpatialFeatureTensor', race_vs_race, race,
                                             '{}@{}@S.npz'.format(player_id, replay_name))
-            if os.path.isfile(os.path.join(FLAGS.root, spatial_path_S)):
+            # Channel groups are stored next to it as [PATH]@S_[GROUP].npz
+            if os.path.isfile(os.path.join(FLAGS.root, spatial_path_S)) or \
+                    os.path.isfile(os.path.join(FLAGS.root, spatial_path_S.replace('@S.npz', '@S_minimap.npz'))):
                 parsed_replays_info['spatial_path_S'] = spatial_path_S
 
             spatial_path_G = os.path.join(FLAGS.parsed_replay_path, 'SpatialFeatureTensor', race_vs_race, race,
@@ -75,7 +100,19 @@ def main(argv):
 
             replay_path_dict[race].append(parsed_replays_info)
 
-        result.append(replay_path_dict)
+            records.append({'replay': replay_name, 'player_id': player_id, 'race': race,
+                            'enemy_race': [r for i, r in races.items() if i != player_id][0],
+                            'map_name': str(info['map_name']),
+                            'reward': int(info['result'][k] == sc_pb.Victory),
+                            'mmr': int(info['mmr'][k]), 'apm': int(info['apm'][k]),
+                            'duration': int(info['game_duration_loops']),
+                            'global_length': n_frames(os.path.join(FLAGS.root, global_path)),
+                            'spatial_length': n_frames(os.path.join(FLAGS.root, spatial_path_G)),
+                            'global_path': parsed_replays_info.get('global_path', ''),
+                            'spatial_path_S': parsed_replays_info.get('spatial_path_S', ''),
+                            'spatial_path_G': parsed_replays_info.get('spatial_path_G', '')})
+
+        result.append((replay_path_dict, records))
 
     FLAGS.save_path = os.path.join(FLAGS.save_path, race_vs_race)
     if not os.path.isdir(FLAGS.save_path):
@@ -0,0 +1,304 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import heapq
+import signal
+import contextlib
+import queue as Queue
+import multiprocessing
+
+import numpy as np
+from tqdm import tqdm
+
+class Worker(multiprocessing.Process):
+    """
+    A Process holding one game for as long as it runs, fed with replays by ControllerPool.
+    The game is restarted, with exponential backoff, when it fails to start or to answer a ping
+    """
+    def __init__(self, worker_id, run_config, processor, tasks, results, max_replays, max_restarts, backoff,
+                    delay=0.):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self.worker_id = worker_id
+        self.run_config = run_config
+        self.processor = processor
+        self.tasks = tasks
+        self.results = results
+        self.max_replays = max_replays
+        self.max_restarts = max_restarts
+        self.backoff = backoff
+        self.delay = delay
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda a, b: sys.exit())  # Kill thread upon termination signal
+        time.sleep(self.delay)  # Stagger startups, otherwise they seem to conflict somehow
+        process = self.processor(self.worker_id, self.run_config)
+
+        replay_path = None
+        failures = 0
+        while True:
+            try:
+                with self.run_config.start() as controller:
+                    n_replays = 0
+                    while self.max_replays <= 0 or n_replays < self.max_replays:
+                        if replay_path is None:
+                            replay_path = self.tasks.get()
+                            if replay_path is None:
+                                return # No more replays to process
+
+                        controller.ping() # Health check, a dead game is restarted and keeps the replay
+                        self.results.put(('start', self.worker_id, replay_path, None, None))
+                        start = time.time()
+                        try:
+                            process(controller, replay_path)
+                            seconds, error = time.time() - start, None
+                        except Exception as e:
+                            seconds, error = None, repr(e)
+                        self.results.put(('done', self.worker_id, replay_path, error, seconds))
+                        replay_path = None
+                        n_replays += 1
+                        if error is None:
+                            failures = 0
+            except Exception as e:
+                failures += 1
+                if failures > self.max_restarts:
+                    self.results.put(('exit', self.worker_id, replay_path, repr(e), None))
+                    return
+                self.results.put(('restart', self.worker_id, replay_path, repr(e), None))
+                time.sleep(self.backoff * 2 ** (failures - 1))
+
+class ControllerPool(object):
+    """
+    Process replays with n_instance long-lived games, pulling from one queue.
+    processor(worker_id, run_config) is called once in every worker and returns process(controller, replay_path),
+    where replay_path may be any task naming a replay, such as (replay_path, player_id).
+    Replays raising an exception or running over timeout seconds are reported as failed, without taking
+    down the other replays of the worker; a hung worker is killed and replaced
+    """
+    def __init__(self, run_config, processor, n_instance, timeout=None, max_replays=0, max_restarts=5, backoff=1.,
+                    stagger=1.):
+        self.run_config = run_config
+        self.processor = processor
+        self.n_instance = n_instance
+        self.timeout = timeout
+        self.max_replays = max_replays
+        self.max_restarts = max_restarts
+        self.backoff = backoff
+        self.stagger = stagger
+
+    def __start_worker__(self, worker_id, delay=0.):
+        worker = Worker(worker_id, self.run_config, self.processor, self.tasks, self.results,
+                        self.max_replays, self.max_restarts, self.backoff, delay)
+        worker.start()
+        return worker
+
+    def __kill__(self, worker):
+        worker.terminate() # Closes its game
+        worker.join(10)
+        if worker.is_alive():
+            worker.kill()
+            worker.join()
+
+    def run(self, replay_list, costs=None, ledger=None):
+        """
+        Replays are dispatched longest first when their estimated costs, {replay_path: seconds}, are given.
+        Their progress is recorded in ledger when given.
+        Returns {'done', 'failed', 'timeouts', 'restarts', 'unprocessed', 'errors': {replay_path: error},
+                 'times': {replay_path: seconds}, 'makespan', 'predicted_makespan'}
+        """
+        predicted = None
+        if costs is not None:
+            replay_list = sorted(replay_list, key=lambda p: -costs[p])
+            predicted = makespan([costs[p] for p in replay_list], self.n_instance)
+
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        for replay_path in replay_list:
+            self.tasks.put(replay_path)
+        for _ in range(self.n_instance): # Stop every worker once the queue is drained
+            self.tasks.put(None)
+
+        stats = {'done': 0, 'failed': 0, 'timeouts': 0, 'restarts': 0, 'errors': {}, 'times': {},
+                 'predicted_makespan': predicted}
+        workers = {i: self.__start_worker__(i, i*self.stagger) for i in range(self.n_instance)}
+        running = {}    # worker_id -> (replay_path, start time)
+        finished = set()
+        first, last = None, None # Game startups are left out of the makespan
+        pbar = tqdm(total=len(replay_list), desc='#Replay')
+
+        def finish(replay_path, error, seconds=None):
+            nonlocal last
+            if replay_path in finished: # e.g. done right before its worker was killed on timeout
+                return
+            finished.add(replay_path)
+            last = time.time() # Including the replays failed on timeouts or exits
+            stats['done' if error is None else 'failed'] += 1
+            if error is not None:
+                stats['errors'][replay_path] = error
+            if ledger is not None:
+                ledger.finish(replay_path, error, seconds)
+            pbar.update()
+
+        def handle(block):
+            nonlocal first
+            messages = []
+            try:
+                if block:
+                    messages.append(self.results.get(timeout=1))
+                while True:
+                    messages.append(self.results.get_nowait())
+            except Queue.Empty:
+                pass
+
+            for kind, worker_id, replay_path, error, seconds in messages:
+                if kind == 'start':
+                    running[worker_id] = (replay_path, time.time())
+                    first = first or time.time()
+                    if ledger is not None:
+                        ledger.start(replay_path)
+                elif kind == 'done':
+                    running.pop(worker_id, None)
+                    finish(replay_path, error, seconds)
+                    if seconds is not None:
+                        stats['times'][replay_path] = seconds
+                elif kind == 'restart':
+                    stats['restarts'] += 1
+                elif kind == 'exit' and replay_path is not None:
+                    # Unable to start a game, the replay it held is lost with it
+                    finish(replay_path, error)
+
+        try:
+            while len(finished) < len(replay_list) and len(workers) > 0:
+                handle(block=True)
+
+                now = time.time()
+                for worker_id, worker in list(workers.items()):
+                    replay_path, start = running.get(worker_id, (None, now))
+                    timed_out = self.timeout is not None and now - start > self.timeout
+                    if worker.is_alive() and not timed_out:
+                        continue
+
+                    if worker.is_alive():
+                        self.__kill__(worker)
+                        stats['timeouts'] += 1
+                    else:
+                        # Its last messages may have reached the queue only after the drain above
+                        worker.join()
+                        handle(block=False)
+                        replay_path, _ = running.get(worker_id, (None, now))
+                    del workers[worker_id]
+                    if replay_path is not None: # Crashed or hung on it
+                        running.pop(worker_id)
+                        finish(replay_path, 'Timeout' if timed_out else 'Exit code {}'.format(worker.exitcode))
+                        workers[worker_id] = self.__start_worker__(worker_id)
+        finally:
+            pbar.close()
+            for worker in workers.values():
+                self.__kill__(worker)
+
+        # Left in the queue when every worker failed to start a game
+        stats['unprocessed'] = len(replay_list) - len(finished)
+        stats['makespan'] = last - first if first is not None and last is not None else 0.
+        return stats
+
+def makespan(costs, n_instance):
+    """
+    Finish time of the last replay when every idle worker takes the next one in order
+    """
+    finish = [0.] * n_instance
+    for cost in costs:
+        heapq.heappush(finish, heapq.heappop(finish) + cost)
+    return max(finish)
+
+def summary(stats):
+    line = '{done} done, {failed} failed ({timeouts} timeouts), {unprocessed} unprocessed, ' \
+           '{restarts} restarts, makespan {makespan:.1f}s'.format(**stats)
+    if stats['predicted_makespan'] is not None:
+        line += ' (predicted {:.1f}s)'.format(stats['predicted_makespan'])
+    return line
+
+class CostModel(object):
+    """
+    Seconds to process a replay as overhead + rate * game_duration_loops,
+    fitted on the replays timed by the previous runs and saved at path
+    """
+    def __init__(self, path, rate=1e-3, max_samples=10000):
+        self.path = path
+        self.max_samples = max_samples
+        self.samples = []  # [game_duration_loops, seconds]
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.samples = json.load(f)
+        self.overhead, self.rate = self.__fit__(0., rate)
+
+    def __fit__(self, overhead, rate):
+        if len(self.samples) == 0:
+            return overhead, rate
+        loops, seconds = np.asarray(self.samples, dtype=np.float64).T
+        if len(np.unique(loops)) > 1:
+            overhead, rate = np.linalg.lstsq(np.stack([np.ones_like(loops), loops], axis=1), seconds, rcond=None)[0]
+            if overhead >= 0 and rate > 0:
+                return overhead, rate
+        return 0., seconds.sum() / max(loops.sum(), 1.) # Mean throughput
+
+    def predict(self, durations):
+        """
+        {replay_path: game_duration_loops} -> {replay_path: seconds}
+        """
+        return {p: self.overhead + self.rate * loops for p, loops in durations.items()}
+
+    def update(self, durations, times):
+        self.samples = (self.samples + [[durations[p], t] for p, t in sorted(times.items())])[-self.max_samples:]
+        self.overhead, self.rate = self.__fit__(self.overhead, self.rate)
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path+'.tmp', 'w') as f:
+            json.dump(self.samples, f)
+        os.replace(self.path+'.tmp', self.path)
+
+class FakeController(object):
+    """
+    Stands in for a pysc2 controller. replay_info() of replays named *hang* never returns,
+    *crash* kills the game and *error* raises
+    """
+    def __init__(self):
+        self.alive = True
+
+    def ping(self):
+        if not self.alive:
+            raise ConnectionError('Game is dead')
+
+    def replay_info(self, replay_data):
+        if 'hang' in replay_data:
+            time.sleep(1e6)
+        if 'crash' in replay_data:
+            self.alive = False
+            raise ConnectionError('Game crashed')
+        if 'error' in replay_data:
+            raise ValueError('Corrupt replay')
+        return replay_data
+
+class FakeRunConfig(object):
+    """
+    Stands in for pysc2.run_configs.get(), the first start_failures games fail to start
+    """
+    def __init__(self, start_failures=0, startup_time=0.):
+        self.start_failures = multiprocessing.Value('i', start_failures)
+        self.startup_time = startup_time
+
+    @contextlib.contextmanager
+    def start(self):
+        time.sleep(self.startup_time)
+        with self.start_failures.get_lock():
+            self.start_failures.value -= 1
+            if self.start_failures.value >= 0:
+                raise ConnectionError('Game failed to start')
+        yield FakeController()
+
+    def replay_data(self, replay_path):
+        return replay_path
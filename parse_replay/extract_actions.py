@@ -5,22 +5,25 @@ from __future__ import print_function
 import os
 import sys
 import json
-import time
-import signal
-import threading
-import queue as Queue
-import multiprocessing
+import stream
 from absl import app
 from absl import flags
-from future.builtins import range
 
-from google.protobuf.json_format import MessageToJson
+import numpy as np
 
 from pysc2 import run_configs
 from pysc2.lib import point
+from pysc2.lib import features
 from s2clientprotocol import sc2api_pb2 as sc_pb
 from s2clientprotocol import common_pb2 as common_pb
 
+from macro_actions import MacroActionClassifier
+from controller_pool import ControllerPool, CostModel, summary
+from ledger import Ledger
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import replay_infos
+
 FLAGS = flags.FLAGS
 flags.DEFINE_string(name='hq_replay_set', default='../high_quality_replays/Terran_vs_Terran.json',
                     help='File storing replays list')
@@ -31,8 +34,14 @@ flags.DEFINE_integer(name='n_instance', default=16,
                      help='# of processes to run')
 flags.DEFINE_integer(name='step_mul', default=8,
                      help='step size')
-flags.DEFINE_integer(name='batch_size', default=10,
-                     help='# of replays to process in one iter')
+flags.DEFINE_integer(name='batch_size', default=0,
+                     help='# of replays to process before restarting the game [0 indicate never]')
+flags.DEFINE_float(name='timeout', default=None,
+                   help='Seconds before giving up a replay')
+flags.DEFINE_integer(name='max_attempts', default=3,
+                     help='# of failed attempts before a replay is left out [0 indicate never]')
+flags.DEFINE_boolean(name='resume', default=True,
+                     help='Skip the replays done by the previous runs, as recorded in the ledger')
 flags.DEFINE_integer(name='width', default=24,
                      help='World width')
 flags.DEFINE_integer(name='map_size', default=64,
@@ -45,80 +54,54 @@ interface = sc_pb.InterfaceOptions(raw=True, score=False,
 size.assign_to(interface.feature_layer.resolution)
 size.assign_to(interface.feature_layer.minimap_resolution)
 
-class ReplayProcessor(multiprocessing.Process):
-    """A Process that pulls replays and processes them."""
-    def __init__(self, run_config, replay_queue, counter, total_num):
-        super(ReplayProcessor, self).__init__()
-        self.run_config = run_config
-        self.replay_queue = replay_queue
-        self.counter = counter
-        self.total_num = total_num
-
-    def run(self):
-        signal.signal(signal.SIGTERM, lambda a, b: sys.exit())  # Kill thread upon termination signal
-        while True:
-            with self.run_config.start() as controller: 
-                for _ in range(FLAGS.batch_size):
-                    try:
-                        replay_path = self.replay_queue.get()
-                    except Queue.Empty:
-                        return
-
-                    try:
-                        with self.counter.get_lock():
-                            self.counter.value += 1
-                            print('Processing {}/{} ...'.format(self.counter.value, self.total_num))
-
-                        replay_data = self.run_config.replay_data(replay_path) # Get high level replay data
-                        info = controller.replay_info(replay_data)
-                        map_data = None
-                        if info.local_map_path: # Special handling for custom maps
-                            map_data = self.run_config.map_data(info.local_map_path) 
-
-                        for player_info in info.player_info: # Process replay from each players point of view
-                            race = common_pb.Race.Name(player_info.player_info.race_actual)
-                            player_id = player_info.player_info.player_id
-
-                            if os.path.isfile(os.path.join(FLAGS.save_path, race,
-                                                           '{}@{}'.format(player_id, os.path.basename(replay_path)))): # Skip replays that have already been processed
-                                continue
-
-                            self.process_replay(controller, replay_data, map_data, player_id, race, replay_path) # Process replay
-                    except Exception as e:
-                        print(e)
-                        break
-                    finally:
-                        self.replay_queue.task_done()
-
-    def process_replay(self, controller, replay_data, map_data, player_id, race, replay_path):
-        controller.start_replay(sc_pb.RequestStartReplay( # Start the replay
-            replay_data=replay_data,
-            map_data=map_data,
-            options=interface,
-            observed_player_id=player_id))
-
-        save_folder = os.path.join(FLAGS.save_path, race)
-        actions = []
-        
-        while True:
-            controller.step(FLAGS.step_mul)
-            obs = controller.observe()  # Get observation from current frame
-            actions.append([MessageToJson(a) for a in obs.actions]) # Save all actions observed between previous and current observed frame
-
-            if obs.player_result: # Player result obtained means game has ended
-                with open(os.path.join(save_folder, '{}@{}'.format(
-                        player_id, os.path.basename(replay_path))), 'w') as f:
-                    json.dump(actions, f)
-                return
-
-
-def replay_queue_filler(replay_queue, replay_list):
-    """A thread that fills the replay_queue with replay filenames."""
-    for replay_path in replay_list:
-        replay_queue.put(replay_path)
+def processor(worker_id, run_config):
+    macro_action = MacroActionClassifier() # Kept warm across the replays of the worker
+
+    def process(controller, task):
+        replay_path, player_id = task # Process replay from the point of view of one player
+        replay_data = run_config.replay_data(replay_path) # Get high level replay data
+        info = controller.replay_info(replay_data)
+        map_data = None
+        if info.local_map_path: # Special handling for custom maps
+            map_data = run_config.map_data(info.local_map_path)
+
+        race = [common_pb.Race.Name(p.player_info.race_actual)
+                    for p in info.player_info if p.player_info.player_id == player_id][0]
+        process_replay(controller, replay_data, map_data, player_id, race, replay_path, macro_action) # Process replay
+    return process
+
+def process_replay(controller, replay_data, map_data, player_id, race, replay_path, macro_action):
+    controller.start_replay(sc_pb.RequestStartReplay( # Start the replay
+        replay_data=replay_data,
+        map_data=map_data,
+        options=interface,
+        observed_player_id=player_id))
+
+    save_path = os.path.join(FLAGS.save_path, race, '{}@{}'.format(player_id, os.path.basename(replay_path)))
+    feat = features.features_from_game_info(controller.game_info())
+    steps = []
+
+    # Written under temporary names, a crash never leaves truncated outputs
+    ostream = stream.open(save_path+'.tmp', 'wb', buffer_size=1000)
+    while True:
+        controller.step(FLAGS.step_mul)
+        obs = controller.observe()  # Get observation from current frame
+        # Save all actions observed between previous and current observed frame
+        ostream.write(sc_pb.ResponseObservation(actions=obs.actions))
+        steps.append(obs.actions)
+
+        if obs.player_result: # Player result obtained means game has ended
+            ostream.close()
+            with open(save_path+'@macro.npy.tmp', 'wb') as f:
+                np.save(f, macro_action.stream(feat, steps))
+            os.rename(save_path+'@macro.npy.tmp', save_path+'@macro.npy')
+            os.rename(save_path+'.tmp', save_path)
+            return
 
 def main(argv):
     race_vs_race = os.path.basename(FLAGS.hq_replay_set).split('.')[0] # Get the specified matchup
+    cost_path = os.path.join(FLAGS.save_path, 'Costs', 'extract_actions.json')
+    ledger_path = os.path.join(FLAGS.save_path, 'Ledger', 'extract_actions', race_vs_race+'.jsonl')
     FLAGS.save_path = os.path.join(FLAGS.save_path, 'Actions', race_vs_race)
 
     for race in set(race_vs_race.split('_vs_')): # Handle each race in the matchup
@@ -127,28 +110,28 @@ def main(argv):
             os.makedirs(path)
 
     run_config = run_configs.get() # Get SC2 run config
+    with open(FLAGS.hq_replay_set) as f: # Get all the replays from preprocess
+        replay_list = json.load(f)
+    # Resume with the (replay, player) pairs not done by the previous runs, the longest replays first
+    ledger = Ledger(ledger_path)
+    durations = {(p, player_id): int(replay_infos.load(infos_path).fields(p)['game_duration_loops'])
+                    for p, infos_path in replay_list for player_id, _, _ in replay_infos.load(infos_path).players(p)}
+    if FLAGS.resume:
+        durations = {task: durations[task] for task in ledger.pending(durations, FLAGS.max_attempts)}
+    cost_model = CostModel(cost_path)
+
     try:
-        with open(FLAGS.hq_replay_set) as f: # Get all the replays from preprocess
-            replay_list = json.load(f)
-        replay_list = sorted([p for p, _ in replay_list])
-
-        # Create controller thread for allocating replays 
-        replay_queue = multiprocessing.JoinableQueue(FLAGS.n_instance * 10)
-        replay_queue_thread = threading.Thread(target=replay_queue_filler,
-                                           args=(replay_queue, replay_list))
-        replay_queue_thread.daemon = True
-        replay_queue_thread.start()
-
-        counter = multiprocessing.Value('i', 0)
-        for _ in range(FLAGS.n_instance): # Start worker threads
-            p = ReplayProcessor(run_config, replay_queue, counter, len(replay_list))
-            p.daemon = True
-            p.start()
-            time.sleep(1)   # Stagger startups, otherwise they seem to conflict somehow
-
-        replay_queue.join() # Wait for the queue to empty.
+        stats = ControllerPool(run_config, processor, FLAGS.n_instance,
+                               timeout=FLAGS.timeout, max_replays=FLAGS.batch_size).run(
+                                    sorted(durations), cost_model.predict(durations), ledger)
+        cost_model.update(durations, stats['times'])
+        print(summary(stats))
+        for replay_path, error in sorted(stats['errors'].items()):
+            print('{}: {}'.format(replay_path, error))
+        return int(stats['failed'] + stats['unprocessed'] > 0) # Failed replays are retried by the next run
     except KeyboardInterrupt:
         print("Caught KeyboardInterrupt, exiting.")
+        return 1
 
 if __name__ == '__main__':
     app.run(main)
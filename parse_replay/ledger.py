@@ -0,0 +1,53 @@
+import os
+import json
+import time
+
+class Ledger(object):
+    """
+    State of every task of a stage, pending, running, done or failed, with its attempts and timing.
+    Changes are appended as JSON lines by the process dispatching the tasks and the last line of a task wins,
+    so a crash loses at most a torn last line. Tasks left running by a crash are run again
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # Torn by a crash while appending
+                    self.entries[self.__task__(entry.pop('task'))] = entry
+        elif not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.f = open(path, 'a')
+
+    def __task__(self, task):
+        return tuple(task) if isinstance(task, list) else task
+
+    def __write__(self, task, **kwargs):
+        entry = self.entries.setdefault(task, {'state': 'pending', 'attempts': 0, 'seconds': None, 'error': None})
+        entry.update(kwargs, time=time.time())
+        # One write per line, appends of concurrent stages do not interleave
+        self.f.write(json.dumps(dict(entry, task=task)) + '\n')
+        self.f.flush()
+
+    def state(self, task):
+        return self.entries.get(task, {'state': 'pending'})['state']
+
+    def pending(self, tasks, max_attempts=0):
+        """
+        Tasks not done yet, leaving out the ones which failed max_attempts times [0 indicate never]
+        """
+        return [t for t in tasks if self.state(t) != 'done' and
+                    (max_attempts <= 0 or self.entries.get(t, {'attempts': 0})['attempts'] < max_attempts)]
+
+    def start(self, task):
+        self.__write__(task, state='running', attempts=self.entries.get(task, {'attempts': 0})['attempts'] + 1)
+
+    def finish(self, task, error=None, seconds=None):
+        self.__write__(task, state='done' if error is None else 'failed', error=error, seconds=seconds)
+
+    def close(self):
+        self.f.close()
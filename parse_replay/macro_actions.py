@@ -0,0 +1,54 @@
+import numpy as np
+
+from pysc2.lib.actions import FUNCTIONS
+
+macro_prefixes = {'Build', 'Train', 'Research', 'Morph', 'Cancel', 'Halt', 'Stop'}
+
+class MacroActionClassifier(object):
+    """
+    Function id of the first macro action of a step, -1 if there is none.
+    reverse_action() only looks at the ability id and the kind of target of a unit command,
+    so its result is memoized on them and one classifier serves every replay of a process
+    """
+    def __init__(self):
+        self.memo = {}  # (ability_id, target) -> macro function id or -1
+
+    def __key__(self, action):
+        for field in ['action_feature_layer', 'action_render']:
+            if action.HasField(field) and getattr(action, field).HasField('unit_command'):
+                command = getattr(action, field).unit_command
+                return command.ability_id, command.WhichOneof('target')
+        return None # Camera moves, selections and UI actions are never macro actions
+
+    def classify(self, feat, action):
+        key = self.__key__(action)
+        if key is None:
+            return -1
+        if key not in self.memo:
+            try:
+                func_id = feat.reverse_action(action).function
+            except Exception:
+                func_id = -1
+            self.memo[key] = func_id if func_id >= 0 and \
+                                FUNCTIONS[func_id].name.split('_')[0] in macro_prefixes else -1
+        return self.memo[key]
+
+    def __call__(self, feat, actions):
+        for action in actions:
+            func_id = self.classify(feat, action)
+            if func_id >= 0:
+                return func_id
+        return -1
+
+    def stream(self, feat, steps):
+        """Macro function id of every step of an action stream, as saved in @macro.npy."""
+        return np.asarray([self(feat, actions) for actions in steps], dtype=np.int16)
+
+def sampled_frames(macro_actions, step_mul, skip, frame_ids=None):
+    """Frames of the macro steps and of the fixed recording steps, given the macro action of every step.
+    frame_ids of the steps default to step_mul, 2*step_mul, ..."""
+    macro_actions = np.asarray(macro_actions)
+    if frame_ids is None:
+        frame_ids = step_mul * np.arange(1, len(macro_actions)+1)
+    frame_ids = np.asarray(frame_ids)
+    return frame_ids[(macro_actions >= 0) | (frame_ids % skip == 0)].tolist()
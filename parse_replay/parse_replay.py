@@ -5,14 +5,8 @@ from __future__ import print_function
 import os
 import sys
 import json
-import time
-import signal
-import threading
-import queue as Queue
-import multiprocessing
 from absl import app
 from absl import flags
-from future.builtins import range
 
 from google.protobuf.json_format import MessageToJson
 
@@ -23,6 +17,12 @@ from s2clientprotocol import common_pb2 as common_pb
 
 import stream
 
+from controller_pool import ControllerPool, CostModel, summary
+from ledger import Ledger
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import replay_infos
+
 FLAGS = flags.FLAGS
 flags.DEFINE_string(name='hq_replay_set', default='../high_quality_replays/Terran_vs_Terran.json',
                     help='File storing replays list')
@@ -31,8 +31,14 @@ flags.DEFINE_string(name='save_path', default='../parsed_replays',
 
 flags.DEFINE_integer(name='n_instance', default=16,
                      help='# of processes to run')
-flags.DEFINE_integer(name='batch_size', default=10,
-                     help='# of replays to process in one iter')
+flags.DEFINE_integer(name='batch_size', default=0,
+                     help='# of replays to process before restarting the game [0 indicate never]')
+flags.DEFINE_float(name='timeout', default=None,
+                   help='Seconds before giving up a replay')
+flags.DEFINE_integer(name='max_attempts', default=3,
+                     help='# of failed attempts before a replay is left out [0 indicate never]')
+flags.DEFINE_boolean(name='resume', default=True,
+                     help='Skip the replays done by the previous runs, as recorded in the ledger')
 
 flags.DEFINE_integer(name='width', default=24,
                      help='World width')
@@ -46,100 +52,62 @@ interface = sc_pb.InterfaceOptions(raw=True, score=True,
 size.assign_to(interface.feature_layer.resolution)
 size.assign_to(interface.feature_layer.minimap_resolution)
 
-class ReplayProcessor(multiprocessing.Process):
-    """A Process that pulls replays and processes them."""
-    def __init__(self, run_config, replay_queue, counter, total_num):
-        super(ReplayProcessor, self).__init__()
-        self.run_config = run_config
-        self.replay_queue = replay_queue
-        self.counter = counter
-        self.total_num = total_num
-
-    def run(self):
-        signal.signal(signal.SIGTERM, lambda a, b: sys.exit())  # Kill thread upon termination signal
-        while True:
-            with self.run_config.start() as controller:
-                for _ in range(FLAGS.batch_size):
-                    try:
-                        replay_path = self.replay_queue.get()
-                    except Queue.Empty:
-                        return
-                    try:
-                        with self.counter.get_lock():
-                            self.counter.value += 1
-                            print('Processing {}/{} ...'.format(self.counter.value, self.total_num))
-
-                        sampled_action_path = os.path.join(FLAGS.save_path.replace(
-                            'SampledObservations', 'SampledActions'), os.path.basename(replay_path)) 
-                        if not os.path.isfile(sampled_action_path): # Unable to find the sampled observations of replay
-                            print('Unable to locate', sampled_action_path)
-                            return
-
-                        with open(sampled_action_path) as f: # Get all macro action frames
-                            actions = json.load(f)
-                        actions.insert(0, 0) # Add 0th frame to the start
-
-                        replay_data = self.run_config.replay_data(replay_path)
-                        info = controller.replay_info(replay_data)
-                        map_data = None
-                        if info.local_map_path: # Special handling for custom maps
-                            map_data = self.run_config.map_data(info.local_map_path)
-
-                        for player_info in info.player_info: # Parse replay from each player's point of view
-                            race = common_pb.Race.Name(player_info.player_info.race_actual)
-                            player_id = player_info.player_info.player_id
-
-                            observation_path = os.path.join(FLAGS.save_path, race,
-                                                            '{}@{}'.format(player_id, os.path.basename(replay_path)))
-                            global_info_path = observation_path.replace('SampledObservations', 'GlobalInfos')
-
-                            if os.path.isfile(observation_path) and os.path.isfile(global_info_path): # Skip replay if it has already been processed
-                                continue
-
-                            ostream = stream.open(observation_path, 'wb', buffer_size=1000)
-                            self.process_replay(controller, replay_data, map_data, player_id, actions,
-                                                ostream, global_info_path)
-                            ostream.close()
-                    except Exception as e:
-                        try:
-                            ostream.close()
-                            if os.path.isfile(observation_path):
-                                os.remove(observation_path)
-
-                            if os.path.isfile(global_info_path):
-                                os.remove(global_info_path)
-                        except:
-                            pass
-
-                        print(e)
-                        break
-                    finally:
-                        self.replay_queue.task_done()
-
-    def process_replay(self, controller, replay_data, map_data, player_id, actions, ostream, global_info_path):
-        controller.start_replay(sc_pb.RequestStartReplay(
-            replay_data=replay_data,
-            map_data=map_data,
-            options=interface,
-            observed_player_id=player_id))
-
-        global_info = {'game_info': controller.game_info(), # Get the basic information about the game
-                       'data_raw': controller.data_raw()}   # Get the raw static data for the current game
-        with open(global_info_path, 'w') as f:
-            json.dump({k:MessageToJson(v) for k, v in global_info.items()}, f)
-
-        for pre_id, id in zip(actions[:-1], actions[1:]): # Loop through all the steps, zip creates pairs of previous and current frame ids
-            controller.step(id - pre_id)
-            obs = controller.observe()
-            ostream.write(obs) # Save observations
-
-def replay_queue_filler(replay_queue, replay_list):
-    """A thread that fills the replay_queue with replay paths."""
-    for replay_path in replay_list:
-        replay_queue.put(replay_path)
+def processor(worker_id, run_config):
+    def process(controller, task):
+        replay_path, player_id = task # Parse replay from the point of view of one player
+        sampled_frame_path = os.path.join(FLAGS.save_path.replace(
+            'SampledObservations', 'SampledFrames'), os.path.basename(replay_path))
+        if not os.path.isfile(sampled_frame_path): # Unable to find the sampled frames of replay
+            raise IOError('Unable to locate {}'.format(sampled_frame_path))
+
+        with open(sampled_frame_path) as f: # Get all sampled frames, see sample_frames.py
+            frames = json.load(f)
+        frames.insert(0, 0) # Add 0th frame to the start
+
+        replay_data = run_config.replay_data(replay_path)
+        info = controller.replay_info(replay_data)
+        map_data = None
+        if info.local_map_path: # Special handling for custom maps
+            map_data = run_config.map_data(info.local_map_path)
+
+        race = [common_pb.Race.Name(p.player_info.race_actual)
+                    for p in info.player_info if p.player_info.player_id == player_id][0]
+        observation_path = os.path.join(FLAGS.save_path, race,
+                                        '{}@{}'.format(player_id, os.path.basename(replay_path)))
+        global_info_path = observation_path.replace('SampledObservations', 'GlobalInfos')
+
+        # Written under temporary names, a crash never leaves truncated outputs
+        ostream = stream.open(observation_path+'.tmp', 'wb', buffer_size=1000)
+        try:
+            process_replay(controller, replay_data, map_data, player_id, frames,
+                           ostream, global_info_path+'.tmp')
+        finally:
+            ostream.close()
+        os.rename(global_info_path+'.tmp', global_info_path)
+        os.rename(observation_path+'.tmp', observation_path)
+    return process
+
+def process_replay(controller, replay_data, map_data, player_id, frames, ostream, global_info_path):
+    controller.start_replay(sc_pb.RequestStartReplay(
+        replay_data=replay_data,
+        map_data=map_data,
+        options=interface,
+        observed_player_id=player_id))
+
+    global_info = {'game_info': controller.game_info(), # Get the basic information about the game
+                   'data_raw': controller.data_raw()}   # Get the raw static data for the current game
+    with open(global_info_path, 'w') as f:
+        json.dump({k:MessageToJson(v) for k, v in global_info.items()}, f)
+
+    for pre_id, id in zip(frames[:-1], frames[1:]): # Loop through all the steps, zip creates pairs of previous and current frame ids
+        controller.step(id - pre_id)
+        obs = controller.observe()
+        ostream.write(obs) # Save observations
 
 def main(argv):
     race_vs_race = os.path.basename(FLAGS.hq_replay_set).split('.')[0] # Get the specified matchup
+    cost_path = os.path.join(FLAGS.save_path, 'Costs', 'parse_replay.json')
+    ledger_path = os.path.join(FLAGS.save_path, 'Ledger', 'parse_replay', race_vs_race+'.jsonl')
     FLAGS.save_path = os.path.join(FLAGS.save_path, 'SampledObservations', race_vs_race)
 
     for race in set(race_vs_race.split('_vs_')): # Handle each race in the matchup
@@ -152,27 +120,28 @@ def main(argv):
             os.makedirs(path)
 
     run_config = run_configs.get()
+    with open(FLAGS.hq_replay_set) as f:
+        replay_list = json.load(f)
+    # Resume with the (replay, player) pairs not done by the previous runs, the longest replays first
+    ledger = Ledger(ledger_path)
+    durations = {(p, player_id): int(replay_infos.load(infos_path).fields(p)['game_duration_loops'])
+                    for p, infos_path in replay_list for player_id, _, _ in replay_infos.load(infos_path).players(p)}
+    if FLAGS.resume:
+        durations = {task: durations[task] for task in ledger.pending(durations, FLAGS.max_attempts)}
+    cost_model = CostModel(cost_path)
+
     try:
-        with open(FLAGS.hq_replay_set) as f:
-            replay_list = json.load(f)
-        replay_list = sorted([p for p, _ in replay_list])
-
-        replay_queue = multiprocessing.JoinableQueue(FLAGS.n_instance * 10)
-        replay_queue_thread = threading.Thread(target=replay_queue_filler,
-                                           args=(replay_queue, replay_list))
-        replay_queue_thread.daemon = True
-        replay_queue_thread.start()
-
-        counter = multiprocessing.Value('i', 0)
-        for _ in range(FLAGS.n_instance):
-            p = ReplayProcessor(run_config, replay_queue, counter, len(replay_list))
-            p.daemon = True
-            p.start()
-            time.sleep(1)   # Stagger startups, otherwise they seem to conflict somehow
-
-        replay_queue.join() # Wait for the queue to empty.
+        stats = ControllerPool(run_config, processor, FLAGS.n_instance,
+                               timeout=FLAGS.timeout, max_replays=FLAGS.batch_size).run(
+                                    sorted(durations), cost_model.predict(durations), ledger)
+        cost_model.update(durations, stats['times'])
+        print(summary(stats))
+        for replay_path, error in sorted(stats['errors'].items()):
+            print('{}: {}'.format(replay_path, error))
+        return int(stats['failed'] + stats['unprocessed'] > 0) # Failed replays are retried by the next run
     except KeyboardInterrupt:
         print("Caught KeyboardInterrupt, exiting.")
+        return 1
 
 if __name__ == '__main__':
     app.run(main)
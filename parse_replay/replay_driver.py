@@ -0,0 +1,185 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import functools
+from absl import app
+from absl import flags
+
+import numpy as np
+
+from google.protobuf.json_format import MessageToJson
+
+from pysc2 import run_configs
+from pysc2.lib import point
+from pysc2.lib import features
+from s2clientprotocol import sc2api_pb2 as sc_pb
+from s2clientprotocol import common_pb2 as common_pb
+
+import stream
+
+from macro_actions import MacroActionClassifier, sampled_frames
+from controller_pool import ControllerPool, CostModel, summary
+from ledger import Ledger
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import replay_infos
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(name='hq_replay_set', default='../high_quality_replays/Terran_vs_Terran.json',
+                    help='File storing replays list')
+flags.DEFINE_string(name='save_path', default='../parsed_replays',
+                    help='Path for saving results')
+
+flags.DEFINE_integer(name='n_instance', default=16,
+                     help='# of processes to run')
+flags.DEFINE_integer(name='batch_size', default=0,
+                     help='# of replays to process before restarting the game [0 indicate never]')
+flags.DEFINE_float(name='timeout', default=None,
+                   help='Seconds before giving up a replay')
+flags.DEFINE_integer(name='max_attempts', default=3,
+                     help='# of failed attempts before a replay is left out [0 indicate never]')
+flags.DEFINE_boolean(name='resume', default=True,
+                     help='Skip the replays done by the previous runs, as recorded in the ledger')
+flags.DEFINE_integer(name='buffer_size', default=1000,
+                     help='# of observations buffered in memory before writing them')
+
+flags.DEFINE_integer(name='step_mul', default=8,
+                     help='step size')
+flags.DEFINE_integer(name='skip', default=96,
+                     help='# of skipped frames')
+flags.DEFINE_integer(name='width', default=24,
+                     help='World width')
+flags.DEFINE_integer(name='map_size', default=64,
+                     help='Map size')
+
+FLAGS(sys.argv)
+size = point.Point(FLAGS.map_size, FLAGS.map_size)
+interface = sc_pb.InterfaceOptions(raw=True, score=True,
+                feature_layer=sc_pb.SpatialCameraSetup(width=FLAGS.width))
+size.assign_to(interface.feature_layer.resolution)
+size.assign_to(interface.feature_layer.minimap_resolution)
+
+def processor(race_vs_race, worker_id, run_config):
+    """
+    Runs every replay once per player, writing the outputs of extract_actions.py,
+    sample_frames.py and parse_replay.py together.
+    """
+    macro_action = MacroActionClassifier() # Kept warm across the replays of the worker
+
+    def process(controller, replay_path):
+        replay_data = run_config.replay_data(replay_path)
+        info = controller.replay_info(replay_data)
+        map_data = None
+        if info.local_map_path: # Special handling for custom maps
+            map_data = run_config.map_data(info.local_map_path)
+
+        players = [(p.player_info.player_id, common_pb.Race.Name(p.player_info.race_actual))
+                        for p in info.player_info]
+        process_replay(controller, replay_data, map_data, players, race_vs_race, os.path.basename(replay_path),
+                       macro_action)
+    return process
+
+def process_replay(controller, replay_data, map_data, players, race_vs_race, replay_name, macro_action):
+    paths = [{k: os.path.join(FLAGS.save_path, k, race_vs_race, race, '{}@{}'.format(player_id, replay_name))
+                for k in ['Actions', 'SampledObservations', 'GlobalInfos']} for player_id, race in players]
+    sampled_frame_path = os.path.join(FLAGS.save_path, 'SampledFrames', race_vs_race, replay_name)
+
+    ## The first player keeps every observation, until the macro frames of the other player are known
+    spill_path = paths[0]['SampledObservations']+'.all'
+    frames = set()
+    macro_actions = []
+    for i, ((player_id, _), path) in enumerate(zip(players, paths)):
+        controller.start_replay(sc_pb.RequestStartReplay(
+            replay_data=replay_data,
+            map_data=map_data,
+            options=interface,
+            observed_player_id=player_id))
+
+        global_info = {'game_info': controller.game_info(), # Get the basic information about the game
+                       'data_raw': controller.data_raw()}   # Get the raw static data for the current game
+        with open(path['GlobalInfos']+'.tmp', 'w') as f:
+            json.dump({k:MessageToJson(v) for k, v in global_info.items()}, f)
+        feat = features.features_from_game_info(global_info['game_info'])
+
+        astream = stream.open(path['Actions']+'.tmp', 'wb', buffer_size=FLAGS.buffer_size)
+        ostream = stream.open(spill_path if i == 0 else path['SampledObservations']+'.tmp', 'wb',
+                              buffer_size=FLAGS.buffer_size)
+        macro_actions.append([])
+        frame_ids = []
+        while True:
+            controller.step(FLAGS.step_mul)
+            obs = controller.observe()
+            # Frames of both players are the game loops of their observations, as checked by global_states.py
+            frame_id = obs.observation.game_loop - 1
+            frame_ids.append(frame_id)
+
+            astream.write(sc_pb.ResponseObservation(actions=obs.actions))
+            macro_actions[i].append(macro_action(feat, obs.actions))
+            if i == 0 or frame_id in frames or macro_actions[i][-1] >= 0 or frame_id % FLAGS.skip == 0:
+                ostream.write(obs)
+
+            if obs.player_result: # Player result obtained means game has ended
+                break
+        astream.close()
+        ostream.close()
+        frames |= set(sampled_frames(macro_actions[i], FLAGS.step_mul, FLAGS.skip, frame_ids))
+
+    ## Keep the frames sampled for either player
+    ostream = stream.open(paths[0]['SampledObservations']+'.tmp', 'wb', buffer_size=FLAGS.buffer_size)
+    for obs in stream.parse(spill_path, sc_pb.ResponseObservation):
+        if obs.observation.game_loop - 1 in frames:
+            ostream.write(obs)
+    ostream.close()
+    os.remove(spill_path)
+
+    for path, macro in zip(paths, macro_actions):
+        with open(path['Actions']+'@macro.npy.tmp', 'wb') as f:
+            np.save(f, np.asarray(macro, dtype=np.int16))
+        os.rename(path['Actions']+'@macro.npy.tmp', path['Actions']+'@macro.npy')
+        for p in path.values():
+            os.rename(p+'.tmp', p)
+    with open(sampled_frame_path+'.tmp', 'w') as f:
+        json.dump(sorted(frames), f)
+    os.rename(sampled_frame_path+'.tmp', sampled_frame_path)
+
+def main(argv):
+    race_vs_race = os.path.basename(FLAGS.hq_replay_set).split('.')[0] # Get the specified matchup
+    for folder in ['Actions', 'SampledObservations', 'GlobalInfos']:
+        for race in set(race_vs_race.split('_vs_')): # Handle each race in the matchup
+            path = os.path.join(FLAGS.save_path, folder, race_vs_race, race)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+    if not os.path.isdir(os.path.join(FLAGS.save_path, 'SampledFrames', race_vs_race)):
+        os.makedirs(os.path.join(FLAGS.save_path, 'SampledFrames', race_vs_race))
+
+    cost_path = os.path.join(FLAGS.save_path, 'Costs', 'replay_driver.json')
+    ledger_path = os.path.join(FLAGS.save_path, 'Ledger', 'replay_driver', race_vs_race+'.jsonl')
+    run_config = run_configs.get()
+    with open(FLAGS.hq_replay_set) as f:
+        replay_list = json.load(f)
+    # Resume with the replays not done by the previous runs, the longest first
+    ledger = Ledger(ledger_path)
+    durations = {p: int(replay_infos.load(infos_path).fields(p)['game_duration_loops']) for p, infos_path in replay_list}
+    if FLAGS.resume:
+        durations = {p: durations[p] for p in ledger.pending(durations, FLAGS.max_attempts)}
+    cost_model = CostModel(cost_path)
+
+    try:
+        stats = ControllerPool(run_config, functools.partial(processor, race_vs_race), FLAGS.n_instance,
+                               timeout=FLAGS.timeout, max_replays=FLAGS.batch_size).run(
+                                    sorted(durations), cost_model.predict(durations), ledger)
+        cost_model.update(durations, stats['times'])
+        print(summary(stats))
+        for replay_path, error in sorted(stats['errors'].items()):
+            print('{}: {}'.format(replay_path, error))
+        return int(stats['failed'] + stats['unprocessed'] > 0) # Failed replays are retried by the next run
+    except KeyboardInterrupt:
+        print("Caught KeyboardInterrupt, exiting.")
+        return 1
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,315 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import json
+import shutil
+import hashlib
+import subprocess
+from absl import app
+from absl import flags
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(name='hq_replay_set', default='../high_quality_replays/Terran_vs_Terran.json',
+                    help='File storing replays list')
+flags.DEFINE_string(name='parsed_replay_path', default='../parsed_replays',
+                    help='Path for parsed replays')
+flags.DEFINE_string(name='save_path', default='../train_val_test',
+                    help='Path for saving the split')
+flags.DEFINE_string(name='state_path', default=None,
+                    help='Path for the build state [default: PARSED_REPLAY_PATH/.build]')
+
+flags.DEFINE_integer(name='n_workers', default=16,
+                     help='# of stage processes to run at the same time')
+flags.DEFINE_integer(name='chunk_size', default=10,
+                     help='# of replays handed to one stage process')
+
+flags.DEFINE_integer(name='step_mul', default=8,
+                     help='step size')
+flags.DEFINE_integer(name='skip', default=96,
+                     help='# of skipped frames')
+flags.DEFINE_integer(name='width', default=24,
+                     help='World width')
+flags.DEFINE_integer(name='map_size', default=64,
+                     help='Map size')
+flags.DEFINE_boolean(name='single_pass', default=False,
+                     help='Extract actions and sampled observations in one run of every replay')
+flags.DEFINE_boolean(name='from_observations', default=False,
+                     help='Compute Stat and GlobalFeatureVector from the SampledObservations, without GlobalFeatures')
+flags.DEFINE_boolean(name='spatial', default=False,
+                     help='Extract spatial feature tensors')
+flags.DEFINE_boolean(name='quantize', default=False,
+                     help='Store the raw integer layers of S')
+flags.DEFINE_string(name='ratio', default='7:1:2',
+                    help='train:val:test')
+flags.DEFINE_integer(name='seed', default=1,
+                     help='random seed')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class Stage(object):
+    """
+    One script of the pipeline, run on chunks of replays [per_replay] or once [aggregate].
+    The build key of a task hashes params, the sources of the script and the outputs of the tasks it depends on
+    """
+    def __init__(self, name, script, params, outputs, deps, sources=(), per_replay=True, item_flag=None):
+        self.name = name
+        self.script = script
+        self.params = params
+        self.outputs = outputs      # item -> glob patterns
+        self.deps = deps            # item -> task ids
+        self.sources = [script] + list(sources)
+        self.per_replay = per_replay
+        self.item_flag = item_flag  # Flag taking the item of aggregate stages, instead of the replays list
+
+    def command(self, replay_set, item):
+        params = dict(self.params, **({self.item_flag: item} if self.item_flag else {'hq_replay_set': replay_set}))
+        return [sys.executable, os.path.basename(self.script)] + \
+               ['--{}={}'.format(k, v) for k, v in sorted(params.items())]
+
+def build_stages(race_vs_race, races, replays):
+    P = os.path.abspath(FLAGS.parsed_replay_path)
+    per_player = lambda folder: lambda name: [os.path.join(P, folder, race_vs_race, '*', '*@'+name)]
+    all_of = lambda stage: lambda _: ['{}:{}'.format(stage, os.path.basename(p)) for p, _ in replays]
+    actions = lambda name: per_player('Actions')(name) + per_player('Actions')(name+'@macro.npy')
+    sampled_frames = lambda name: [os.path.join(P, 'SampledFrames', race_vs_race, name)]
+    observations = lambda name: per_player('SampledObservations')(name) + per_player('GlobalInfos')(name)
+
+    if FLAGS.single_pass:
+        stages = [
+            Stage('replay_driver', 'parse_replay/replay_driver.py',
+                  {'save_path': P, 'n_instance': 1, 'resume': False, 'step_mul': FLAGS.step_mul,
+                   'skip': FLAGS.skip, 'width': FLAGS.width, 'map_size': FLAGS.map_size},
+                  lambda name: actions(name) + sampled_frames(name) + observations(name),
+                  lambda name: [], sources=['parse_replay/macro_actions.py'])]
+    else:
+        stages = [
+            Stage('extract_actions', 'parse_replay/extract_actions.py',
+                  {'save_path': P, 'n_instance': 1, 'resume': False, 'step_mul': FLAGS.step_mul,
+                   'width': FLAGS.width, 'map_size': FLAGS.map_size},
+                  actions, lambda name: [], sources=['parse_replay/macro_actions.py']),
+            Stage('sample_frames', 'parse_replay/sample_frames.py',
+                  {'parsed_replays': P, 'n_workers': 1, 'step_mul': FLAGS.step_mul, 'skip': FLAGS.skip},
+                  sampled_frames, lambda name: ['extract_actions:'+name],
+                  sources=['parse_replay/macro_actions.py', 'preprocess/replay_infos.py']),
+            Stage('parse_replay', 'parse_replay/parse_replay.py',
+                  {'save_path': P, 'n_instance': 1, 'resume': False, 'width': FLAGS.width,
+                   'map_size': FLAGS.map_size},
+                  observations, lambda name: ['sample_frames:'+name])]
+    parsers = [s.name for s in stages]
+    parsed = lambda name: ['{}:{}'.format(parser, name) for parser in parsers]
+
+    if FLAGS.from_observations:
+        # Both read the SampledObservations, GlobalFeatures are never written
+        state_params = {'from_observations': True, 'step_mul': FLAGS.step_mul}
+        global_features = parsed
+        all_global_features = lambda item: sum([all_of(parser)(item) for parser in parsers], [])
+    else:
+        state_params = {}
+        global_features = lambda name: ['replay2global_features:'+name]
+        all_global_features = all_of('replay2global_features')
+        stages.append(
+            Stage('replay2global_features', 'parse_replay/replay2global_features.py',
+                  {'parsed_replay_path': P, 'n_workers': 1, 'step_mul': FLAGS.step_mul},
+                  per_player('GlobalFeatures'), parsed,
+                  sources=['extract_features/global_states.py', 'extract_features/game_state.py',
+                           'preprocess/replay_infos.py']))
+
+    stages += [
+        Stage('replay_stat', 'extract_features/replay_stat.py',
+              dict(state_params, hq_replay_path=os.path.dirname(os.path.abspath(FLAGS.hq_replay_set)),
+                   parsed_replay_path=P),
+              lambda race: [os.path.join(P, 'Stat', race+'.json'), os.path.join(P, 'Stat', race+'_human.json')],
+              all_global_features, per_replay=False, item_flag='race',
+              sources=['extract_features/global_states.py', 'extract_features/game_state.py']),
+        Stage('global_feature_vector', 'extract_features/global_feature_vector.py',
+              dict(state_params, parsed_replay_path=P, n_workers=1),
+              lambda name: [os.path.join(P, 'GlobalFeatureVector', race_vs_race, '*', '*@{}.npz'.format(name))],
+              lambda name: global_features(name) + ['replay_stat:'+race for race in races],
+              sources=['extract_features/game_state.py', 'extract_features/global_states.py',
+                       'preprocess/replay_infos.py'])]
+    if FLAGS.spatial:
+        stages.append(
+            Stage('spatial_feature_tensor', 'extract_features/spatial_feature_tensor.py',
+                  {'parsed_replay_path': P, 'step_mul': FLAGS.step_mul, 'n_workers': 1, 'quantize': FLAGS.quantize},
+                  lambda name: [os.path.join(P, 'SpatialFeatureTensor', race_vs_race, '*', '*@{}@*.npz'.format(name))],
+                  lambda name: parsed(name) + ['replay_stat:'+race for race in races],
+                  sources=['extract_features/game_state.py', 'extract_features/SpatialFeatures.py',
+                           'preprocess/replay_infos.py']))
+    stages.append(
+        Stage('split', 'extract_features/split.py',
+              {'root': os.path.dirname(P), 'parsed_replay_path': os.path.basename(P),
+               'save_path': os.path.abspath(FLAGS.save_path), 'ratio': FLAGS.ratio, 'seed': FLAGS.seed},
+              lambda _: [os.path.join(os.path.abspath(FLAGS.save_path), race_vs_race, '*.json'),
+                         os.path.join(os.path.abspath(FLAGS.save_path), race_vs_race, '*.manifest.npy')],
+              lambda item: sum([all_of(s.name)(item) for s in stages if s.name.endswith(('vector', 'tensor'))], []),
+              sources=['preprocess/replay_infos.py'], per_replay=False))
+
+    return stages
+
+class Builder(object):
+    """
+    Run the stale tasks of the DAG, up to n_workers stage processes at the same time.
+    A task is up to date if its recorded key matches and its outputs still exist
+    """
+    def __init__(self, stages, race_vs_race, races, replays, state_path):
+        self.stages = {s.name: s for s in stages}
+        self.race_vs_race = race_vs_race
+        self.replays = {os.path.basename(p): (p, info) for p, info in replays}
+        self.state_path = state_path
+
+        self.state = {}
+        if os.path.isfile(os.path.join(state_path, 'state.json')):
+            with open(os.path.join(state_path, 'state.json')) as f:
+                self.state = json.load(f)
+        self.source_hashes = {}
+
+        ## Tasks in topological order
+        self.tasks = []
+        for s in stages:
+            items = self.replays if s.per_replay else (races if s.name == 'replay_stat' else [race_vs_race])
+            self.tasks += [(s.name, item) for item in sorted(items)]
+        self.n_chunks = 0
+
+    def __sources_hash__(self, stage):
+        if stage.name not in self.source_hashes:
+            self.source_hashes[stage.name] = [file_hash(os.path.join(ROOT, p)) for p in stage.sources]
+        return self.source_hashes[stage.name]
+
+    def __key__(self, stage, item, outputs):
+        inputs = [outputs[dep] for dep in stage.deps(item) if dep in outputs]
+        if stage.name == 'extract_actions':
+            inputs += [file_hash(p) for p in self.replays[item] if os.path.isfile(p)]
+        data = json.dumps([stage.name, stage.params, self.__sources_hash__(stage), inputs], sort_keys=True)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def __outputs__(self, stage, item):
+        return sorted(sum([glob.glob(pattern) for pattern in stage.outputs(item)], []))
+
+    def __save__(self):
+        path = os.path.join(self.state_path, 'state.json')
+        with open(path+'.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.replace(path+'.tmp', path)
+
+    def __fail__(self, stage, item, failed):
+        # Keep outdated outputs away from the stages downstream, e.g. split
+        failed.add('{}:{}'.format(stage.name, item))
+        self.state.pop('{}:{}'.format(stage.name, item), None)
+        for p in self.__outputs__(stage, item):
+            os.remove(p)
+
+    def __run__(self, stage, items):
+        if stage.per_replay:
+            # race_vs_race is taken from the name of the replays list
+            chunk_path = os.path.join(self.state_path, 'chunks', '{}-{}'.format(stage.name, self.n_chunks))
+            self.n_chunks += 1
+            if not os.path.isdir(chunk_path):
+                os.makedirs(chunk_path)
+            replay_set = os.path.join(chunk_path, self.race_vs_race+'.json')
+            with open(replay_set, 'w') as f:
+                json.dump([list(self.replays[item]) for item in items], f)
+        else:
+            replay_set = os.path.abspath(FLAGS.hq_replay_set)
+
+        command = stage.command(replay_set, items[0])
+        with open(os.path.join(self.state_path, 'logs', stage.name+'.log'), 'a') as log:
+            return subprocess.call(command, cwd=os.path.join(ROOT, os.path.dirname(stage.script)),
+                                   stdout=log, stderr=subprocess.STDOUT)
+
+    def run(self):
+        if os.path.isdir(os.path.join(self.state_path, 'chunks')):
+            shutil.rmtree(os.path.join(self.state_path, 'chunks'))
+        for path in [self.state_path, os.path.join(self.state_path, 'logs')]:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        outputs = {}    # task id -> hashes of its outputs
+        failed = set()
+        report = {name: {'up_to_date': 0, 'built': 0, 'failed': 0} for name in self.stages}
+        pending = list(self.tasks)
+        running = {}
+        with ThreadPoolExecutor(FLAGS.n_workers) as pool:
+            while pending or running:
+                stale = []
+                for stage_name, item in list(pending):
+                    stage = self.stages[stage_name]
+                    task_id = '{}:{}'.format(stage_name, item)
+                    deps = stage.deps(item)
+                    if not all(dep in outputs or dep in failed for dep in deps):
+                        continue
+
+                    pending.remove((stage_name, item))
+                    # Aggregate stages go on with the replays that did build
+                    if (stage.per_replay and any(dep in failed for dep in deps)) or \
+                            not any(dep in outputs for dep in deps) and len(deps) > 0:
+                        self.__fail__(stage, item, failed)
+                        report[stage_name]['failed'] += 1
+                        continue
+                    key = self.__key__(stage, item, outputs)
+                    record = self.state.get(task_id)
+                    if record is not None and record['key'] == key and all(os.path.isfile(p) for p in record['outputs']):
+                        outputs[task_id] = record['outputs']
+                        report[stage_name]['up_to_date'] += 1
+                        continue
+                    stale.append((stage, item, key))
+
+                ## Submit stale tasks, chunked per stage
+                for stage in self.stages.values():
+                    items = [(item, key) for s, item, key in stale if s is stage]
+                    size = FLAGS.chunk_size if stage.per_replay else 1
+                    for i in range(0, len(items), size):
+                        chunk = items[i:i+size]
+                        # Stale outputs are rebuilt from scratch, the SC2 stages run with resume=False
+                        for item, _ in chunk:
+                            for p in self.__outputs__(stage, item):
+                                os.remove(p)
+                        running[pool.submit(self.__run__, stage, [item for item, _ in chunk])] = (stage, chunk)
+
+                if len(running) == 0:
+                    # Up to date tasks may have unblocked others
+                    continue
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, chunk = running.pop(future)
+                    ret = future.result()
+                    for item, key in chunk:
+                        task_id = '{}:{}'.format(stage.name, item)
+                        paths = self.__outputs__(stage, item)
+                        if ret != 0 or len(paths) == 0:
+                            self.__fail__(stage, item, failed)
+                            report[stage.name]['failed'] += 1
+                            continue
+                        outputs[task_id] = {p: file_hash(p) for p in paths}
+                        self.state[task_id] = {'key': key, 'outputs': outputs[task_id]}
+                        report[stage.name]['built'] += 1
+                    self.__save__()
+
+        return report
+
+def main(argv):
+    with open(FLAGS.hq_replay_set) as f:
+        replays = sorted(json.load(f))
+    race_vs_race = os.path.basename(FLAGS.hq_replay_set).split('.')[0]
+    races = sorted(set(race_vs_race.split('_vs_')))
+
+    state_path = FLAGS.state_path or os.path.join(FLAGS.parsed_replay_path, '.build')
+    builder = Builder(build_stages(race_vs_race, races, replays), race_vs_race, races, replays, state_path)
+    report = builder.run()
+
+    for name, counts in report.items():
+        print('{}: {up_to_date} up to date, {built} built, {failed} failed'.format(name, **counts))
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,27 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+from absl import app
+from absl import flags
+
+from replay_infos import build_index, import_json
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(name='infos_path', default='../replays_infos',
+                    help='Path of the replay infos store')
+flags.DEFINE_string(name='json_path', default=None,
+                    help='Infos stored as one JSON file per replay to import [None indicate indexing the store only]')
+flags.DEFINE_integer(name='n_workers', default=4,
+                     help='# of shards to index at the same time')
+
+def main(argv):
+    if not os.path.isdir(FLAGS.infos_path):
+        os.makedirs(FLAGS.infos_path)
+    if FLAGS.json_path is not None:
+        import_json(FLAGS.json_path, FLAGS.infos_path)
+    print('{} replays'.format(len(build_index(FLAGS.infos_path, FLAGS.n_workers))))
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,85 @@
+import os
+import traceback
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+class Call(object):
+    """
+    func(item), or func(*item) when star, returning (index, error, result) instead of raising
+    """
+    def __init__(self, func, star=False):
+        self.func = func
+        self.star = star
+
+    def __call__(self, indexed_item):
+        i, item = indexed_item
+        try:
+            return i, None, self.func(*item) if self.star else self.func(item)
+        except Exception:
+            return i, traceback.format_exc(), None
+
+class Executor(object):
+    """
+    Run a function over items in n_workers processes [0 indicate all cores], chunk_size items per task
+    [0 indicate automatic]. initializer(*initargs) sets up every worker once, e.g. to load the Stat files.
+    map() yields the results, in the order of the items when ordered; the items raising are kept in errors
+    as (item, traceback) without stopping the others
+    """
+    def __init__(self, n_workers=0, chunk_size=0, ordered=False, initializer=None, initargs=(), desc='#Replay'):
+        self.n_workers = n_workers or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+        self.initializer = initializer
+        self.initargs = initargs
+        self.desc = desc
+        self.n_items = 0
+        self.errors = []
+
+    def map(self, func, items, star=False):
+        items = list(items)
+        self.n_items += len(items)
+        call = Call(func, star)
+        # A few tasks per worker, as Pool.map does
+        chunk_size = self.chunk_size or max(1, len(items) // (4 * self.n_workers))
+
+        with tqdm(total=len(items), desc=self.desc) as pbar:
+            if self.n_workers == 1 or len(items) <= 1:
+                if self.initializer is not None:
+                    self.initializer(*self.initargs)
+                results = map(call, enumerate(items))
+                for result in self.__collect__(results, items, pbar):
+                    yield result
+            else:
+                with Pool(self.n_workers, self.initializer, self.initargs) as p:
+                    imap = p.imap if self.ordered else p.imap_unordered
+                    for result in self.__collect__(imap(call, enumerate(items), chunk_size), items, pbar):
+                        yield result
+
+    def starmap(self, func, items):
+        return self.map(func, items, star=True)
+
+    def __collect__(self, results, items, pbar):
+        for i, error, result in results:
+            pbar.update()
+            if error is not None:
+                self.errors.append((items[i], error))
+                continue
+            yield result
+
+    def run(self, func, items, star=False):
+        """
+        map() for its side effects only
+        """
+        for _ in self.map(func, items, star):
+            pass
+
+    def report(self):
+        """
+        Print the failed items, returns the exit code of the stage
+        """
+        for item, error in self.errors:
+            print('{}:\n{}'.format(item, error))
+        if len(self.errors) > 0:
+            print('{}/{} failed'.format(len(self.errors), self.n_items))
+        return int(len(self.errors) > 0)
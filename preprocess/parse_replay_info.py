@@ -4,66 +4,43 @@ from __future__ import print_function
 
 import os
 import sys
-import time
-import json
-import signal
-import threading
-import queue as Queue
 from absl import app
 from absl import flags
-import multiprocessing
 from itertools import chain
-from future.builtins import range
-from google.protobuf.json_format import MessageToJson
 
 from pysc2 import run_configs
 
+import replay_infos
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'parse_replay'))
+from controller_pool import ControllerPool, summary
+
 FLAGS = flags.FLAGS
 flags.DEFINE_string(name='replays_paths', default='./;',
                     help='Paths for replays, split by ;')
 flags.DEFINE_string(name='save_path', default='../replays_infos',
-                    help='Path for saving results')
+                    help='Path of the replay infos store')
 
 flags.DEFINE_integer(name='n_instance', default=4,
                      help='# of processes to run')
-flags.DEFINE_integer(name='batch_size', default=300,
-                     help='# of replays to process in one iter')
-
-class ReplayProcessor(multiprocessing.Process):
-    """A Process that pulls replays and processes them."""
-    def __init__(self, run_config, replay_queue, counter, total_num):
-        super(ReplayProcessor, self).__init__()
-        self.run_config = run_config
-        self.replay_queue = replay_queue
-        self.counter = counter
-        self.total_num = total_num
+flags.DEFINE_integer(name='batch_size', default=0,
+                     help='# of replays to process before restarting the game [0 indicate never]')
+flags.DEFINE_float(name='timeout', default=None,
+                   help='Seconds before giving up a replay')
 
-    def run(self):
-        signal.signal(signal.SIGTERM, lambda a, b: sys.exit())  # Kill thread upon termination signal
-        while True:
-            with self.run_config.start() as controller: # Get SC2 run configuration
-                for _ in range(FLAGS.batch_size):
-                    try:
-                        replay_path = self.replay_queue.get() # Get next replay
-                    except Queue.Empty:
-                        return # No more replays to process
-                    try:
-                        replay_data = self.run_config.replay_data(replay_path) 
-                        info = controller.replay_info(replay_data) # Get high level replay info
+def processor(worker_id, run_config):
+    """
+    Appends the infos of the replays processed by a worker to its own shard
+    """
+    shard = replay_infos.shard_path(FLAGS.save_path, worker_id)
+    replay_infos.repair(shard) # A replaced worker may have been killed while appending
+    f = open(shard, 'ab')
 
-                        info_json = MessageToJson(info)
-                        with open(os.path.join(FLAGS.save_path, os.path.basename(replay_path)), 'w') as f: # Save replay info
-                            json.dump({'info': info_json, 'path':replay_path}, f)
-                        with self.counter.get_lock():
-                            self.counter.value += 1
-                            print('Processing {}/{} ...'.format(self.counter.value, self.total_num))
-                    finally:
-                        self.replay_queue.task_done()
-
-def replay_queue_filler(replay_queue, replay_list):
-    """A thread that fills the replay_queue with replay paths."""
-    for replay_path in replay_list:
-        replay_queue.put(replay_path)
+    def process(controller, replay_path):
+        replay_data = run_config.replay_data(replay_path)
+        info = controller.replay_info(replay_data) # Get high level replay info
+        replay_infos.append(f, replay_path, info) # Save replay info
+    return process
 
 def main(argv):
     if not os.path.isdir(FLAGS.save_path):
@@ -71,27 +48,20 @@ def main(argv):
 
     run_config = run_configs.get()
 
+    replay_list = sorted(chain(*[run_config.replay_paths(path)
+                                    for path in FLAGS.replays_paths.split(';')
+                                        if len(path.strip()) > 0]))
+    stats = None
     try:
-        # Create controller thread for allocating replays
-        replay_list = sorted(chain(*[run_config.replay_paths(path)
-                                        for path in FLAGS.replays_paths.split(';')
-                                            if len(path.strip()) > 0]))
-        replay_queue = multiprocessing.JoinableQueue(FLAGS.n_instance * 10)
-        replay_queue_thread = threading.Thread(target=replay_queue_filler,
-                                               args=(replay_queue, replay_list))
-        replay_queue_thread.daemon = True
-        replay_queue_thread.start()
-
-        counter = multiprocessing.Value('i', 0)
-        for _ in range(FLAGS.n_instance): # Create threads for processing
-            p = ReplayProcessor(run_config, replay_queue, counter, len(replay_list))
-            p.daemon = True
-            p.start()
-            time.sleep(1)   # Stagger startups, otherwise they seem to conflict somehow
-
-        replay_queue.join() # Wait for the queue to empty.
+        stats = ControllerPool(run_config, processor, FLAGS.n_instance,
+                               timeout=FLAGS.timeout, max_replays=FLAGS.batch_size).run(replay_list)
+        print(summary(stats))
+        for replay_path, error in sorted(stats['errors'].items()):
+            print('{}: {}'.format(replay_path, error))
     except KeyboardInterrupt:
         print("Caught KeyboardInterrupt, exiting.")
+    replay_infos.build_index(FLAGS.save_path, FLAGS.n_instance) # Index the fields used by the later steps
+    return int(stats is None or stats['failed'] + stats['unprocessed'] > 0)
 
 if __name__ == '__main__':
     app.run(main)
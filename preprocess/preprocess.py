@@ -4,20 +4,17 @@ from __future__ import print_function
 
 import os
 import json
-import glob
+import numpy as np
 from absl import app
 from absl import flags
-from tqdm import tqdm
-
-from google.protobuf.json_format import Parse
 
 from pysc2 import run_configs
-from s2clientprotocol import sc2api_pb2 as sc_pb
-from s2clientprotocol import common_pb2 as common_pb
+
+from replay_infos import index_path
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string(name='infos_path', default='../replays_infos',
-                    help='Paths for infos of replays')
+                    help='Path of the replay infos store')
 flags.DEFINE_string(name='save_path', default='../high_quality_replays',
                     help='Path for saving results')
 
@@ -30,57 +27,74 @@ flags.DEFINE_integer(name='min_apm', default=10,
 flags.DEFINE_integer(name='min_mmr', default=1000,
                      help='Min MMR')
 
-def valid_replay(info, ping):
-    """Make sure the replay isn't corrupt, and is worth looking at."""
-    if info.HasField("error"):
-        return False
-    if info.base_build != ping.base_build:
-        return False
-    if info.game_duration_loops < FLAGS.min_duration:
-        return False
-    if FLAGS.max_duration is not None and info.game_duration_loops > FLAGS.max_duration:
-        return  False
-    if len(info.player_info) != 2:
-        return False
-
-    for p in info.player_info:
-        if p.player_apm < FLAGS.min_apm or p.player_mmr < FLAGS.min_mmr:
-            # Low APM = player just standing around.
-            # Low MMR = corrupt replay or player who is weak.
-            return False
-        if p.player_result.result not in {1, 2}:
-            return False
-
-    return True
+flags.DEFINE_integer(name='base_build', default=None,
+                     help='Base build of the replays to keep [None indicate the build of the installed game]')
+flags.DEFINE_integer(name='n_bins', default=10,
+                     help='# of bins of the reported histograms')
+
+def valid_replays(index, base_build):
+    """Make sure the replays aren't corrupt. Returns the mask of replays worth looking at."""
+    valid = ~index['error'] & (index['base_build'] == base_build) & (index['n_players'] == 2)
+    # Neither a win nor a loss, e.g. ties and undecided games
+    return valid & np.all(np.isin(index['result'], [1, 2]), axis=1)
+
+def thresholds(index):
+    """Masks of replays passing each cutoff."""
+    masks = {'min_duration': index['game_duration_loops'] >= FLAGS.min_duration,
+             # Low APM = player just standing around.
+             'min_apm': np.all(index['apm'] >= FLAGS.min_apm, axis=1),
+             # Low MMR = corrupt replay or player who is weak.
+             'min_mmr': np.all(index['mmr'] >= FLAGS.min_mmr, axis=1)}
+    if FLAGS.max_duration is not None:
+        masks['max_duration'] = index['game_duration_loops'] <= FLAGS.max_duration
+    return masks
+
+def histograms(index):
+    """Histograms of MMR/APM (the lower of both players) and duration, to tune the cutoffs."""
+    result = {}
+    for name, values in [('mmr', index['mmr'].min(axis=1)), ('apm', index['apm'].min(axis=1)),
+                         ('duration', index['game_duration_loops'])]:
+        counts, edges = np.histogram(values, bins=FLAGS.n_bins)
+        result[name] = {'counts': counts.tolist(), 'edges': edges.tolist()}
+    return result
 
 def main(argv):
     if not os.path.isdir(FLAGS.save_path):
         os.makedirs(FLAGS.save_path)
-    replay_infos = glob.glob(os.path.join(FLAGS.infos_path, '*.SC2Replay'))
+    index = np.load(index_path(FLAGS.infos_path))
 
-    run_config = run_configs.get()
-    with run_config.start() as controller:
-        ping = controller.ping()
+    base_build = FLAGS.base_build
+    if base_build is None:
+        run_config = run_configs.get()
+        with run_config.start() as controller:
+            base_build = controller.ping().base_build
 
-    result = {}
-    pbar = tqdm(total=len(replay_infos), desc='#Replay')
-    for info_path in replay_infos: # Loop through all replay infos
-        with open(info_path) as f:
-            info = json.load(f)
-
-        proto = Parse(info['info'], sc_pb.ResponseReplayInfo()) # Parse info for current replay
-        if valid_replay(proto, ping):
-            players_info = proto.player_info
-            races = '_vs_'.join(sorted(common_pb.Race.Name(player_info.player_info.race_actual) # Create the matchup
-                                       for player_info in players_info))
-            if races not in result:
-                result[races] = []
-            result[races].append((info['path'], info_path)) # Save based on race vs race
-        pbar.update()
-
-    for k, v in result.items():
-        with open(os.path.join(FLAGS.save_path, k+'.json'), 'w') as f:
-            json.dump(v, f)
+    index = index[valid_replays(index, base_build)]
+    masks = thresholds(index)
+    stats = {'valid': len(index), 'histograms': histograms(index),
+             'removed': {k: int(np.sum(~v)) for k, v in masks.items()}}
+    index = index[np.logical_and.reduce(list(masks.values()))]
+    stats['kept'] = len(index)
+
+    # Create the matchup
+    matchups = np.where(index['race'][:, 0] <= index['race'][:, 1],
+                        np.char.add(np.char.add(index['race'][:, 0], '_vs_'), index['race'][:, 1]),
+                        np.char.add(np.char.add(index['race'][:, 1], '_vs_'), index['race'][:, 0]))
+    stats['matchups'] = {}
+    for races in np.unique(matchups):
+        replays = sorted(index['path'][matchups == races].tolist())
+        stats['matchups'][str(races)] = len(replays)
+        with open(os.path.join(FLAGS.save_path, str(races)+'.json'), 'w') as f:
+            json.dump([(path, FLAGS.infos_path) for path in replays], f) # Save based on race vs race
+
+    with open(os.path.join(FLAGS.save_path, 'stats.json'), 'w') as f:
+        json.dump(stats, f, indent=2)
+
+    for name, hist in stats['histograms'].items():
+        print(name)
+        for count, low, high in zip(hist['counts'], hist['edges'][:-1], hist['edges'][1:]):
+            print('  [{:8.0f}, {:8.0f}) {:8d}'.format(low, high, count))
+    print('{valid} valid replays, removed by {removed}, {kept} kept: {matchups}'.format(**stats))
 
 if __name__ == '__main__':
     app.run(main)
@@ -0,0 +1,164 @@
+import os
+import glob
+import json
+import struct
+import functools
+import numpy as np
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+from s2clientprotocol import sc2api_pb2 as sc_pb
+from s2clientprotocol import common_pb2 as common_pb
+
+# Every record is [path length, info length] as little-endian uint32, the replay path and the serialized ResponseReplayInfo
+header = struct.Struct('<II')
+
+# One row per replay, players padded to 2
+index_fields = [('path', 'U512'), ('shard', 'i4'), ('offset', 'i8'), ('length', 'i4'),
+                ('error', '?'), ('base_build', 'i4'), ('game_duration_loops', 'i4'), ('map_name', 'U128'),
+                ('n_players', 'i1'), ('player_id', 'i1', 2), ('race', 'U8', 2), ('result', 'i1', 2),
+                ('mmr', 'i4', 2), ('apm', 'i4', 2)]
+
+def shard_path(save_path, i):
+    return os.path.join(save_path, 'infos-{}.bin'.format(i))
+
+def shard_ids(save_path):
+    return sorted(int(os.path.basename(p)[len('infos-'):-len('.bin')])
+                    for p in glob.glob(os.path.join(save_path, 'infos-*.bin')))
+
+def index_path(save_path):
+    return os.path.join(save_path, 'index.npy')
+
+def append(f, replay_path, info):
+    """
+    Append one record to the shard opened as f, flushed so that other processes can index it
+    """
+    path, data = replay_path.encode(), info.SerializeToString()
+    f.write(header.pack(len(path), len(data)) + path + data)
+    f.flush()
+
+def records(shard):
+    """
+    (replay path, offset, length) of the info of every complete record in a shard
+    """
+    with open(shard, 'rb') as f:
+        offset = 0
+        while True:
+            head = f.read(header.size)
+            if len(head) < header.size:
+                return
+            path_length, length = header.unpack(head)
+            path = f.read(path_length)
+            f.seek(length, 1)
+            offset += header.size + path_length
+            if offset + length > os.fstat(f.fileno()).st_size:
+                return  # Truncated by a crash while appending
+            yield path.decode(), offset, length
+            offset += length
+
+def repair(shard):
+    """
+    Truncate a record torn by a crash at the end of a shard, before appending to it
+    """
+    if not os.path.isfile(shard):
+        return
+    end = 0
+    for _, offset, length in records(shard):
+        end = offset + length
+    if end < os.path.getsize(shard):
+        with open(shard, 'r+b') as f:
+            f.truncate(end)
+
+def row(info, path, shard, offset, length):
+    players = list(info.player_info)[:2]
+    return (path, shard, offset, length, info.HasField('error'), info.base_build, info.game_duration_loops,
+            info.map_name, len(info.player_info),
+            [p.player_info.player_id for p in players] + [0]*(2-len(players)),
+            [common_pb.Race.Name(p.player_info.race_actual) for p in players] + ['']*(2-len(players)),
+            [p.player_result.result for p in players] + [0]*(2-len(players)),
+            [p.player_mmr for p in players] + [0]*(2-len(players)),
+            [p.player_apm for p in players] + [0]*(2-len(players)))
+
+def index_shard(save_path, i):
+    rows = []
+    with open(shard_path(save_path, i), 'rb') as f:
+        for path, offset, length in records(shard_path(save_path, i)):
+            f.seek(offset)
+            rows.append(row(sc_pb.ResponseReplayInfo.FromString(f.read(length)), path, i, offset, length))
+    return rows
+
+def build_index(save_path, n_workers=1):
+    """
+    Index the records of every shard under save_path, n_workers shards at a time.
+    The latest record of a replay wins
+    """
+    rows = {}
+    with Pool(n_workers) as p:
+        for shard_rows in tqdm(p.imap(functools.partial(index_shard, save_path), shard_ids(save_path)),
+                               total=len(shard_ids(save_path)), desc='#Shard'):
+            rows.update((os.path.basename(r[0]), r) for r in shard_rows)
+
+    index = np.array([rows[k] for k in sorted(rows)], dtype=index_fields)
+    with open(index_path(save_path)+'.tmp', 'wb') as f:
+        np.save(f, index)
+    os.replace(index_path(save_path)+'.tmp', index_path(save_path))
+    return index
+
+def import_json(json_path, save_path):
+    """
+    Convert the infos written as one JSON file per replay by earlier versions of parse_replay_info.py
+    """
+    from google.protobuf.json_format import Parse
+
+    with open(shard_path(save_path, max(shard_ids(save_path) + [-1]) + 1), 'ab') as f:
+        for info_path in tqdm(sorted(glob.glob(os.path.join(json_path, '*.SC2Replay'))), desc='#Replay'):
+            with open(info_path) as g:
+                info = json.load(g)
+            append(f, info['path'], Parse(info['info'], sc_pb.ResponseReplayInfo()))
+
+class ReplayInfos(object):
+    """
+    Replay infos written by parse_replay_info.py, looked up by replay name.
+    fields() reads the index only, info() decodes the whole ResponseReplayInfo
+    """
+    def __init__(self, save_path):
+        self.save_path = save_path
+        self.index = np.load(index_path(save_path), mmap_mode='r')
+        self.rows = {os.path.basename(p): i for i, p in enumerate(self.index['path'])}
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, replay_path):
+        return os.path.basename(replay_path) in self.rows
+
+    def fields(self, replay_path):
+        return self.index[self.rows[os.path.basename(replay_path)]]
+
+    def players(self, replay_path):
+        """
+        [(player_id, race, result)] of every player
+        """
+        fields = self.fields(replay_path)
+        return [(int(fields['player_id'][i]), str(fields['race'][i]), int(fields['result'][i]))
+                    for i in range(min(2, fields['n_players']))]
+
+    def info(self, replay_path):
+        fields = self.fields(replay_path)
+        shard = int(fields['shard'])
+        if shard not in self.shards:
+            self.shards[shard] = open(shard_path(self.save_path, shard), 'rb')
+        self.shards[shard].seek(int(fields['offset']))
+        return sc_pb.ResponseReplayInfo.FromString(self.shards[shard].read(int(fields['length'])))
+
+    def close(self):
+        for f in self.shards.values():
+            f.close()
+        self.shards = {}
+
+@functools.lru_cache(maxsize=None)
+def load(save_path):
+    # Replay lists store the path of the store next to every replay
+    return ReplayInfos(save_path)
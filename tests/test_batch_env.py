@@ -0,0 +1,80 @@
+import os
+import json
+
+import numpy as np
+import pytest
+
+from data_loader.BatchEnv import BatchGlobalFeatureEnv, BatchSpatialEnv
+from benchmarks.synthetic import generate
+
+def run(env_cls, split, root, out=None, step_kwargs={}, **kwargs):
+    """
+    Every batch of one epoch, copied out of the buffers of out
+    """
+    env = env_cls()
+    env.init(split, root, 'Terran', 'Terran', n_replays=3, n_steps=4, epochs=1, seed=0, **kwargs)
+    batches = []
+    while True:
+        env_return = env.step(out=out, **step_kwargs)
+        if env_return is None:
+            break
+        result, reset = env_return
+        if out is not None:
+            assert result is out
+        batches.append(([np.array(r) for r in result], np.array(reset)))
+    env.close()
+    return batches
+
+@pytest.fixture(scope='module')
+def quantized(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('quantized'))
+    return generate(root, n_replays=5, min_length=7, max_length=30, spatial=True, quantize=True, density=0.01), root
+
+@pytest.mark.parametrize('env_cls', [BatchGlobalFeatureEnv, BatchSpatialEnv])
+@pytest.mark.parametrize('packing', [False, True])
+@pytest.mark.parametrize('step_kwargs', [{}, {'reward': False, 'action': True, 'score': True}])
+def test_out_buffers(quantized, env_cls, packing, step_kwargs):
+    split, root = quantized
+    expected = run(env_cls, split, root, step_kwargs=step_kwargs, packing=packing)
+
+    # Filled with garbage, padding has to be written as well
+    out = [np.full(r.shape, 7, dtype=np.float32) for r in expected[0][0]]
+    batches = run(env_cls, split, root, out=out, step_kwargs=step_kwargs, packing=packing)
+
+    assert len(batches) == len(expected)
+    for (result, reset), (expected_result, expected_reset) in zip(batches, expected):
+        assert np.array_equal(reset, expected_reset)
+        for r, e in zip(result, expected_result):
+            np.testing.assert_allclose(r, e.astype(np.float32), rtol=1e-6)
+
+def test_dequantize(quantized):
+    split, root = quantized
+    channels = ('screen', 'minimap', 'unit_type')
+    raw = run(BatchSpatialEnv, split, root, channels=channels, dequantize=False)
+    batches = run(BatchSpatialEnv, split, root, channels=channels)
+
+    # S = S_raw / scale, with the scales stored next to the layers
+    with open(split) as f:
+        S_path = os.path.join(root, json.load(f)[0]['Terran'][0]['spatial_path_S'])
+    scale = []
+    for c in channels:
+        with np.load(S_path.replace('@S.npz', '@S_{}.npz'.format(c))) as f:
+            scale.extend(f['scale'])
+    scale = np.asarray(scale, dtype=np.float64)[:, None, None]
+
+    assert len(batches) == len(raw)
+    for (result, _), (raw_result, _) in zip(batches, raw):
+        assert raw_result[0].dtype.kind == 'u' and result[0].dtype == np.float32
+        assert np.all((result[0] >= 0) & (result[0] <= 1))
+        np.testing.assert_allclose(result[0], raw_result[0] / scale, rtol=1e-6)
+        for r, e in zip(result[1:], raw_result[1:]):
+            assert np.array_equal(r, e)
+
+def test_quantized_scales_are_checked(quantized):
+    split, root = quantized
+
+    class OtherScales(BatchSpatialEnv):
+        channel_scales = dict(BatchSpatialEnv.channel_scales, unit_type=[1000])
+
+    with pytest.raises(ValueError):
+        run(OtherScales, split, root)
@@ -0,0 +1,53 @@
+import os
+import re
+import sys
+import glob
+import json
+import subprocess
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A few preprocessed replays, [[replay_path, infos_path], ...] named [RACE]_vs_[RACE].json as by preprocess.py
+REPLAY_SET = os.environ.get('MSC_TEST_REPLAY_SET')
+
+def build(replay_set, tmp_path, *flags):
+    output = subprocess.check_output([sys.executable, 'build.py', '--hq_replay_set', replay_set,
+                                      '--parsed_replay_path', str(tmp_path / 'parsed_replays'),
+                                      '--save_path', str(tmp_path / 'train_val_test'),
+                                      '--n_workers', '2', '--chunk_size', '2'] + list(flags),
+                                     cwd=os.path.join(ROOT, 'pipeline'), universal_newlines=True)
+    report = {}
+    for name, up_to_date, built, failed in re.findall(r'^(\w+): (\d+) up to date, (\d+) built, (\d+) failed$',
+                                                      output, re.M):
+        report[name] = {'up_to_date': int(up_to_date), 'built': int(built), 'failed': int(failed)}
+    return report
+
+@pytest.mark.skipif(REPLAY_SET is None, reason='Needs SC2 and MSC_TEST_REPLAY_SET')
+def test_chain_end_to_end(tmp_path):
+    pytest.importorskip('pysc2')
+    with open(REPLAY_SET) as f:
+        n_replays = len(json.load(f))
+    race_vs_race = os.path.basename(REPLAY_SET).split('.')[0]
+
+    # extract_actions -> sample_frames -> parse_replay -> replay2global_features -> ... -> split
+    report = build(REPLAY_SET, tmp_path, '--spatial')
+    assert set(report) == {'extract_actions', 'sample_frames', 'parse_replay', 'replay2global_features',
+                           'replay_stat', 'global_feature_vector', 'spatial_feature_tensor', 'split'}
+    for name, counts in report.items():
+        assert counts['failed'] == 0, name
+        assert counts['built'] > 0, name
+    for name in ['extract_actions', 'sample_frames', 'parse_replay', 'global_feature_vector']:
+        assert report[name]['built'] == n_replays, name
+
+    parsed = tmp_path / 'parsed_replays'
+    for folder in ['SampledFrames', 'SampledObservations', 'GlobalFeatures', 'GlobalFeatureVector',
+                   'SpatialFeatureTensor']:
+        assert len(glob.glob(str(parsed / folder / race_vs_race / '**' / '*.SC2Replay*'), recursive=True)) > 0, folder
+    assert len(glob.glob(str(tmp_path / 'train_val_test' / race_vs_race / '*.json'))) > 0
+
+    # Nothing changed, nothing is rebuilt
+    report = build(REPLAY_SET, tmp_path, '--spatial')
+    for name, counts in report.items():
+        assert counts['built'] == 0 and counts['failed'] == 0, name
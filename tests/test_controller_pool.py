@@ -0,0 +1,57 @@
+import os
+import sys
+import functools
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'parse_replay'))
+from controller_pool import ControllerPool, FakeRunConfig
+
+def processor(pid_path, worker_id, run_config):
+    def process(controller, replay_path):
+        controller.replay_info(run_config.replay_data(replay_path))
+        # Which process handled the replay
+        with open(os.path.join(pid_path, replay_path), 'w') as f:
+            f.write(str(os.getpid()))
+    return process
+
+def run(tmp_path, replay_list, start_failures=0, **kwargs):
+    pool = ControllerPool(FakeRunConfig(start_failures), functools.partial(processor, str(tmp_path)), 1,
+                          backoff=0.01, stagger=0., **kwargs)
+    return pool.run(replay_list)
+
+def pid(tmp_path, replay_path):
+    with open(str(tmp_path / replay_path)) as f:
+        return int(f.read())
+
+def test_failures(tmp_path):
+    # One worker, so the replays run in order
+    stats = run(tmp_path, ['crash0', 'ok0', 'error0', 'ok1', 'hang0', 'ok2', 'ok3'], start_failures=1, timeout=1.)
+
+    assert stats['done'] == 4
+    assert stats['failed'] == 3
+    assert stats['timeouts'] == 1
+    # The game failing to start, then the crashed game failing the ping before ok0
+    assert stats['restarts'] == 2
+    assert stats['unprocessed'] == 0
+    assert sorted(stats['errors']) == ['crash0', 'error0', 'hang0']
+    assert stats['errors']['hang0'] == 'Timeout'
+    assert 'Game crashed' in stats['errors']['crash0']
+    assert 'Corrupt replay' in stats['errors']['error0']
+    assert sorted(stats['times']) == ['ok0', 'ok1', 'ok2', 'ok3']
+
+    # The hung worker is killed and replaced by a new process, which takes the remaining replays
+    assert pid(tmp_path, 'ok0') == pid(tmp_path, 'ok1')
+    assert pid(tmp_path, 'ok2') == pid(tmp_path, 'ok3')
+    assert pid(tmp_path, 'ok2') != pid(tmp_path, 'ok1')
+
+def test_makespan_ends_with_timeout(tmp_path):
+    stats = run(tmp_path, ['ok0', 'hang0'], timeout=1.)
+
+    assert stats['done'] == 1 and stats['timeouts'] == 1
+    assert stats['makespan'] >= 1.
+
+def test_unprocessed(tmp_path):
+    stats = run(tmp_path, ['ok0', 'ok1'], start_failures=10, max_restarts=1)
+
+    assert stats['done'] == 0 and stats['failed'] == 0
+    assert stats['restarts'] == 1
+    assert stats['unprocessed'] == 2
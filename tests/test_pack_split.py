@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+
+import numpy as np
+import pytest
+
+from data_loader.BatchEnv import BatchGlobalFeatureEnv, load_packed_split
+from benchmarks.synthetic import generate
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'extract_features'))
+import pack_split
+from pack_split import FLAGS
+
+def pack(split, root, columnar):
+    FLAGS(['pack_split.py', '--root', root, '--columnar={}'.format(columnar)])
+    with open(split) as f:
+        replays = json.load(f)
+    name = 'columnar' if columnar else 'rows'
+    index_path = os.path.join(root, name+'.json')
+    pack_split.pack(replays, 'Terran', 'Terran', os.path.join(root, name+'.bin'), index_path)
+    return index_path
+
+def run(split, root, **kwargs):
+    env = BatchGlobalFeatureEnv()
+    env.init(split, root, 'Terran', 'Terran', n_replays=3, n_steps=4, epochs=1, seed=0, **kwargs)
+    batches = []
+    while True:
+        env_return = env.step(action=True, score=True)
+        if env_return is None:
+            break
+        batches.append([np.array(r) for r in env_return[0]])
+    env.close()
+    return batches
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_packed_matches_unpacked(tmp_path, columnar):
+    root = str(tmp_path)
+    split = generate(root, n_replays=5, min_length=7, max_length=30, density=0.1)
+    packed_path = pack(split, root, columnar)
+
+    expected = run(split, root)
+    batches = run(split, root, packed_path=packed_path)
+    assert len(batches) == len(expected)
+    for result, expected_result in zip(batches, expected):
+        for r, e in zip(result, expected_result):
+            # Stored as float32
+            np.testing.assert_allclose(r, e, rtol=1e-6)
+
+    # Windows of the packed split are the same rows
+    env = BatchGlobalFeatureEnv()
+    env.init(split, root, 'Terran', 'Terran', packed_path=packed_path)
+    env.close()
+    for path in env.replays:
+        replay_dict = env.__load_replay__(path)
+        window = env.__load_window__(path, 2, 5)
+        for k, v in window.items():
+            assert np.array_equal(v, replay_dict[k][2:5])
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_empty_split(tmp_path, columnar):
+    root = str(tmp_path)
+    split = os.path.join(root, 'empty.json')
+    with open(split, 'w') as f:
+        json.dump([], f)
+    packed_path = pack(split, root, columnar)
+
+    with open(packed_path) as f:
+        index = json.load(f)
+    assert index['n_rows'] == 0 and index['n_features'] == 15+738
+    assert load_packed_split(packed_path, root) == {}
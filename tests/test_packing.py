@@ -0,0 +1,54 @@
+import json
+
+import numpy as np
+
+from data_loader.BatchEnv import BatchEnv
+
+class FrameEnv(BatchEnv):
+    """
+    Replays of the given lengths, frame t of a replay holds t+1 so that padding is 0
+    """
+    def __post_init__(self):
+        pass
+
+    def __generate_replay_list__(self, replays, root, race):
+        return list(replays)
+
+    def __replay_length__(self, length):
+        return length
+
+    def __load_replay__(self, length):
+        return {'frame': np.arange(1, length+1)}
+
+    def __post_process__(self, result, **kwargs):
+        return [result['frame']]
+
+def test_packing_returns_every_frame(tmp_path):
+    lengths = [7, 3, 12, 5, 1, 9, 4]
+    path = str(tmp_path / 'lengths.json')
+    with open(path, 'w') as f:
+        json.dump(lengths, f)
+
+    for n_replays, n_steps in [(1, 4), (3, 4), (4, 5), (8, 3)]:
+        env = FrameEnv()
+        env.init(path, None, None, None, n_replays=n_replays, n_steps=n_steps, epochs=2, seed=0, packing=True)
+
+        n_frames, n_padding = 0, 0
+        while True:
+            env_return = env.step()
+            if env_return is None:
+                break
+            (frames,), reset = env_return
+            assert frames.shape == (n_steps, n_replays)
+            n_frames += int(np.sum(frames > 0))
+            n_padding += int(np.sum(frames == 0))
+            # A replay starts at 1 and counts up to its end
+            for i in range(n_replays):
+                column = frames[:, i][frames[:, i] > 0]
+                starts = reset[:, i][frames[:, i] > 0]
+                assert np.all((column[1:] == column[:-1] + 1) | starts[1:])
+                assert np.all(column[starts] == 1)
+        env.close()
+
+        assert n_frames == 2*sum(lengths) == env.step_count()
+        assert n_padding == env.padding_stats()['padding']
@@ -0,0 +1,68 @@
+import json
+
+import numpy as np
+
+from data_loader.PrefetchEnv import PrefetchBatchEnv, balance
+from test_packing import FrameEnv
+
+LENGTHS = [7, 3, 12, 5, 1, 9, 4, 20, 6]
+
+def write_lengths(tmp_path):
+    path = str(tmp_path / 'lengths.json')
+    with open(path, 'w') as f:
+        json.dump(LENGTHS, f)
+    return path
+
+def test_ranks_split_every_epoch(tmp_path):
+    path = write_lengths(tmp_path)
+    world_size, epochs = 3, 2
+
+    envs, n_batches = [], []
+    for rank in range(world_size):
+        env = FrameEnv()
+        env.init(path, None, None, None, n_replays=2, n_steps=4, epochs=epochs, seed=0, rank=rank,
+                 world_size=world_size)
+        n = 0
+        while env.step() is not None:
+            n += 1
+        env.close()
+        envs.append(env)
+        n_batches.append(n)
+
+    # Every rank stops after the same # of batches
+    assert len(set(n_batches)) == 1 and n_batches[0] > 0
+    for epoch in range(epochs):
+        shards = [env.shards[epoch] for env in envs]
+        # Disjoint shards covering the split, with balanced # of frames
+        assert sorted(sum(shards, [])) == sorted(LENGTHS)
+        frames = [sum(shard) for shard in shards]
+        assert max(frames) - min(frames) <= max(LENGTHS)
+
+def test_balance():
+    shards = balance(LENGTHS, 3)
+    assert sorted(sum(shards, [])) == list(range(len(LENGTHS)))
+    frames = [sum(LENGTHS[idx] for idx in shard) for shard in shards]
+    assert max(frames) - min(frames) <= max(LENGTHS)
+
+def test_prefetch_returns_every_frame(tmp_path):
+    path = write_lengths(tmp_path)
+    env = PrefetchBatchEnv(FrameEnv, n_workers=3, n_prefetch=2)
+    env.init(path, None, None, None, n_replays=4, n_steps=5, epochs=2, seed=0, packing=True)
+
+    frames = []
+    while True:
+        env_return = env.step()
+        if env_return is None:
+            break
+        result, reset = env_return
+        assert result[0].shape == (5, 4) and reset.shape == (5, 4)
+        frames.append(result[0])
+    env.close()
+
+    frames = np.stack(frames)
+    assert int(np.sum(frames > 0)) == 2*sum(LENGTHS) == env.step_count()
+    assert int(np.sum(frames == 0)) == env.padding_stats()['padding']
+    # Every replay returns 1, 2, ..., T once per epoch
+    values, counts = np.unique(frames[frames > 0], return_counts=True)
+    for v, c in zip(values, counts):
+        assert c == 2*sum(length >= v for length in LENGTHS)
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pytest
+
+from data_loader.BatchEnv import BatchGlobalFeatureEnv, BatchSpatialEnv
+from data_loader.SharedStore import SharedReplayStore, publish, unlink
+from benchmarks.synthetic import generate
+
+def run(env_cls, split, root, cache=None, **step_kwargs):
+    env = env_cls()
+    env.init(split, root, 'Terran', 'Terran', n_replays=3, n_steps=4, epochs=2, seed=0, cache=cache)
+    batches = []
+    while True:
+        env_return = env.step(**step_kwargs)
+        if env_return is None:
+            break
+        batches.append([np.array(r) for r in env_return[0]])
+    env.close()
+    return batches
+
+@pytest.fixture
+def store():
+    name = 'msc_test_{}'.format(os.getpid())
+    yield name
+    try:
+        unlink(name)
+    except FileNotFoundError:
+        pass
+
+@pytest.mark.parametrize('env_cls', [BatchGlobalFeatureEnv, BatchSpatialEnv])
+def test_store_serves_any_labels(tmp_path, store, env_cls):
+    root = str(tmp_path)
+    split = generate(root, n_replays=4, min_length=7, max_length=30, spatial=True, density=0.01)
+    env = env_cls()
+    env.init(split, root, 'Terran', 'Terran')
+    env.close()
+    # Published by a trainer of the default labels
+    publish(env, store)
+
+    for step_kwargs in [{}, {'reward': False, 'action': True}, {'score': True}]:
+        cache = SharedReplayStore(store)
+        batches = run(env_cls, split, root, cache=cache, **step_kwargs)
+        assert cache.misses == 0 and cache.hits > 0
+        cache.close()
+
+        expected = run(env_cls, split, root, **step_kwargs)
+        assert len(batches) == len(expected)
+        for result, expected_result in zip(batches, expected):
+            assert len(result) == len(expected_result)
+            for r, e in zip(result, expected_result):
+                assert np.array_equal(r, e)
+
+def test_store_warns_on_misses(tmp_path, store):
+    root = str(tmp_path)
+    split = generate(root, n_replays=4, min_length=7, max_length=30, density=0.01)
+    env = BatchGlobalFeatureEnv()
+    env.init(split, root, 'Terran', 'Terran')
+    env.close()
+    publish(env, store)
+
+    env = BatchGlobalFeatureEnv()
+    cache = SharedReplayStore(store)
+    # Another observation is another set of features
+    env.init(split, root, 'Terran', 'Terran', epochs=1, cache=cache, observation=['player'])
+    with pytest.warns(UserWarning, match='not in SharedReplayStore'):
+        while env.step() is not None:
+            pass
+    env.close()
+    assert cache.hits == 0 and cache.misses > 0
+    cache.close()
@@ -0,0 +1,47 @@
+import numpy as np
+
+from data_loader.BatchEnv import BatchGlobalFeatureEnv
+from data_loader.WindowEnv import WindowBatchEnv
+from benchmarks.synthetic import generate
+
+class CountingEnv(BatchGlobalFeatureEnv):
+    loads = 0
+
+    def __load_replay__(self, path):
+        CountingEnv.loads += 1
+        return super(CountingEnv, self).__load_replay__(path)
+
+    def __load_window__(self, path, start, end):
+        CountingEnv.loads += 1
+        return super(CountingEnv, self).__load_window__(path, start, end)
+
+def run(split, root, **kwargs):
+    CountingEnv.loads = 0
+    env = WindowBatchEnv(CountingEnv)
+    env.init(split, root, 'Terran', 'Terran', n_replays=3, n_steps=4, epochs=3, seed=0, burn_in=2, **kwargs)
+    batches = []
+    while True:
+        env_return = env.step(action=True)
+        if env_return is None:
+            break
+        result, require_init = env_return
+        assert all(require_init)
+        batches.append([np.array(r) for r in result])
+    env.close()
+    return batches, CountingEnv.loads
+
+def test_windows_are_sliced_from_cached_replays(tmp_path):
+    root = str(tmp_path)
+    split = generate(root, n_replays=4, min_length=7, max_length=30, density=0.1)
+
+    expected, loads = run(split, root, cache_size=0)
+    assert loads == 3*len(expected)
+    batches, loads = run(split, root)
+    # Every replay is decoded once
+    assert loads <= 4
+
+    assert len(batches) == len(expected)
+    for result, expected_result in zip(batches, expected):
+        assert result[0].shape == (2+4, 3, 738)
+        for r, e in zip(result, expected_result):
+            assert np.array_equal(r, e)